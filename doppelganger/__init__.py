@@ -1,15 +1,46 @@
 # Copyright 2017 Sidewalk Labs | https://www.apache.org/licenses/LICENSE-2.0
 
-from .allocation import HouseholdAllocator
-from .bayesnets import SegmentedData, BayesianNetworkModel
-from .config import Configuration
-from .datasource import PumsData, CleanedData, DirtyDataSource
-from .marginals import Marginals
-from .preprocessing import Preprocessor
-from .populationgen import Population
-
-# Enumerate exports, to make the linter happy.
+import importlib
+import sys
+
+# Public name -> module defining it.  Modules are imported when one of their
+# names is first used, so that e.g. a generation worker never pays for
+# importing the allocation or census code.
+_EXPORTS = {
+    'HouseholdAllocator': 'allocation',
+    'SegmentedData': 'bayesnets',
+    'BayesianNetworkModel': 'bayesnets',
+    'Configuration': 'config',
+    'PumsData': 'datasource',
+    'CleanedData': 'datasource',
+    'DirtyDataSource': 'datasource',
+    'Marginals': 'marginals',
+    'Preprocessor': 'preprocessing',
+    'PumaTractMapping': 'pumatracts',
+    'LazyPopulation': 'populationgen',
+    'Population': 'populationgen',
+}
+
 __all__ = [
-    HouseholdAllocator, SegmentedData, BayesianNetworkModel, Configuration,
-    PumsData, CleanedData, Marginals, Population, Preprocessor, DirtyDataSource
+    'HouseholdAllocator', 'SegmentedData', 'BayesianNetworkModel', 'Configuration',
+    'PumsData', 'CleanedData', 'Marginals', 'Population', 'Preprocessor', 'DirtyDataSource',
+    'LazyPopulation', 'PumaTractMapping'
 ]
+
+
+def __getattr__(name):
+    if name not in _EXPORTS:
+        raise AttributeError('module {} has no attribute {}'.format(__name__, name))
+    value = getattr(importlib.import_module('.' + _EXPORTS[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_EXPORTS))
+
+
+if sys.version_info < (3, 7):
+    # Modules cannot define __getattr__, so import everything up front
+    for _name in _EXPORTS:
+        __getattr__(_name)
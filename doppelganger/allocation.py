@@ -3,6 +3,7 @@
 from __future__ import (
     absolute_import, division, print_function, unicode_literals
 )
+from builtins import str
 
 from collections import defaultdict, namedtuple
 import numpy as np
@@ -11,7 +12,7 @@ import pandas
 from doppelganger.listbalancer import (
     balance_multi_cvx, discretize_multi_weights
 )
-from doppelganger import inputs
+from doppelganger import datasets, inputs
 
 # These are the minimum fields needed to allocate households
 DEFAULT_PERSON_FIELDS = {
@@ -31,6 +32,18 @@ DEFAULT_HOUSEHOLD_FIELDS = {
 }
 
 
+# Explicit types of allocation columns in datasets
+DATASET_DTYPES = {
+    inputs.TRACT.name: str,
+    inputs.SERIAL_NUMBER.name: str,
+}
+
+
+# Controls that households are balanced to, and controls of their persons
+HOUSEHOLD_CONTROLS = ['1', '2', '3', '4+']
+PERSON_CONTROLS = ['0-17', '18-34', '35-64', '65+']
+
+
 CountInformation = namedtuple('CountInformation', ['tract', 'count'])
 
 
@@ -53,7 +66,36 @@ class HouseholdAllocator(object):
         return HouseholdAllocator(allocated_households, allocated_persons)
 
     @staticmethod
-    def from_cleaned_data(marginals, households_data, persons_data):
+    def from_dataset(households_path, persons_path, tracts=None, format='parquet'):
+        """Load saved household and person allocations from datasets.
+
+        Only the households of the given tracts are read, and only the persons
+        of those households are kept, so e.g. one county can be regenerated
+        from a statewide allocation.
+
+        Args:
+            households_path (unicode): directory of the households dataset,
+                partitioned by tract
+            persons_path (unicode): directory of the persons dataset
+            tracts (list(unicode)): tracts to load, all if None
+            format (unicode): 'parquet' or 'arrow'
+
+        Returns:
+            HouseholdAllocator: allocated persons & households
+
+        """
+        filters = {inputs.TRACT.name: tracts} if tracts is not None else None
+        allocated_households = datasets.read_dataset(
+            households_path, filters=filters, dtypes=DATASET_DTYPES, format=format)
+        if tracts is not None:
+            filters = {inputs.SERIAL_NUMBER.name: pandas.unique(
+                allocated_households[inputs.SERIAL_NUMBER.name])}
+        allocated_persons = datasets.read_dataset(
+            persons_path, filters=filters, dtypes=DATASET_DTYPES, format=format)
+        return HouseholdAllocator(allocated_households, allocated_persons)
+
+    @staticmethod
+    def from_cleaned_data(marginals, households_data, persons_data, scale=1.0):
         """Allocate households based on the given data.
 
         marginals (Marginals): controls to match when allocating
@@ -61,6 +103,11 @@ class HouseholdAllocator(object):
             DEFAULT_HOUSEHOLD_FIELDS.
         persons_data (CleanedData): data about persons.  Must contain
             DEFAULT_PERSON_FIELDS.
+        scale (float): fraction of the full population to allocate, e.g.
+            0.01 for a 1% population to iterate on models quickly.  Controls,
+            meta-marginals and initial weights are scaled before balancing,
+            and weights are integerized at the scaled totals.  See
+            `scaling_error` for how closely the result matches.
         """
         for field in DEFAULT_HOUSEHOLD_FIELDS:
             assert field.name in households_data.data, \
@@ -69,16 +116,24 @@ class HouseholdAllocator(object):
             assert field.name in persons_data.data, \
                 'Missing required field {}'.format(field.name)
 
+        if scale != 1.0:
+            marginals = marginals.scale(scale)
         households, persons = HouseholdAllocator._format_data(
             households_data.data, persons_data.data)
         allocated_households, allocated_persons = \
-            HouseholdAllocator._allocate_households(households, persons, marginals)
-        return HouseholdAllocator(allocated_households, allocated_persons)
+            HouseholdAllocator._allocate_households(households, persons, marginals, scale)
+        allocator = HouseholdAllocator(allocated_households, allocated_persons)
+        allocator.scaling_error = HouseholdAllocator._scaling_error(
+            allocated_households, marginals)
+        return allocator
 
     def __init__(self, allocated_households, allocated_persons):
 
         self.allocated_households = allocated_households
         self.allocated_persons = allocated_persons
+        # Error of the allocation against its (scaled) controls, if allocated
+        # by from_cleaned_data
+        self.scaling_error = None
         self.serialno_to_counts = defaultdict(list)
         for _, row in self.allocated_households.iterrows():
             serialno = row[inputs.SERIAL_NUMBER.name]
@@ -113,29 +168,47 @@ class HouseholdAllocator(object):
         self.allocated_households.to_csv(household_file)
         self.allocated_persons.to_csv(person_file)
 
+    def write_dataset(self, households_path, persons_path, format='parquet'):
+        """Write allocated households and persons to datasets
+
+        Households are partitioned by tract.  Persons are shared by all tracts,
+        so they are written sorted by serial number instead, which lets readers
+        skip the row groups of other households.
+
+        Args:
+            households_path (unicode): directory to write households to
+            persons_path (unicode): directory to write persons to
+            format (unicode): 'parquet' or 'arrow'
+
+        """
+        datasets.write_dataset(self.allocated_households, households_path,
+                               [inputs.TRACT.name], DATASET_DTYPES, format)
+        persons = self.allocated_persons.sort_values(inputs.SERIAL_NUMBER.name, kind='mergesort')
+        datasets.write_dataset(persons, persons_path, (), DATASET_DTYPES, format)
+
     @staticmethod
-    def _allocate_households(households, persons, tract_controls):
+    def _allocate_households(households, persons, tract_controls, scale=1.0):
         # Only take nonzero weights
         households = households[households[inputs.HOUSEHOLD_WEIGHT.name] > 0]
 
-        # Initial weights from PUMS
-        w = households[inputs.HOUSEHOLD_WEIGHT.name].as_matrix().T
+        # Initial weights from PUMS, scaled like the controls
+        w = households[inputs.HOUSEHOLD_WEIGHT.name].values.T * scale
 
-        hh_columns = ['1', '2', '3', '4+']
+        hh_columns = HOUSEHOLD_CONTROLS
 
-        hh_table = households[hh_columns].as_matrix()
+        hh_table = households[hh_columns].values
 
-        A = tract_controls.data[hh_columns].as_matrix()
+        A = tract_controls.data[hh_columns].values.astype(float)
         n_tracts, n_controls = A.shape
         n_samples = len(households.index.values)
 
         # Control importance weights
         # < 1 means not important (thus relaxing the contraint in the solver)
-        mu = np.mat([1] * n_controls)
+        mu = np.asmatrix([1] * n_controls)
 
         w_extend = np.tile(w, (n_tracts, 1))
-        mu_extend = np.mat(np.tile(mu, (n_tracts, 1)))
-        B = np.mat(np.dot(np.ones((1, n_tracts)), A)[0])
+        mu_extend = np.asmatrix(np.tile(mu, (n_tracts, 1)))
+        B = np.asmatrix(np.dot(np.ones((1, n_tracts)), A)[0])
 
         # Our trade-off coefficient gamma
         # Low values (~1) mean we trust our initial weights, high values
@@ -164,16 +237,56 @@ class HouseholdAllocator(object):
 
         return households_extend, persons
 
+    @staticmethod
+    def _scaling_error(allocated_households, tract_controls):
+        """Compare allocated totals with the controls they were balanced to.
+
+        Returns:
+            DataFrame: indexed by control, with the target total of the
+                controls, the allocated total and the relative error
+        """
+        counts = allocated_households[inputs.COUNT.name].values
+        controls = [control for control in HOUSEHOLD_CONTROLS + PERSON_CONTROLS
+                    if control in allocated_households and control in tract_controls.data]
+        target = np.array([tract_controls.data[control].astype(float).sum()
+                           for control in controls])
+        allocated = np.array([(allocated_households[control].values * counts).sum()
+                              for control in controls], dtype=float)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            relative_error = np.where(target > 0, (allocated - target) / target, np.nan)
+        return pandas.DataFrame({
+            'target': target,
+            'allocated': allocated,
+            'relative_error': relative_error,
+        }, index=pandas.Index(controls, name='control'), columns=[
+            'target', 'allocated', 'relative_error'])
+
+    @staticmethod
+    def _indicators(column, controls):
+        """DataFrame of whether each value of the column is each control.
+
+        Categorical columns are compared by their integer codes.
+        """
+        if hasattr(column, 'cat'):
+            positions = column.cat.categories.get_indexer(controls)
+            values = column.cat.codes.values[:, np.newaxis] == positions[np.newaxis, :]
+            # Controls that are not categories match nothing
+            values &= positions >= 0
+        else:
+            values = (np.asarray(column, dtype=object)[:, np.newaxis] ==
+                      np.array(controls, dtype=object)[np.newaxis, :])
+        return pandas.DataFrame(values, index=column.index, columns=controls)
+
     @staticmethod
     def _format_data(households_data, persons_data):
-        hp_hhs = pandas.get_dummies(
-            households_data[inputs.NUM_PEOPLE.name])
+        hp_hhs = HouseholdAllocator._indicators(
+            households_data[inputs.NUM_PEOPLE.name], HOUSEHOLD_CONTROLS)
         households_data = pandas.concat([households_data, hp_hhs], axis=1)
 
-        hp_ages = pandas.get_dummies(persons_data[inputs.AGE.name])
+        hp_ages = HouseholdAllocator._indicators(persons_data[inputs.AGE.name], PERSON_CONTROLS)
         persons_data = pandas.concat([persons_data, hp_ages], axis=1)
 
-        persons_trimmed = persons_data[[inputs.SERIAL_NUMBER.name, '0-17', '18-34', '35-64', '65+']]
+        persons_trimmed = persons_data[[inputs.SERIAL_NUMBER.name] + PERSON_CONTROLS]
 
         # Get counts we need
         persons_trimmed = persons_trimmed.groupby(
@@ -181,8 +294,8 @@ class HouseholdAllocator(object):
         households_trimmed = households_data[[
             inputs.SERIAL_NUMBER.name,
             inputs.NUM_PEOPLE.name,
-            inputs.HOUSEHOLD_WEIGHT.name, '1', '2', '3', '4+'
-        ]]
+            inputs.HOUSEHOLD_WEIGHT.name
+        ] + HOUSEHOLD_CONTROLS]
 
         # Merge
         households_out = pandas.merge(
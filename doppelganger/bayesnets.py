@@ -21,14 +21,56 @@ import json
 import itertools
 import sys
 
+import numpy as np
 import pandas
-from pomegranate import BayesianNetwork
 
+from doppelganger import inputs, seeding
+from doppelganger.lazy import LazyModule
 
+pomegranate = LazyModule('pomegranate')
+
+
+def vectorized_segmenter(segmenter):
+    """Mark a segmenter as vectorized.
+
+    Segmenters are normally called once per row of data.  A vectorized
+    segmenter is instead called once with the whole DataFrame and returns a
+    Series or array with the segment of each row, e.g.
+
+        household_segmenter = vectorized_segmenter(lambda data: data['num_people'])
+    """
+    segmenter.vectorized = True
+    return segmenter
+
+
+@vectorized_segmenter
 def default_segmenter(x):
     return 'one_segment'
 
 
+def segment_data(segmenter, data):
+    """Find the segment of every row of the given data.
+
+    Args:
+        segmenter: function mapping a row of data to a type, or a vectorized
+            segmenter mapping a DataFrame to the types of its rows
+        data (pandas.DataFrame): data to segment
+
+    Returns:
+        numpy array: the segment of each row
+    """
+    if getattr(segmenter, 'vectorized', False) is True:
+        segments = np.asarray(segmenter(data), dtype=object)
+        if segments.ndim == 0:
+            # A single segment for every row
+            return np.repeat(segments, len(data))
+        return segments
+    segments = np.empty(len(data), dtype=object)
+    for i, (_, row) in enumerate(data.iterrows()):
+        segments[i] = segmenter(row)
+    return segments
+
+
 class SegmentedData(object):
     """Segmented data for use with the segemented BayesianNetworkModel.
 
@@ -47,18 +89,22 @@ class SegmentedData(object):
         Args:
             cleaned_data (CleanedData): data to train on
             segmenter: function mapping a dict of data to a type for
-                segmentation
+                segmentation, or a vectorized segmenter (see
+                `vectorized_segmenter`)
             weight_field (unicode): Name of the int field that shows how much
                 this row  of data should be weighted.
         """
         segmenter = segmenter or default_segmenter
+        data = cleaned_data.data
+        segments = segment_data(segmenter, data)
+        if weight_field:
+            weights = data[weight_field].astype(int)
+        else:
+            weights = np.ones(len(data), dtype=int)
+        rows = data[list(fields)].itertuples(index=False, name=None)
         type_to_data = defaultdict(list)
-        for _, row in cleaned_data.data.iterrows():
-            type_ = segmenter(row)
-            weight = row[weight_field] if weight_field else 1
-            cleaned_row = tuple(row[fields])
-            for _ in range(weight):
-                type_to_data[type_].append(cleaned_row)
+        for type_, weight, cleaned_row in zip(segments, weights, rows):
+            type_to_data[type_].extend([cleaned_row] * weight)
         return SegmentedData(type_to_data, segmenter)
 
     def num_rows_data(self):
@@ -79,7 +125,9 @@ class BayesianNetworkModel(object):
         self.type_to_network = type_to_network
         self.fields = fields
         self.distribution_cache = {}
+        self.cumulative_cache = {}
         self.segmenter = segmenter or default_segmenter
+        self._vocabulary = None
 
     @staticmethod
     def from_file(filename, segmenter=None):
@@ -164,7 +212,8 @@ class BayesianNetworkModel(object):
         json_blob = json.loads(json_string)
         type_to_network = {}
         for type_, network_json in json_blob['type_to_network'].items():
-            type_to_network[type_] = BayesianNetwork.from_json(json.dumps(network_json))
+            type_to_network[type_] = pomegranate.BayesianNetwork.from_json(
+                json.dumps(network_json))
         fields = list(json_blob['fieldnames'])
         return BayesianNetworkModel(type_to_network, fields, segmenter)
 
@@ -193,7 +242,7 @@ class BayesianNetworkModel(object):
             if prior_data is not None:
                 # Make defensive copy
                 data = list(data) + list(prior_data)
-            bayesian_network = BayesianNetwork.from_structure(data, structure)
+            bayesian_network = pomegranate.BayesianNetwork.from_structure(data, structure)
             type_to_network[type_] = bayesian_network
         return BayesianNetworkModel(type_to_network, fields, segmenter=input_data.segmenter)
 
@@ -280,9 +329,11 @@ class BayesianNetworkModel(object):
                 data_new = bayesian_network.predict(data_new)
                 # Update the model
                 bayesian_network.fit(data_new, inertia=inertia)
+        self.distribution_cache = {}
+        self.cumulative_cache = {}
         return self
 
-    def generate(self, type_, evidence, count=1):
+    def generate(self, type_, evidence, count=1, random_state=None):
         """Sample from the network based on the given evidence
 
         Args:
@@ -291,33 +342,200 @@ class BayesianNetworkModel(object):
                     field names must be in the fields supplied on model
                     creation.
             count (int): the number of samples to generate
+            random_state (numpy.random.Generator or RandomState): source of
+                    randomness for reproducible samples, e.g. from `seeding.work_unit_rng`.
+                    Uses pomegranate's global random state if not given.
         Returns:
             tuple of data sampled, one element for each of the fields
                     supplied on model creation.
 
         """
-        if (type_, evidence) in self.distribution_cache:
-            distributions = self.distribution_cache[(type_, evidence)]
-        else:
-            try:
-                evidence_translated = {
-                    str(self.fields.index(field)): value
-                    for field, value in evidence
-                }
-            except ValueError:
-                raise ValueError('Evidence supplied not in model fields')
-                # When pomegranate supports sampling directly from the BN we
-                # will use that. See github issue
-                # https://github.com/jmschrei/pomegranate/issues/231
-            distributions = self.type_to_network[
-                type_].predict_proba(evidence_translated)
-            self.distribution_cache[(type_, evidence)] = distributions
-
+        if random_state is not None:
+            codes, vocabulary = self.generate_batch(
+                [type_], [[value for _, value in evidence]], [count],
+                evidence_fields=[field for field, _ in evidence], random_state=random_state
+            )
+            return tuple(
+                tuple(values[code] for values, code in zip(vocabulary, row)) for row in codes
+            )
+        distributions = self._predict_distributions(type_, evidence)
         generated = tuple(
             tuple(distribution.sample() for distribution in distributions) for _ in range(count)
         )
         return generated
 
+    def _predict_distributions(self, type_, evidence):
+        """The distribution of each field given the evidence, cached."""
+        if (type_, evidence) in self.distribution_cache:
+            return self.distribution_cache[(type_, evidence)]
+        try:
+            evidence_translated = {
+                str(self.fields.index(field)): value
+                for field, value in evidence
+            }
+        except ValueError:
+            raise ValueError('Evidence supplied not in model fields')
+            # When pomegranate supports sampling directly from the BN we
+            # will use that. See github issue
+            # https://github.com/jmschrei/pomegranate/issues/231
+        distributions = self.type_to_network[
+            type_].predict_proba(evidence_translated)
+        self.distribution_cache[(type_, evidence)] = distributions
+        return distributions
+
+    def vocabulary(self):
+        """The possible values of each field, across all segments.
+
+        Returns:
+            list(list): for each field, its sorted values.  The integer codes
+                returned by `generate_batch` index into these lists.
+        """
+        if self._vocabulary is None:
+            field_values = [set() for _ in self.fields]
+            for network in self.type_to_network.values():
+                for values, state in zip(field_values, network.states):
+                    distribution = json.loads(str(state))['distribution']
+                    if distribution['name'] == 'ConditionalProbabilityTable':
+                        values.update(row[-2] for row in distribution['table'])
+                    else:
+                        values.update(distribution['parameters'][0])
+            self._vocabulary = [sorted(values) for values in field_values]
+        return self._vocabulary
+
+    def _cumulative_probabilities(self, type_, evidence):
+        """Cumulative probabilities over the vocabulary codes of each field, cached."""
+        if (type_, evidence) in self.cumulative_cache:
+            return self.cumulative_cache[(type_, evidence)]
+        cumulative = []
+        for field, distribution, values in zip(
+                self.fields, self._predict_distributions(type_, evidence), self.vocabulary()):
+            if hasattr(distribution, 'parameters'):
+                probabilities = distribution.parameters[0]
+            else:
+                # An observed value rather than a distribution
+                probabilities = {distribution: 1.0}
+            field_cumulative = np.cumsum([probabilities.get(value, 0.0) for value in values])
+            if not field_cumulative[-1] > 0:
+                raise ValueError('No possible values for {} given evidence {}'.format(
+                    field, evidence))
+            cumulative.append(field_cumulative / field_cumulative[-1])
+        self.cumulative_cache[(type_, evidence)] = cumulative
+        return cumulative
+
+    def generate_batch(self, segments, evidence_matrix, counts, evidence_fields=None,
+                       random_state=None):
+        """Sample from the network for many (segment, evidence) pairs at once.
+
+        Requests with identical segment and evidence are grouped, and each
+        group is sampled with a single vectorized draw.
+
+        Args:
+            segments (array-like): user-defined type of each request
+            evidence_matrix (pandas.DataFrame): observed values, one row per
+                request and one column per evidence field.  A 2d array may be
+                passed instead along with `evidence_fields`.  Blank values are
+                treated as unobserved.
+            counts (array-like(int)): number of samples for each request
+            evidence_fields (list(unicode)): names of the columns of
+                evidence_matrix, when it is not a DataFrame
+            random_state (numpy.random.Generator or RandomState): source of
+                randomness, e.g. from `seeding.work_unit_rng`.  Uses numpy's global random
+                state if not given.
+
+        Returns:
+            (numpy array, list(list)): integer codes with a row for each
+                sample and a column for each of the fields supplied on model
+                creation, and the vocabulary those codes index into.  The
+                samples of each request are contiguous and in request order.
+        """
+        if isinstance(evidence_matrix, pandas.DataFrame):
+            evidence_fields = list(evidence_matrix.columns)
+            evidence_values = evidence_matrix.values
+        else:
+            evidence_fields = list(evidence_fields or ())
+            evidence_values = np.asarray(evidence_matrix, dtype=object).reshape(
+                len(counts), len(evidence_fields))
+        segments = np.asarray(segments, dtype=object)
+        counts = np.asarray(counts, dtype=np.int64)
+        random_state = random_state if random_state is not None else np.random
+        vocabulary = self.vocabulary()
+        codes = np.zeros((counts.sum(), len(self.fields)), dtype=_code_dtype(vocabulary))
+        if len(counts) == 0:
+            return codes, vocabulary
+
+        offsets = np.cumsum(counts) - counts
+        key_columns = [segments] + [evidence_values[:, i] for i in range(len(evidence_fields))]
+        for first_row, rows in iterate_groups(key_columns):
+            n_samples = counts[rows].sum()
+            if n_samples == 0:
+                continue
+            evidence = tuple(
+                (field, value) for field, value in zip(evidence_fields, evidence_values[first_row])
+                if not inputs.is_blank(value)
+            )
+            cumulative = self._cumulative_probabilities(segments[first_row], evidence)
+            draws = seeding.uniform(random_state, (n_samples, len(self.fields)))
+            targets = expand_ranges(offsets[rows], counts[rows])
+            for i, field_cumulative in enumerate(cumulative):
+                codes[targets, i] = np.minimum(
+                    np.searchsorted(field_cumulative, draws[:, i], side='right'),
+                    len(field_cumulative) - 1
+                )
+        return codes, vocabulary
+
+
+def _code_dtype(vocabulary):
+    """Smallest signed integer type that can hold a code for every value."""
+    largest = max([len(values) for values in vocabulary] + [1])
+    for dtype in (np.int8, np.int16, np.int32):
+        if largest <= np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+
+def expand_ranges(starts, lengths):
+    """Concatenation of np.arange(start, start + length) for each start and length."""
+    ends = np.cumsum(lengths)
+    return np.repeat(starts - ends + lengths, lengths) + np.arange(ends[-1] if len(ends) else 0)
+
+
+def iterate_groups(key_columns):
+    """Group the rows of the given columns by their values in all columns.
+
+    Missing values are grouped together like any other value.
+
+    Args:
+        key_columns (list(array-like)): columns of equal length
+
+    Yields: (position of the group's first row, positions of all its rows)
+        for each group, in order of first appearance
+    """
+    if len(key_columns[0]) == 0:
+        return
+    # Combine the columns' codes one column at a time, refactorizing so that
+    # the combined codes stay below the number of rows.  Missing values have
+    # code -1, so codes are shifted up by one before combining.
+    group_ids = None
+    for column in key_columns:
+        if isinstance(column, pandas.Categorical):
+            # Categorical codes already number the values
+            codes = column.codes.astype(np.int64) + 1
+        elif hasattr(column, 'cat'):
+            codes = column.cat.codes.values.astype(np.int64) + 1
+        else:
+            codes = pandas.factorize(np.asarray(column, dtype=object))[0].astype(np.int64) + 1
+        if group_ids is not None:
+            codes = group_ids * (codes.max() + 1) + codes
+        group_ids = pandas.factorize(codes)[0].astype(np.int64)
+    # Factorized codes number groups in order of first appearance
+    order = np.argsort(group_ids, kind='mergesort')
+    group_sizes = np.bincount(group_ids)
+    group_ends = np.cumsum(group_sizes)
+    group_starts = group_ends - group_sizes
+    for start, end in zip(group_starts, group_ends):
+        rows = order[start:end]
+        yield rows[0], rows
+
 
 def define_bayes_net_structure(nodes, edges):
     """Create a bayes network based on the given configuration
@@ -0,0 +1,170 @@
+# Copyright 2017 Sidewalk Labs | https://www.apache.org/licenses/LICENSE-2.0
+
+"""On-disk cache of census API responses.
+
+ACS releases do not change once published, so a response can be reused for
+as long as it is kept.  Responses are stored in a SQLite file, keyed by the
+dataset (the API url, which includes the year), the variables asked for and
+the geography.  The API key is not part of the cache key.
+
+    cache = CensusCache('census_cache.sqlite')
+    marginals = Marginals.from_census_data_by_county(
+        mappings, census_key, state, pumas, cache=cache)
+
+With `offline=True`, a cache never lets a request through: responses that are
+not cached fail with `CensusCacheMiss`.
+"""
+
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+
+import json
+import sqlite3
+
+
+class CensusCacheMiss(Exception):
+    """A response was not cached, and the cache is offline."""
+    pass
+
+
+def cache_key(api_url, params):
+    """Cache key of a request to the census API.
+
+    Args:
+        api_url (unicode): url of the dataset, e.g. .../data/2015/acs5
+        params (dict): query parameters, with 'get', 'for' and 'in'
+
+    Returns:
+        unicode: key that is the same for the same dataset, variables and
+            geography, whatever the order of the variables and the API key
+    """
+    return json.dumps({
+        'dataset': api_url,
+        'variables': sorted(params['get'].split(',')),
+        'for': params.get('for'),
+        'in': params.get('in'),
+    }, sort_keys=True)
+
+
+class CensusCache(object):
+
+    def __init__(self, path, max_bytes=None, offline=False):
+        """
+        Args:
+            path (unicode): SQLite file to store responses in, created if
+                missing.  ':memory:' keeps responses in memory only.
+            max_bytes (int): if given, the least recently used responses are
+                evicted to keep the stored responses under this size
+            offline (bool): never request uncached responses, see
+                `fetch`
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.connection = sqlite3.connect(path)
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS responses ('
+                'key TEXT PRIMARY KEY, response TEXT NOT NULL, '
+                'size INTEGER NOT NULL, last_used INTEGER NOT NULL)'
+            )
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)')
+
+    def _next_use(self):
+        """Increasing number to order responses by use, which unlike the time
+        can never tie."""
+        return self.connection.execute(
+            'SELECT COALESCE(MAX(last_used), 0) + 1 FROM responses').fetchone()[0]
+
+    def get(self, key):
+        """The cached response of the key, or None if it is not cached."""
+        row = self.connection.execute(
+            'SELECT response FROM responses WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        with self.connection:
+            self.connection.execute(
+                'UPDATE responses SET last_used = ? WHERE key = ?', (self._next_use(), key))
+        return json.loads(row[0])
+
+    def put(self, key, response):
+        """Store a JSON-serializable response."""
+        text = json.dumps(response)
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO responses (key, response, size, last_used) '
+                'VALUES (?, ?, ?, ?)', (key, text, len(text), self._next_use()))
+        if self.max_bytes is not None:
+            self._evict()
+
+    def _evict(self):
+        total = self.connection.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = self.connection.execute(
+            'SELECT key, size FROM responses ORDER BY last_used').fetchall()
+        evicted = []
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            evicted.append((key,))
+            total -= size
+        with self.connection:
+            self.connection.executemany('DELETE FROM responses WHERE key = ?', evicted)
+        self.evictions += len(evicted)
+
+    def fetch(self, api_url, params, request):
+        """The response of a request, from the cache if possible.
+
+        Args:
+            api_url (unicode): url of the dataset
+            params (dict): query parameters
+            request (function): called with no arguments to make the request
+                and return its JSON response, if it is not cached
+
+        Raises:
+            CensusCacheMiss: if the response is not cached and the cache is
+                offline
+        """
+        key = cache_key(api_url, params)
+        response = self.get(key)
+        if response is not None:
+            return response
+        if self.offline:
+            raise CensusCacheMiss('Not cached: {}'.format(key))
+        response = request()
+        self.put(key, response)
+        return response
+
+    def stats(self):
+        """Statistics of the cache.
+
+        Returns:
+            dict: hits and misses of this object, responses evicted by it,
+                and the number and total size of the stored responses
+        """
+        entries, size = self.connection.execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses').fetchone()
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': entries,
+            'bytes': size,
+        }
+
+    def clear(self):
+        """Remove every stored response."""
+        with self.connection:
+            self.connection.execute('DELETE FROM responses')
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,225 @@
+# Copyright 2017 Sidewalk Labs | https://www.apache.org/licenses/LICENSE-2.0
+
+"""Concurrent, rate-limited and retrying requests to the census API.
+
+Requests are scheduled with asyncio and made with a pooled `requests.Session`
+on a thread pool, so no asynchronous http library is needed.  At most
+`concurrency` requests are in flight, a token bucket limits how many are
+started per second, and failed requests are retried with exponential backoff.
+Requests that still fail are collected in a `FetchReport` rather than
+stopping the whole fetch.
+
+Requires python 3, and is not even valid syntax on python 2, so it is only
+imported by functions that need it and is left out of flake8 on python 2.
+"""
+
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import logging
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from doppelganger.censuscache import cache_key
+
+# Http statuses worth retrying: rate limited and server errors
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+
+class TokenBucket(object):
+    """Allows `rate` acquisitions per second on average, in bursts of at most
+    `capacity`."""
+
+    def __init__(self, rate, capacity=1, clock=time.monotonic):
+        if rate <= 0:
+            raise ValueError('Rate must be positive, got {}'.format(rate))
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.tokens = capacity
+        self.updated = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        """Wait until a token is available, and take it."""
+        while True:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class RetryableError(Exception):
+    pass
+
+
+class FetchReport(object):
+    """Outcome of a fetch.
+
+    Attributes:
+        succeeded (list): keys of the queries that succeeded
+        failed (OrderedDict): key -> error message of the queries that failed
+            after all retries
+        requests (int): number of requests made, including retries
+        retries (int): number of retried requests
+        cached (int): number of queries answered from a cache
+    """
+
+    def __init__(self):
+        self.succeeded = []
+        self.failed = OrderedDict()
+        self.requests = 0
+        self.retries = 0
+        self.cached = 0
+
+    @property
+    def complete(self):
+        return not self.failed
+
+    def __repr__(self):
+        return 'FetchReport(succeeded={}, failed={}, requests={}, retries={}, cached={})'.format(
+            len(self.succeeded), len(self.failed), self.requests, self.retries, self.cached)
+
+
+class CensusFetcher(object):
+
+    def __init__(self, api_url, concurrency=8, rate=None, retries=3, backoff=0.5,
+                 max_backoff=30., timeout=60., cache=None):
+        """
+        Args:
+            api_url (unicode): url to request
+            concurrency (int): maximum number of requests in flight
+            rate (float): maximum number of requests started per second, or
+                None for no limit
+            retries (int): number of times to retry a failed request
+            backoff (float): seconds to wait before the first retry, doubled
+                for each retry after that
+            max_backoff (float): longest wait between retries
+            timeout (float): seconds to wait for a response
+            cache (censuscache.CensusCache): if given, only responses that are
+                not cached are requested, and they are then stored.  If the
+                cache is offline, uncached queries fail.
+        """
+        self.api_url = api_url
+        self.concurrency = concurrency
+        self.rate = rate
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.cache = cache
+
+    def _get(self, session, params):
+        """Make one request.  Raises RetryableError if it may succeed later."""
+        try:
+            response = session.get(self.api_url, params=params, timeout=self.timeout)
+        except requests.RequestException as e:
+            raise RetryableError(str(e))
+        if response.status_code in RETRY_STATUSES:
+            raise RetryableError('HTTP {}'.format(response.status_code))
+        response.raise_for_status()
+        return response.json()
+
+    async def _fetch(self, key, params, session, executor, semaphore, bucket, report, loop):
+        async with semaphore:
+            for attempt in range(self.retries + 1):
+                if bucket is not None:
+                    await bucket.acquire()
+                report.requests += 1
+                try:
+                    return await loop.run_in_executor(
+                        executor, functools.partial(self._get, session, params))
+                except RetryableError as e:
+                    if attempt == self.retries:
+                        raise
+                    report.retries += 1
+                    logging.info('Retrying {} after {}'.format(key, e))
+                    await asyncio.sleep(min(self.backoff * 2 ** attempt, self.max_backoff))
+
+    async def _fetch_all(self, queries, session, executor, loop):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        bucket = TokenBucket(self.rate) if self.rate is not None else None
+        report = FetchReport()
+        results = await asyncio.gather(*(
+            self._fetch(key, params, session, executor, semaphore, bucket, report, loop)
+            for key, params in queries
+        ), return_exceptions=True)
+
+        responses = OrderedDict()
+        for (key, _), result in zip(queries, results):
+            if isinstance(result, Exception):
+                logging.warning('Failed to fetch {}: {}'.format(key, result))
+                report.failed[key] = '{}: {}'.format(type(result).__name__, result)
+            else:
+                responses[key] = result
+                report.succeeded.append(key)
+        return responses, report
+
+    def fetch_all(self, queries):
+        """Fetch the JSON responses of the given queries.
+
+        Args:
+            queries (list((key, dict))): keys and query parameters
+
+        Returns:
+            (OrderedDict, FetchReport): key -> JSON response of each query
+                that succeeded, and the report of the fetch
+        """
+        queries = list(queries)
+        cached = OrderedDict()
+        if self.cache is not None:
+            for key, params in queries:
+                response = self.cache.get(cache_key(self.api_url, params))
+                if response is not None:
+                    cached[key] = response
+        uncached = [(key, params) for key, params in queries if key not in cached]
+        if self.cache is not None and self.cache.offline:
+            responses, report = OrderedDict(), FetchReport()
+            for key, params in uncached:
+                report.failed[key] = 'CensusCacheMiss: not cached'
+        else:
+            responses, report = self._fetch_uncached(uncached)
+            if self.cache is not None:
+                for key, params in uncached:
+                    if key in responses:
+                        self.cache.put(cache_key(self.api_url, params), responses[key])
+
+        report.succeeded = list(cached) + report.succeeded
+        report.cached = len(cached)
+        cached.update(responses)
+        ordered = OrderedDict((key, cached[key]) for key, _ in queries if key in cached)
+        return ordered, report
+
+    def _fetch_uncached(self, queries):
+        # A loop cannot run while another runs in the same thread, as in
+        # Jupyter, so then the fetch gets a thread of its own
+        if asyncio._get_running_loop() is not None:
+            with ThreadPoolExecutor(max_workers=1) as thread:
+                return thread.submit(self._run_fetch, queries).result()
+        return self._run_fetch(queries)
+
+    def _run_fetch(self, queries):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.concurrency)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(self._fetch_all(queries, session, executor, loop))
+        finally:
+            loop.close()
+            executor.shutdown()
+            session.close()
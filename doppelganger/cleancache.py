@@ -0,0 +1,282 @@
+# Copyright 2017 Sidewalk Labs | https://www.apache.org/licenses/LICENSE-2.0
+
+"""Content-addressed cache of cleaned data.
+
+Cleaning the same PUMS extract with the same preprocessing gives the same
+result, so `CleanedDataCache.clean` stores what `DirtyDataSource.clean`
+returns, keyed by
+
+ - the source file (its path, size and modification time, or a hash of its
+   contents) or, without a file, a hash of the dirty data,
+ - the source's name map, the requested fields, puma and categorical flag,
+ - the preprocessing: the config of a `Preprocessor.from_config`, or the
+   names and possible values of its processors.
+
+Cleaned frames are stored as Parquet files, which keep categoricals and are
+read back much faster than they are cleaned.  The least recently used are
+evicted to keep the cache under `max_bytes`.  Requires pyarrow.
+
+    cache = CleanedDataCache('cleaned_cache')
+    households = cache.clean(
+        PumsData.from_csv(path), fields, preprocessor, puma='00106', source_path=path)
+"""
+
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+from builtins import str
+
+import hashlib
+import json
+import os
+import sqlite3
+
+import pandas
+
+from doppelganger import inputs
+from doppelganger.datasource import CleanedData
+from doppelganger.hashing import callable_name, file_digest
+
+# Changes whenever cleaning gives different results for the same inputs, so
+# that older entries are not reused
+CLEANING_VERSION = 1
+
+INDEX_FILENAME = 'index.sqlite'
+
+
+def file_key(path, content_hash=False):
+    """Identity of a source file.
+
+    Args:
+        path (unicode): path to the file
+        content_hash (bool): hash the contents of the file, so that an
+            unchanged copy or a touched file still hit.  Otherwise the path,
+            size and modification time identify it, which costs no reading.
+    """
+    if not content_hash:
+        stat = os.stat(path)
+        return {'path': os.path.abspath(path), 'size': stat.st_size,
+                'mtime': getattr(stat, 'st_mtime_ns', stat.st_mtime)}
+    return {'sha256': file_digest(path)}
+
+
+def data_key(data):
+    """Identity of a DataFrame, from a hash of its columns and values."""
+    digest = hashlib.sha256()
+    digest.update(json.dumps([str(column) for column in data.columns]).encode('utf-8'))
+    digest.update(pandas.util.hash_pandas_object(data, index=True).values.tobytes())
+    return {'sha256': digest.hexdigest()}
+
+
+def preprocessor_key(preprocessor, fields):
+    """Identity of how a preprocessor cleans the given fields.
+
+    A preprocessor made with `Preprocessor.from_config` is identified by its
+    config.  Other custom processors are identified by their name and the
+    possible values of their field, so changing the code of one without
+    renaming it needs a `key` passed to `CleanedDataCache.clean`.
+    """
+    if getattr(preprocessor, 'config', None) is not None:
+        return {'config': preprocessor.config}
+    processors = {}
+    for field in fields:
+        processor = preprocessor.input_to_preprocessor.get(field)
+        if processor is None and field in inputs.NAME_TO_DATATYPE:
+            processor = inputs.NAME_TO_DATATYPE[field].preprocessor
+        possible_values = preprocessor.get_possible_values(field) \
+            if field in inputs.NAME_TO_DATATYPE else None
+        processors[field] = [
+            callable_name(processor) if processor is not None else None,
+            sorted(possible_values) if isinstance(possible_values, (set, frozenset))
+            else possible_values
+        ]
+    return {'processors': processors}
+
+
+def cache_key(source_key, fields, preprocessor, puma=None, categorical=False, key=None,
+              name_map=None):
+    """Hex digest identifying a cleaning of a source.
+
+    name_map is the source's map from field names to its column names,
+    which decides the columns cleaned.
+    """
+    description = {
+        'version': CLEANING_VERSION,
+        'source': source_key,
+        'name_map': sorted((name_map or {}).items()),
+        'fields': list(fields),
+        'puma': None if puma is None else str(puma),
+        'categorical': categorical,
+        'preprocessor': preprocessor_key(preprocessor, fields),
+        'key': key,
+    }
+    return hashlib.sha256(
+        json.dumps(description, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def _read_parquet(path):
+    """Read a cleaned frame back, with its object columns as objects again.
+
+    Newer pandas read strings back as a string dtype, which turns the None
+    of missing values into NaN.  The pandas metadata that pyarrow stores
+    tells which columns were objects.
+    """
+    import pyarrow.parquet
+
+    table = pyarrow.parquet.read_table(path)
+    data = table.to_pandas()
+    metadata = table.schema.pandas_metadata or {}
+    for column in metadata.get('columns', []):
+        name = column.get('name')
+        if column.get('numpy_type') == 'object' and name in data and \
+                data[name].dtype != object:
+            values = data[name].astype(object)
+            data[name] = values.where(values.notnull(), None)
+    return data
+
+
+class CleanedDataCache(object):
+
+    def __init__(self, directory, max_bytes=None):
+        """
+        Args:
+            directory (unicode): directory to store cleaned data in, created
+                if missing
+            max_bytes (int): if given, the least recently used entries are
+                evicted to keep the stored files under this size
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.connection = sqlite3.connect(os.path.join(directory, INDEX_FILENAME))
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS entries ('
+                'key TEXT PRIMARY KEY, size INTEGER NOT NULL, last_used INTEGER NOT NULL)'
+            )
+
+    def _path(self, key):
+        return os.path.join(self.directory, '{}.parquet'.format(key))
+
+    def _next_use(self):
+        """Increasing number to order entries by use, which unlike the time
+        can never tie."""
+        return self.connection.execute(
+            'SELECT COALESCE(MAX(last_used), 0) + 1 FROM entries').fetchone()[0]
+
+    def get(self, key):
+        """The cached CleanedData of the key, or None if it is not cached."""
+        path = self._path(key)
+        known = self.connection.execute(
+            'SELECT 1 FROM entries WHERE key = ?', (key,)).fetchone()
+        if known is None or not os.path.exists(path):
+            self.misses += 1
+            return None
+        self.hits += 1
+        with self.connection:
+            self.connection.execute(
+                'UPDATE entries SET last_used = ? WHERE key = ?', (self._next_use(), key))
+        return CleanedData(_read_parquet(path))
+
+    def put(self, key, cleaned_data):
+        """Store CleanedData under the key."""
+        import pyarrow
+        import pyarrow.parquet
+
+        path = self._path(key)
+        # Write to a temporary file first, so readers never see part of one
+        temporary_path = path + '.tmp'
+        pyarrow.parquet.write_table(
+            pyarrow.Table.from_pandas(cleaned_data.data), temporary_path)
+        os.rename(temporary_path, path)
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO entries (key, size, last_used) VALUES (?, ?, ?)',
+                (key, os.path.getsize(path), self._next_use()))
+        if self.max_bytes is not None:
+            self._evict()
+
+    def _evict(self):
+        total = self.connection.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = self.connection.execute(
+            'SELECT key, size FROM entries ORDER BY last_used').fetchall()
+        evicted = []
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            evicted.append(key)
+            total -= size
+        with self.connection:
+            self.connection.executemany(
+                'DELETE FROM entries WHERE key = ?', [(key,) for key in evicted])
+        for key in evicted:
+            if os.path.exists(self._path(key)):
+                os.remove(self._path(key))
+        self.evictions += len(evicted)
+
+    def clean(self, source, fields, preprocessor, puma=None, categorical=False,
+              source_path=None, content_hash=False, key=None):
+        """`source.clean(fields, preprocessor, puma, categorical)`, from the
+        cache if it was cleaned before.
+
+        Args:
+            source (DirtyDataSource): data to clean
+            source_path (unicode): file the source was read from.  If None,
+                the source's data is hashed instead.
+            content_hash (bool): identify the source file by a hash of its
+                contents, see `file_key`
+            key: anything JSON-serializable to add to the cache key, e.g. a
+                version of custom preprocessors
+            see `DirtyDataSource.clean` for the other arguments
+
+        Returns:
+            CleanedData: the cleaned data
+        """
+        fields = list(fields)
+        if source_path is not None:
+            source_key = file_key(source_path, content_hash)
+        else:
+            source_key = data_key(source.data)
+        entry = cache_key(source_key, fields, preprocessor, puma, categorical, key,
+                          name_map=source.name_map)
+        cleaned = self.get(entry)
+        if cleaned is None:
+            cleaned = source.clean(fields, preprocessor, puma=puma, categorical=categorical)
+            self.put(entry, cleaned)
+        return cleaned
+
+    def stats(self):
+        """Statistics of the cache.
+
+        Returns:
+            dict: hits and misses of this object, entries evicted by it, and
+                the number and total size of the stored entries
+        """
+        entries, size = self.connection.execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone()
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': entries,
+            'bytes': size,
+        }
+
+    def clear(self):
+        """Remove every stored entry."""
+        keys = [row[0] for row in self.connection.execute('SELECT key FROM entries')]
+        with self.connection:
+            self.connection.execute('DELETE FROM entries')
+        for key in keys:
+            if os.path.exists(self._path(key)):
+                os.remove(self._path(key))
+
+    def close(self):
+        self.connection.close()
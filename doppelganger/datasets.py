@@ -0,0 +1,168 @@
+# Copyright 2017 Sidewalk Labs | https://www.apache.org/licenses/LICENSE-2.0
+
+"""Columnar datasets partitioned by tract or PUMA.
+
+A dataset is a directory of Parquet or Arrow IPC files with one subdirectory
+per partition value, e.g. `households/tract=000100/part-0-0.parquet`.  Unlike
+csv, columns keep their types, so identifiers such as tracts and PUMAs keep
+their leading zeros.  Readers load only the columns they ask for and skip
+every file outside the requested partitions, so one county of a statewide
+allocation can be reloaded without reading the rest of the state.
+
+Partition columns are always stored as strings.  Requires pyarrow.
+"""
+
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+from builtins import str
+
+import os
+
+
+# Dataset format to (pyarrow format, file extension)
+FORMATS = {
+    'parquet': ('parquet', 'parquet'),
+    'arrow': ('ipc', 'arrow'),
+}
+
+
+def _format(format):
+    if format not in FORMATS:
+        raise ValueError('Unknown dataset format {}, expected one of {}'.format(
+            format, sorted(FORMATS)))
+    return FORMATS[format][0]
+
+
+def extension(format):
+    """File extension of the given dataset format."""
+    _format(format)
+    return FORMATS[format][1]
+
+
+def _partitioning(columns):
+    import pyarrow
+    import pyarrow.dataset
+
+    return pyarrow.dataset.partitioning(
+        pyarrow.schema([(column, pyarrow.string()) for column in columns]), flavor='hive')
+
+
+def _partition_columns(path):
+    """Names of the partition columns of a dataset, from its directory names."""
+    columns = []
+    while os.path.isdir(path):
+        subdirectories = sorted(
+            name for name in os.listdir(path)
+            if '=' in name and os.path.isdir(os.path.join(path, name))
+        )
+        if not subdirectories:
+            break
+        columns.append(subdirectories[0].split('=', 1)[0])
+        path = os.path.join(path, subdirectories[0])
+    return columns
+
+
+def _as_types(data, dtypes):
+    dtypes = {column: dtype for column, dtype in (dtypes or {}).items() if column in data}
+    return data.astype(dtypes) if dtypes else data
+
+
+def write_dataset(data, path, partition_by=(), dtypes=None, format='parquet',
+                  basename_template=None, replace=True):
+    """Write a DataFrame to a dataset.  The index is not written.
+
+    Args:
+        data (DataFrame): data to write
+        path (unicode): directory of the dataset
+        partition_by (iterable(unicode)): columns to partition by, outermost
+            first
+        dtypes (dict(unicode, dtype)): explicit types of columns
+        format (unicode): 'parquet' or 'arrow'
+        basename_template (unicode): name of the files written, see
+            `pyarrow.dataset.write_dataset`
+        replace (bool): if True, replace the partitions being written.  If
+            False, add files alongside them.
+    """
+    import pyarrow
+    import pyarrow.dataset
+
+    partition_by = list(partition_by)
+    data = _as_types(data, dtypes)
+    data = data.astype({column: str for column in partition_by})
+    table = pyarrow.Table.from_pandas(data, preserve_index=False)
+    kwargs = {}
+    if basename_template is not None:
+        kwargs['basename_template'] = basename_template
+    pyarrow.dataset.write_dataset(
+        table, path,
+        format=_format(format),
+        partitioning=_partitioning(partition_by) if partition_by else None,
+        existing_data_behavior='delete_matching' if replace else 'overwrite_or_ignore',
+        **kwargs
+    )
+
+
+def _filter_expression(filters, partition_columns):
+    import pyarrow.dataset
+
+    expression = None
+    for column, values in sorted(filters.items()):
+        if isinstance(values, (str, bytes)) or not hasattr(values, '__iter__'):
+            values = [values]
+        if column in partition_columns:
+            values = [str(value) for value in values]
+        condition = pyarrow.dataset.field(column).isin(list(values))
+        expression = condition if expression is None else expression & condition
+    return expression
+
+
+def _open(path, format):
+    import pyarrow.dataset
+
+    partition_columns = _partition_columns(path)
+    dataset = pyarrow.dataset.dataset(
+        path, format=_format(format),
+        partitioning=_partitioning(partition_columns) if partition_columns else None
+    )
+    return dataset, partition_columns
+
+
+def read_dataset(path, columns=None, filters=None, dtypes=None, format='parquet'):
+    """Read a DataFrame from a dataset.
+
+    Args:
+        path (unicode): directory of the dataset
+        columns (list(unicode)): columns to read, all columns if None
+        filters (dict(unicode, value or list)): read only the rows whose
+            column has the given value, or one of the given values.  Filters
+            on partition columns skip whole files.
+        dtypes (dict(unicode, dtype)): explicit types of columns
+        format (unicode): 'parquet' or 'arrow'
+
+    Returns:
+        DataFrame: the rows read, with the columns in the order written
+    """
+    dataset, partition_columns = _open(path, format)
+    filter_ = _filter_expression(filters, partition_columns) if filters else None
+    table = dataset.to_table(columns=columns, filter=filter_)
+    data = table.to_pandas()
+
+    if columns is None:
+        metadata = dataset.schema.pandas_metadata or {}
+        order = [column['name'] for column in metadata.get('columns', [])
+                 if column['name'] in data]
+        columns = order + [column for column in data if column not in order]
+    return _as_types(data[list(columns)], dtypes)
+
+
+def iter_dataset(path, columns=None, filters=None, dtypes=None, format='parquet'):
+    """Read a dataset one batch of rows at a time.
+
+    Takes the same arguments as `read_dataset`, except that columns must be
+    given, and yields DataFrames of those columns.
+    """
+    dataset, partition_columns = _open(path, format)
+    filter_ = _filter_expression(filters, partition_columns) if filters else None
+    for batch in dataset.to_batches(columns=columns, filter=filter_):
+        yield _as_types(batch.to_pandas()[list(columns)], dtypes)
@@ -4,9 +4,189 @@ from __future__ import (
     absolute_import, division, print_function, unicode_literals
 )
 
+from contextlib import closing, contextmanager
+import re
+import sys
+import threading
+import zipfile
+
 import pandas
+from six.moves import queue
+
+from doppelganger import datasets, inputs
+
+# Rows of PUMS csv files read at a time
+PUMS_CSV_CHUNK_SIZE = 100000
+
+# PUMS column of the state fips code, which PUMA codes are unique within
+PUMS_STATE_COLUMN = 'st'
+
+# Rows fetched from a database cursor at a time
+PUMS_DATABASE_CHUNK_SIZE = 10000
+
+# Table and schema names are formatted into queries, so only plain
+# identifiers are accepted
+_IDENTIFIER = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+
+def _placeholders(paramstyle, count):
+    """Query placeholders of `count` parameters in a DB-API paramstyle."""
+    if paramstyle == 'qmark':
+        return ['?'] * count
+    if paramstyle in ('format', 'pyformat'):
+        return ['%s'] * count
+    if paramstyle == 'numeric':
+        return [':{}'.format(i + 1) for i in range(count)]
+    if paramstyle == 'named':
+        return [':p{}'.format(i) for i in range(count)]
+    raise ValueError('Unsupported paramstyle {}'.format(paramstyle))
+
+
+def _query_params(paramstyle, values):
+    """Parameters of a query in a DB-API paramstyle, by name for 'named'."""
+    if paramstyle == 'named':
+        return {'p{}'.format(i): value for i, value in enumerate(values)}
+    return list(values)
+
+
+def _is_sqlalchemy(conn):
+    """Whether a connection is a SQLAlchemy engine or connection."""
+    return type(conn).__module__.split('.')[0] == 'sqlalchemy'
+
+
+def _connection_paramstyle(conn):
+    """Paramstyle of the DB-API module of a connection, e.g. 'qmark' for
+    sqlite3 and 'pyformat' for psycopg2.
+
+    SQLAlchemy connectables take named parameters, whatever their driver.
+    """
+    if _is_sqlalchemy(conn):
+        return 'named'
+    module = sys.modules.get(type(conn).__module__.split('.')[0])
+    return getattr(module, 'paramstyle', 'qmark')
+
+
+def _pums_query(table_name, schema, columns, puma_count, paramstyle):
+    """Parameterized query of the rows of some PUMAs of a state, ordered by
+    PUMA so that the rows of each PUMA are contiguous."""
+    for identifier in [table_name, schema] + list(columns):
+        if identifier is not None and not _IDENTIFIER.match(identifier):
+            raise ValueError('Invalid identifier {}'.format(identifier))
+    table = table_name if schema is None else '{}.{}'.format(schema, table_name)
+    placeholders = _placeholders(paramstyle, puma_count + 1)
+    return 'SELECT {} FROM {} WHERE ST={} AND PUMA IN ({}) ORDER BY PUMA, SERIALNO'.format(
+        ', '.join(columns), table, placeholders[0], ', '.join(placeholders[1:]))
+
 
-from doppelganger import inputs
+class ConnectionPool(object):
+    """Database connections shared by concurrent readers.
+
+    At most `size` connections are opened, when first needed, and each is
+    used by one reader at a time.  Connections may be used from several
+    threads, e.g. sqlite3 connections must be made with
+    check_same_thread=False.
+    """
+
+    def __init__(self, connect, size=4):
+        """
+        Args:
+            connect (function): called with no arguments to open a DB-API
+                connection
+            size (int): maximum number of open connections
+        """
+        self.connect = connect
+        self.size = size
+        self._idle = queue.Queue()
+        self._opened = []
+        self._lock = threading.Lock()
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if len(self._opened) < self.size:
+                conn = self.connect()
+                self._opened.append(conn)
+                return conn
+        return self._idle.get()
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection, waiting for one if they are all in use."""
+        conn = self._acquire()
+        try:
+            yield conn
+        finally:
+            self._idle.put(conn)
+
+    def close(self):
+        """Close every connection opened by the pool."""
+        with self._lock:
+            for conn in self._opened:
+                conn.close()
+            self._opened = []
+            self._idle = queue.Queue()
+
+
+def _csv_member_names(archive):
+    """Names of the csv files to read in a zip archive.
+
+    A zip archive, e.g. the national csv_pus.zip, is read member by member;
+    the national files are split into several csvs, e.g. ss15pusa.csv and
+    ss15pusb.csv.
+    """
+    return [name for name in sorted(archive.namelist())
+            if name.lower().endswith('.csv') and not name.startswith('__MACOSX/')]
+
+
+def _filter_csv_chunks(infile, path, columns, filters, chunksize):
+    """Stream the filtered rows of one csv, see `_iter_pums_csv`."""
+    read_columns = list(columns) + [column for column in filters if column not in columns]
+    reader = pandas.read_csv(
+        infile, chunksize=chunksize, dtype=str,
+        usecols=lambda column: column.lower() in read_columns
+    )
+    try:
+        for chunk in reader:
+            chunk.columns = [column.lower() for column in chunk.columns]
+            for column, (values, width) in filters.items():
+                if column not in chunk:
+                    raise ValueError('Cannot filter {} by {}, it has no such column'.format(
+                        path, column))
+                chunk = chunk[chunk[column].str.zfill(width).isin(values)]
+            yield chunk[[column for column in columns if column in chunk]]
+    finally:
+        reader.close()
+
+
+def _iter_pums_csv(path, columns, filters, chunksize):
+    """Stream the rows of a PUMS csv that pass the filters.
+
+    Args:
+        path (unicode): csv file, or zip archive of csv files
+        columns (list(unicode)): lower case PUMS names of the columns to
+            return.  Columns are matched whatever their case, and returned
+            in lower case.
+        filters (dict(unicode, (set(unicode), int))): column -> (values to
+            keep, width to zero-pad the values to before comparing)
+        chunksize (int): rows to read at a time
+
+    Yields:
+        DataFrame: filtered rows of each chunk, with every column a string
+    """
+    if not zipfile.is_zipfile(path):
+        for chunk in _filter_csv_chunks(path, path, columns, filters, chunksize):
+            yield chunk
+        return
+    # The archive and each member are closed once streamed, or when the
+    # caller stops early and closes the generator
+    with zipfile.ZipFile(path) as archive:
+        for name in _csv_member_names(archive):
+            with archive.open(name) as member:
+                for chunk in _filter_csv_chunks(member, path, columns, filters, chunksize):
+                    yield chunk
 
 
 class DataSource(object):
@@ -15,9 +195,32 @@ class DataSource(object):
     def from_csv(cls, infile):
         raise NotImplementedError()
 
+    @classmethod
+    def from_dataset(cls, path, columns=None, filters=None, format='parquet'):
+        """Load data from a dataset written by `write_dataset`.
+
+        Args:
+            path (unicode): directory of the dataset
+            columns (list(unicode)): columns to read, all if None
+            filters (dict(unicode, value or list)): read only matching rows,
+                e.g. {'puma': '00100'}
+            format (unicode): 'parquet' or 'arrow'
+        """
+        return cls(datasets.read_dataset(path, columns, filters, format=format))
+
     def write(self, outfile):
         self.data.to_csv(outfile)
 
+    def write_dataset(self, path, partition_by=(), format='parquet'):
+        """Write data to a dataset, e.g. partitioned by PUMA.
+
+        Args:
+            path (unicode): directory to write to
+            partition_by (iterable(unicode)): columns to partition by
+            format (unicode): 'parquet' or 'arrow'
+        """
+        datasets.write_dataset(self.data, path, partition_by, format=format)
+
 
 class DirtyDataSource(DataSource):
 
@@ -25,10 +228,30 @@ class DirtyDataSource(DataSource):
         self.data = data
         self.name_map = name_map
 
-    def clean(self, fields, preprocessor, puma=None):
-        cleaned_data = preprocessor.process_dataframe(self.data, fields, self.name_map)
-        if puma is not None:
+    def clean(self, fields, preprocessor, puma=None, categorical=False):
+        """Process the given fields into CleanedData.
+
+        Args:
+            fields (iterable(unicode)): names of the fields to process
+            preprocessor (Preprocessor): processes the fields, and knows their
+                possible values
+            puma (unicode): keep only the rows of this puma
+            categorical (bool): store fields with possible values as
+                categoricals, see `CleanedData.categorize`.  Off by default,
+                as missing values then become NaN rather than None.
+        """
+        data = self.data
+        dirty_puma = self.name_map.get(inputs.PUMA.name)
+        filter_dirty = (puma is not None and dirty_puma in data and
+                        inputs.PUMA.name not in preprocessor.input_to_preprocessor)
+        if filter_dirty:
+            # Skip preprocessing the rows of other pumas
+            data = data[data[dirty_puma].astype(int) == int(puma)]
+        cleaned_data = preprocessor.process_dataframe(data, fields, self.name_map)
+        if puma is not None and not filter_dirty:
             cleaned_data = cleaned_data[cleaned_data[inputs.PUMA.name].astype(int) == int(puma)]
+        if categorical:
+            return CleanedData(cleaned_data).categorize(preprocessor)
         return CleanedData(cleaned_data)
 
 
@@ -43,19 +266,221 @@ class PumsData(DirtyDataSource):
 
     @staticmethod
     def from_database(
-        conn, state_id, puma_id, table_name, fields
+        conn, state_id, puma_id, table_name, fields, schema='import'
     ):
-        columns = ', '.join(field.pums_name for field in fields)
-        query = (
-            'SELECT {} FROM import.{} WHERE ST=\'{}\' AND PUMA=\'{}\' ORDER BY SERIALNO'
-        ).format(columns, table_name, state_id, puma_id)
-        return PumsData(pandas.read_sql_query(query, conn))
+        """Read the rows of a PUMA.
+
+        Args:
+            conn: DB-API connection, or SQLAlchemy engine or connection
+            see `iter_from_database` for the other arguments
+        """
+        columns = [field.pums_name for field in fields]
+        paramstyle = _connection_paramstyle(conn)
+        query = _pums_query(table_name, schema, columns, 1, paramstyle)
+        if _is_sqlalchemy(conn):
+            import sqlalchemy
+            query = sqlalchemy.text(query)
+        params = _query_params(paramstyle, [state_id, puma_id])
+        return PumsData(pandas.read_sql_query(query, conn, params=params))
+
+    @staticmethod
+    def iter_from_database(conn, state_id, puma_ids, table_name, fields, schema='import',
+                           chunksize=PUMS_DATABASE_CHUNK_SIZE, cursor_name=None):
+        """Stream the rows of several PUMAs with one query.
+
+        Rows are fetched `chunksize` at a time, and the data of each PUMA is
+        yielded as soon as its last row arrives, so at most one PUMA and one
+        chunk are held in memory.
+
+        Args:
+            conn: DB-API connection, e.g. from sqlite3 or psycopg2
+            state_id (unicode): state fips code
+            puma_ids (iterable(unicode)): PUMAs to read
+            table_name (unicode): table of PUMS records
+            fields (iterable(DataType)): fields to read
+            schema (unicode): schema of the table, or None
+            chunksize (int): rows to fetch at a time
+            cursor_name (unicode): if given, open a named cursor, which
+                psycopg2 keeps on the server instead of sending every row of
+                the result at once
+
+        Yields:
+            (unicode, PumsData): each PUMA with rows, in PUMA order, and its
+                data ordered by serial number
+        """
+        puma_ids = sorted(set(puma_ids))
+        if not puma_ids:
+            return
+        columns = [field.pums_name for field in fields]
+        read_columns = list(columns)
+        if inputs.PUMA.pums_name not in [column.lower() for column in columns]:
+            read_columns.append(inputs.PUMA.pums_name)
+        paramstyle = _connection_paramstyle(conn)
+        query = _pums_query(table_name, schema, read_columns, len(puma_ids), paramstyle)
+        cursor = conn.cursor(cursor_name) if cursor_name is not None else conn.cursor()
+        try:
+            cursor.execute(query, _query_params(paramstyle, [state_id] + puma_ids))
+            names = [description[0] for description in cursor.description]
+            puma_position = [name.lower() for name in names].index(inputs.PUMA.pums_name)
+            current_puma, rows = None, []
+            while True:
+                chunk = cursor.fetchmany(chunksize)
+                if not chunk:
+                    break
+                for row in chunk:
+                    if row[puma_position] != current_puma and rows:
+                        yield current_puma, PumsData._from_rows(rows, names, columns)
+                        rows = []
+                    current_puma = row[puma_position]
+                    rows.append(row)
+            if rows:
+                yield current_puma, PumsData._from_rows(rows, names, columns)
+        finally:
+            cursor.close()
+
+    @staticmethod
+    def _from_rows(rows, names, columns):
+        data = pandas.DataFrame.from_records(rows, columns=names)
+        return PumsData(data[names[:len(columns)]])
+
+    @staticmethod
+    def iter_from_database_pool(pool, state_id, puma_ids, table_name, fields, readers=None,
+                                schema='import', chunksize=PUMS_DATABASE_CHUNK_SIZE):
+        """Stream the rows of several PUMAs with concurrent readers.
+
+        The PUMAs are split between `readers` threads, each streaming its
+        share with `iter_from_database` over a connection of the pool.
+
+        Args:
+            pool (ConnectionPool): connections to read with
+            readers (int): number of concurrent readers, the size of the
+                pool if None
+            see `iter_from_database` for the other arguments
+
+        Yields:
+            (unicode, PumsData): each PUMA with rows, in the order they are
+                read
+        """
+        puma_ids = sorted(set(puma_ids))
+        readers = min(readers or pool.size, len(puma_ids))
+        if readers == 0:
+            return
+        # Bounded, so that readers wait rather than fill memory
+        partitions = queue.Queue(maxsize=2 * readers)
+        done = object()
+        # Set if the caller stops iterating, to release the readers
+        stopped = threading.Event()
+
+        def put(item):
+            while not stopped.is_set():
+                try:
+                    partitions.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def read(batch):
+            try:
+                with pool.connection() as conn, closing(PumsData.iter_from_database(
+                        conn, state_id, batch, table_name, fields, schema, chunksize)) as reader:
+                    for partition in reader:
+                        if not put(partition):
+                            return
+            except Exception as e:
+                put(e)
+            finally:
+                put(done)
+
+        threads = [threading.Thread(target=read, args=(puma_ids[i::readers],))
+                   for i in range(readers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        finished = 0
+        try:
+            while finished < readers:
+                partition = partitions.get()
+                if partition is done:
+                    finished += 1
+                elif isinstance(partition, Exception):
+                    raise partition
+                else:
+                    yield partition
+        finally:
+            stopped.set()
 
     @staticmethod
     def from_csv(infile):
         data = pandas.read_csv(infile)
         return PumsData(data)
 
+    @staticmethod
+    def from_csv_filtered(infile, fields, state=None, pumas=None,
+                          chunksize=PUMS_CSV_CHUNK_SIZE):
+        """Load the rows of some PUMAs from a large PUMS csv.
+
+        The file is streamed a chunk at a time, reading only the columns of
+        the given fields, and each chunk is filtered by state and PUMA before
+        the next is read.  Memory use is that of the selected rows, so a
+        single PUMA can be loaded out of a national file.  Values are read
+        as strings, as they are in the PUMS, e.g. '00106' for a PUMA.
+
+        Args:
+            infile (unicode): PUMS csv, or a zip archive of csvs, e.g. the
+                national csv_pus.zip, whose csv members are all read
+            fields (iterable(DataType)): fields to load
+            state (unicode): state fips code to keep, e.g. '06', all if None
+            pumas (iterable(unicode)): PUMA codes to keep, e.g. ['00106'],
+                all if None.  Files of several states need `state` as well.
+            chunksize (int): rows to read at a time
+
+        Returns:
+            PumsData: the selected rows of the given fields
+        """
+        columns = [field.pums_name for field in fields]
+        filters = {}
+        if state is not None:
+            filters[PUMS_STATE_COLUMN] = ({str(state).zfill(2)}, 2)
+        if pumas is not None:
+            filters[inputs.PUMA.pums_name] = ({str(puma).zfill(5) for puma in pumas}, 5)
+        chunks = list(_iter_pums_csv(infile, columns, filters, chunksize))
+        if not chunks:
+            return PumsData(pandas.DataFrame(columns=columns))
+        return PumsData(pandas.concat(chunks, ignore_index=True))
+
+
+def vocabulary(possible_values):
+    """Ordered values of a field: sets are sorted, sequences keep their
+    order, e.g. the labels of bins."""
+    if isinstance(possible_values, (set, frozenset)):
+        return sorted(possible_values)
+    return list(possible_values)
+
+
+def to_categorical(column, possible_values):
+    """A column as a categorical over the given values.
+
+    Values that are not possible are kept, as extra categories after the
+    possible ones, rather than lost, and blanks are missing.  Values are
+    compared as strings, so columns read back from csv as numbers still
+    match.
+    """
+    categories = vocabulary(possible_values)
+    if hasattr(column, 'cat'):
+        values = column.cat.categories
+        if list(values[:len(categories)]) == categories:
+            return column
+        column = column.astype(object)
+    # Blanks are missing, as in `inputs.is_blank`
+    present = column.notnull() & (column.astype(str) != '')
+    column = column.astype(str).where(present)
+    extra = sorted(set(pandas.unique(column[present])) - set(categories))
+    return pandas.Series(
+        pandas.Categorical(column, categories=categories + extra),
+        index=column.index, name=column.name
+    )
+
 
 class CleanedData(DataSource):
 
@@ -66,3 +491,42 @@ class CleanedData(DataSource):
     def from_csv(infile):
         data = pandas.read_csv(infile)
         return CleanedData(data)
+
+    def categorize(self, preprocessor=None, fields=None):
+        """Store fields as categoricals over their possible values.
+
+        Every CleanedData categorized with the same preprocessor shares the
+        same categories, so the integer codes of a field (see `codes`) mean
+        the same in all of them.  Codes take a byte a value instead of a
+        string object, and can be grouped and compared without hashing.
+
+        Args:
+            preprocessor (Preprocessor): gives the possible values of each
+                field, those of its DataType if None
+            fields (iterable(unicode)): fields to categorize, every known
+                field with possible values if None
+
+        Returns:
+            CleanedData: with the fields categorical, and the other columns
+                unchanged
+        """
+        if fields is None:
+            fields = [column for column in self.data.columns
+                      if column in inputs.NAME_TO_DATATYPE]
+        data = self.data.copy()
+        for field in fields:
+            if preprocessor is not None:
+                possible_values = preprocessor.get_possible_values(field)
+            else:
+                possible_values = inputs.NAME_TO_DATATYPE[field].possible_values
+            if possible_values is not None:
+                data[field] = to_categorical(data[field], possible_values)
+        return CleanedData(data)
+
+    def vocabulary(self, field):
+        """Values of a categorical field, in the order of their codes."""
+        return list(self.data[field].cat.categories)
+
+    def codes(self, field):
+        """Integer codes of a categorical field, -1 for missing values."""
+        return self.data[field].cat.codes.values
@@ -0,0 +1,29 @@
+# Copyright 2017 Sidewalk Labs | https://www.apache.org/licenses/LICENSE-2.0
+
+"""Hashes and names shared by the caches that key results by their inputs:
+the pipeline's stage directories and the cleaned data cache."""
+
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+
+import hashlib
+
+# Bytes of a file hashed at a time
+HASH_BLOCK_SIZE = 1 << 20
+
+
+def file_digest(path):
+    """sha256 of the contents of a file, read a block at a time."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as infile:
+        for block in iter(lambda: infile.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def callable_name(value):
+    """Qualified name of a function or class, or of the class of an
+    instance, e.g. doppelganger.preprocessing.Preprocessor."""
+    return '{}.{}'.format(getattr(value, '__module__', None),
+                          getattr(value, '__name__', type(value).__name__))
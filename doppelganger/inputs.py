@@ -12,6 +12,9 @@ import datetime
 from enum import Enum
 import math
 
+import numpy as np
+import pandas
+
 # Constant for missing data
 UNKNOWN = None
 
@@ -23,18 +26,57 @@ class DataCategory(Enum):
 
 class DataType(object):
 
-    def __init__(self, name, pums_name, preprocessor, type_, possible_values):
+    def __init__(self, name, pums_name, preprocessor, type_, possible_values,
+                 vectorized_preprocessor=None):
+        """
+        Args:
+            vectorized_preprocessor (function): processes a whole Series at
+                once, with the same results as applying `preprocessor` to each
+                element.  Defaults to the `vectorized` attribute of
+                `preprocessor`, if it has one.
+        """
         self.name = name
         self.pums_name = pums_name
         self.preprocessor = preprocessor
         self.type_ = type_
         self.possible_values = possible_values
+        self.vectorized_preprocessor = (
+            vectorized_preprocessor or getattr(preprocessor, 'vectorized', None))
 
     def process(self, data):
         if self.preprocessor is not None:
             return self.preprocessor(data)
         return data
 
+    def process_series(self, series):
+        """Process every element of a Series."""
+        if self.vectorized_preprocessor is not None:
+            return self.vectorized_preprocessor(series)
+        if self.preprocessor is not None:
+            return series.apply(self.preprocessor)
+        return series
+
+
+def process_series(preprocessor, series):
+    """Apply a preprocessor to every element of a Series, with its vectorized
+    variant if it has one."""
+    vectorized = getattr(preprocessor, 'vectorized', None)
+    if vectorized is not None:
+        return vectorized(series)
+    return series.apply(preprocessor)
+
+
+def vectorized(elementwise):
+    """Declare a function as the vectorized variant of a preprocessor.
+
+    The decorated function takes and returns a Series, and is stored as the
+    `vectorized` attribute of `elementwise`.
+    """
+    def decorator(function):
+        elementwise.vectorized = function
+        return function
+    return decorator
+
 
 def is_blank(input):
     return (
@@ -44,6 +86,34 @@ def is_blank(input):
     )
 
 
+def _integers(series):
+    """Vectorized int(), as floats, with NaN for blanks.
+
+    PUMS columns have few distinct values, so each is converted once, with
+    int() itself so that values it rejects, e.g. '2.7', raise ValueError here
+    too.
+    """
+    codes, uniques = pandas.factorize(series)
+    numbers = [np.nan if is_blank(value) else int(value) for value in uniques]
+    # Code -1 of missing values picks the NaN at the end
+    return np.array(numbers + [np.nan], dtype=float)[codes]
+
+
+def _series(series, values):
+    """Series of processed values, kept as objects so that UNKNOWN stays
+    None rather than becoming NaN."""
+    return pandas.Series(values, index=series.index, name=series.name, dtype=object)
+
+
+def _labeled(series, labels, codes, unknown=None):
+    """Series of the labels at the given codes, and UNKNOWN where
+    `unknown`."""
+    values = np.asarray(labels, dtype=object)[codes]
+    if unknown is not None:
+        values[unknown] = UNKNOWN
+    return _series(series, values)
+
+
 def generate_binning_preprocessor(bins):
     if len(bins) == 0:
         return lambda x: 'all_values'
@@ -62,6 +132,13 @@ def generate_binning_preprocessor(bins):
             if int(number) <= bin_:
                 return labels[i]
         return labels[-1]
+
+    @vectorized(generate_bin)
+    def generate_bins(series):
+        numbers = _integers(series)
+        codes = np.searchsorted(bins, numbers, side='left')
+        codes[np.isnan(numbers)] = 0
+        return _labeled(series, labels, codes)
     return labels, generate_bin
 
 
@@ -81,12 +158,29 @@ def age_discrete(age):
     return '65+'
 
 
+@vectorized(age_discrete)
+def _age_discrete_vectorized(ages):
+    numbers = _integers(ages)
+    codes = np.searchsorted([17, 34, 64], numbers, side='left')
+    return _labeled(ages, ['0-17', '18-34', '35-64', '65+'], codes, np.isnan(numbers))
+
+
 def num_people_discrete(num_people):
     if int(num_people) < 4:
         return str(int(num_people))
     return '4+'
 
 
+@vectorized(num_people_discrete)
+def _num_people_discrete_vectorized(num_people):
+    numbers = _integers(num_people)
+    if np.isnan(numbers).any():
+        # Blanks are errors, as they are element by element
+        return num_people.apply(num_people_discrete)
+    labels = np.where(numbers < 4, numbers.astype(np.int64).astype(str), '4+')
+    return _series(num_people, labels.astype(object))
+
+
 def gender_named(input):
     if is_blank(input):
         return UNKNOWN
@@ -100,6 +194,21 @@ def gender_named(input):
         return UNKNOWN
 
 
+@vectorized(gender_named)
+def _gender_named_vectorized(genders):
+    numbers = _integers(genders)
+    values = np.select([numbers == 1, numbers == 2], ['M', 'F'], default=UNKNOWN)
+    return _series(genders, values)
+
+
+def _int_vectorized(series):
+    """Vectorized int(), which also fails on blanks."""
+    numbers = _integers(series)
+    if np.isnan(numbers).any():
+        return series.apply(int)
+    return pandas.Series(numbers.astype(np.int64), index=series.index, name=series.name)
+
+
 def yyyy_to_age(input):
     if is_blank(input):
         return UNKNOWN
@@ -132,11 +241,11 @@ NUM_PEOPLE = DataType(
 )
 
 HOUSEHOLD_WEIGHT = DataType(
-    'household_weight', 'wgtp', int, DataCategory.HOUSEHOLD, None
+    'household_weight', 'wgtp', int, DataCategory.HOUSEHOLD, None, _int_vectorized
 )
 
 PERSON_WEIGHT = DataType(
-    'person_weight', 'pwgtp', int, DataCategory.PERSON, None
+    'person_weight', 'pwgtp', int, DataCategory.PERSON, None, _int_vectorized
 )
 
 SERIAL_NUMBER = DataType('serial_number', 'serialno', None, None, None)
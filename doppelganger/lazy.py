@@ -0,0 +1,38 @@
+# Copyright 2017 Sidewalk Labs | https://www.apache.org/licenses/LICENSE-2.0
+
+"""Modules imported at first use.
+
+cvxpy, pomegranate and requests take long to import, and most processes use
+at most one of them: a generation worker never solves an allocation, and an
+allocation never fetches marginals.  Modules that depend on them refer to a
+`LazyModule` instead, which imports the real module the first time one of
+its attributes is used.
+
+    cvx = LazyModule('cvxpy')
+    ...
+    x = cvx.Variable(n)  # cvxpy is imported here
+"""
+
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+
+import importlib
+
+
+class LazyModule(object):
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attribute):
+        return getattr(self._load(), attribute)
+
+    def __repr__(self):
+        return '<lazy module {}>'.format(self._name)
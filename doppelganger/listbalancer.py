@@ -6,9 +6,12 @@ from __future__ import (
 
 import logging
 
-import cvxpy as cvx
 import numpy as np
 
+from doppelganger.lazy import LazyModule
+
+cvx = LazyModule('cvxpy')
+
 
 def _insert_append(arr, indices, values, axis=0):
     """Insert / Append values to array along given axis
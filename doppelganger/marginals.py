@@ -4,8 +4,16 @@ from __future__ import (
     absolute_import, division, print_function, unicode_literals
 )
 
+from builtins import str
+
+import logging
+
 import pandas
-import requests
+
+from doppelganger import datasets
+from doppelganger.censuscache import CensusCacheMiss
+from doppelganger.lazy import LazyModule
+from doppelganger.pumatracts import GEOGRAPHY_COLUMNS, PumaTractMapping
 
 
 CONTROLS = {
@@ -58,6 +66,29 @@ CONTROL_NAMES = tuple(i for cat in CONTROLS.keys()
                       for i in CONTROLS[cat].keys())
 
 
+CENSUS_API_URL = 'http://api.census.gov/data/2015/acs5'
+
+# Maximum number of connections kept open to the census API
+CENSUS_POOL_SIZE = 10
+
+
+# Rows of ACS summary files read at a time
+SUMMARY_FILE_CHUNK_SIZE = 100000
+
+# GEO_ID prefix of the tract summary level of ACS summary files
+SUMMARY_TRACT_GEO_ID_PREFIX = '1400000US'
+
+
+requests = LazyModule('requests')
+
+
+# Explicit types of marginals columns in datasets
+DATASET_DTYPES = dict(
+    [(column, str) for column in GEOGRAPHY_COLUMNS] +
+    [(control, 'int64') for control in CONTROL_NAMES]
+)
+
+
 class CensusFetchException(Exception):
     pass
 
@@ -66,40 +97,304 @@ class Marginals(object):
 
     def __init__(self, data):
         self.data = data
+        # Report of failed requests, if fetched concurrently
+        self.fetch_report = None
+
+    def scale(self, scale):
+        """Marginals with every control multiplied by the given factor.
+
+        Used to allocate a scaled-down population, e.g. at 1% with scale=0.01.
+        Meta-marginals are sums of the controls, so they scale consistently.
+
+        Args:
+            scale (float): factor to multiply controls by, greater than 0
+
+        Returns:
+            Marginals: scaled marginals, with float controls
+        """
+        if scale <= 0:
+            raise ValueError('Scale must be positive, got {}'.format(scale))
+        data = self.data.copy()
+        for control in CONTROL_NAMES:
+            if control in data:
+                data[control] = data[control].astype(float) * scale
+        return Marginals(data)
 
     @staticmethod
     def _fetch_from_census(
-        census_key, field_key_list, tract_key, state_key, county_key
+        census_key, field_key_list, tract_key, state_key, county_key, cache=None
     ):
         controls_str = ','.join(field_key_list)
-        query = ('http://api.census.gov/data/2015/acs5?get={}'
+        query = ('{}?get={}'
                  '&for=tract:{}&in=state:{}+county:{}&key={}'
-                 ).format(controls_str, tract_key, state_key,
+                 ).format(CENSUS_API_URL, controls_str, tract_key, state_key,
                           county_key, census_key)
-        try:
-            encoded_response = requests.get(query)
-            response = encoded_response.json()
-        except Exception:
-            print('failed to load marginals for query:\n{}\n'.format(query))
-            print('response:\n{}'.format(encoded_response.text))
-            raise CensusFetchException()
+
+        def request():
+            try:
+                encoded_response = requests.get(query)
+                return encoded_response.json()
+            except Exception:
+                print('failed to load marginals for query:\n{}\n'.format(query))
+                print('response:\n{}'.format(encoded_response.text))
+                raise CensusFetchException()
+
+        if cache is None:
+            response = request()
+        else:
+            params = Marginals._census_params(
+                census_key, field_key_list, state_key, county_key, tract_key)
+            try:
+                response = cache.fetch(CENSUS_API_URL, params, request)
+            except CensusCacheMiss as e:
+                raise CensusFetchException(str(e))
         control_keys = response[0]
         control_counts = response[1]
         full_controls = dict(zip(control_keys, control_counts))
         return full_controls
 
     @staticmethod
-    def from_census_data(puma_tract_mappings, census_key, state=None, pumas=None):
+    def _census_params(census_key, field_key_list, state_key, county_key, tract_key='*'):
+        """Query parameters of the ACS API for one tract, or with '*' all
+        tracts of a county."""
+        return {
+            'get': ','.join(field_key_list),
+            'for': 'tract:{}'.format(tract_key),
+            'in': 'state:{} county:{}'.format(state_key, county_key),
+            'key': census_key,
+        }
+
+    @staticmethod
+    def _control_fields(control_cat):
+        return [key for sublist in control_cat.values() for key in sublist]
+
+    @staticmethod
+    def _response_frame(response):
+        """DataFrame of a JSON response of the ACS API, a row per tract."""
+        frame = pandas.DataFrame(response[1:], columns=response[0])
+        # A field may be asked for more than once, keep one column of each
+        return frame.loc[:, ~frame.columns.duplicated()]
+
+    @staticmethod
+    def _fetch_county_from_census(
+        session, api_url, census_key, field_key_list, state_key, county_key, cache=None
+    ):
+        """Fetch the given fields of every tract in a county in one request.
+
+        Returns:
+            DataFrame: a row per tract, with a column per field and the
+                'state', 'county' and 'tract' columns of the response
+        """
+        params = Marginals._census_params(census_key, field_key_list, state_key, county_key)
+
+        def request():
+            encoded_response = session.get(api_url, params=params)
+            encoded_response.raise_for_status()
+            return encoded_response.json()
+
+        try:
+            response = request() if cache is None else cache.fetch(api_url, params, request)
+        except Exception as e:
+            raise CensusFetchException(
+                'Failed to load marginals for state {} county {}: {}'.format(
+                    state_key, county_key, e))
+        return Marginals._response_frame(response)
+
+    @staticmethod
+    def _tract_controls(frames, county_key):
+        """Sum the fields of a county's responses into controls, for every
+        tract at once.
+
+        Args:
+            frames (list(DataFrame)): response of each control category
+            county_key (unicode): county of the responses
+        """
+        frame = pandas.concat(
+            [frame.set_index('tract') for frame in frames], axis=1, join='inner')
+        frame = frame.loc[:, ~frame.columns.duplicated()]
+        controls = pandas.DataFrame({
+            'COUNTYFP': county_key,
+            'TRACTCE': frame.index.values,
+        })
+        for _, control_cat in CONTROLS.items():
+            for sum_key, sum_cat in control_cat.items():
+                values = frame[list(sum_cat)].apply(pandas.to_numeric, errors='coerce')
+                missing = values.isnull().any(axis=1).values
+                if missing.any():
+                    raise CensusFetchException(
+                        'Missing or non-numeric {} in county {} tracts {}'.format(
+                            sum_key, county_key, list(frame.index.values[missing])))
+                counts = values.sum(axis=1).astype('int64')
+                controls[sum_key] = counts.astype(str).values
+        return controls
+
+    @staticmethod
+    def _select_mappings(puma_tract_mappings, state, pumas):
+        """Mappings of the tracts in the given pumas of a state."""
+        if isinstance(puma_tract_mappings, PumaTractMapping):
+            return puma_tract_mappings.select(state, pumas)
+        return pandas.DataFrame(
+            [line for line in puma_tract_mappings
+             if line['STATEFP'] == state and line['PUMA5CE'] in pumas],
+            columns=list(GEOGRAPHY_COLUMNS)
+        )
+
+    @staticmethod
+    def _select_pumas(puma_tract_mappings, state, pumas):
+        """Mappings of the tracts in the given pumas of a state, checking
+        that the state and every puma are given and mapped."""
+        pumas = list(pumas or [])
+        if not state or not pumas:
+            raise ValueError('Please supply a state fips code and a puma.')
+        mappings = Marginals._select_mappings(puma_tract_mappings, state, pumas)
+        unknown = sorted(set(pumas).difference(mappings['PUMA5CE']))
+        if unknown:
+            raise ValueError('No tracts are mapped to pumas {} of state {}'.format(
+                unknown, state))
+        return mappings
+
+    @staticmethod
+    def _join_mappings(mappings, tract_controls):
+        """Marginals of the mapped tracts that have controls, in mapping order."""
+        columns = list(GEOGRAPHY_COLUMNS) + list(CONTROL_NAMES)
+        if not tract_controls:
+            return Marginals(pandas.DataFrame([], columns=columns))
+        controls = pandas.concat(tract_controls, ignore_index=True)
+        data = mappings.merge(controls, on=['COUNTYFP', 'TRACTCE'], how='inner')
+        return Marginals(data[columns].reset_index(drop=True))
+
+    @staticmethod
+    def from_census_data_by_county(puma_tract_mappings, census_key, state, pumas,
+                                   session=None, api_url=CENSUS_API_URL, cache=None):
+        """Fetch marginal sums from the census API, a county at a time.
+
+        Rather than a request per tract and control category, this makes one
+        request per county and control category, for all of the county's
+        tracts, over a pool of reused connections.  The response is then
+        split into tracts.  Counties that fail to load are skipped.
+
+        Args:
+            puma_tract_mappings (dict): see `from_census_data`
+            census_key (unicode): census API key
+            state (unicode): state fips code
+            pumas (iterable of unicode): pumas to fetch for
+            session (requests.Session): session to make requests with.  If
+                None, a pooled session is opened and closed.
+            api_url (unicode): url of the ACS API
+            cache (censuscache.CensusCache): if given, reuse and store
+                responses in this cache
+
+        Returns:
+            Marginals: marginals fetched from the census API, with the same
+                columns as `from_census_data`
+
+        """
+        mappings = Marginals._select_pumas(puma_tract_mappings, state, pumas)
+        own_session = session is None
+        if own_session:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=CENSUS_POOL_SIZE, pool_maxsize=CENSUS_POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+
+        tract_controls = []
+        try:
+            for county_key in pandas.unique(mappings['COUNTYFP']):
+                logging.info('Fetching county {}'.format(county_key))
+                try:
+                    frames = [
+                        Marginals._fetch_county_from_census(
+                            session, api_url, census_key,
+                            Marginals._control_fields(control_cat), state, county_key, cache
+                        )
+                        for control_cat in CONTROLS.values()
+                    ]
+                    tract_controls.append(Marginals._tract_controls(frames, county_key))
+                except CensusFetchException as e:
+                    logging.warning('Skip county {}: {}'.format(county_key, e))
+        finally:
+            if own_session:
+                session.close()
+        return Marginals._join_mappings(mappings, tract_controls)
+
+    @staticmethod
+    def from_census_data_concurrent(puma_tract_mappings, census_key, state=None, pumas=None,
+                                    by_county=False, concurrency=8, rate=None, retries=3,
+                                    backoff=0.5, api_url=CENSUS_API_URL, cache=None):
+        """Fetch marginal sums from the census API with concurrent requests.
+
+        Takes the same mappings, state and pumas as `from_census_data` and
+        returns the same marginals, but requests run concurrently, limited to
+        `rate` per second, and failed requests are retried with exponential
+        backoff before their tract (or county) is skipped.  Requires python 3.
+
+        Args:
+            puma_tract_mappings (dict): see `from_census_data`
+            census_key (unicode): census API key
+            state (unicode): state fips code
+            pumas (iterable of unicode): pumas to fetch for
+            by_county (bool): fetch all tracts of a county in one request per
+                control category, see `from_census_data_by_county`
+            concurrency (int): maximum number of requests in flight
+            rate (float): maximum number of requests started per second, or
+                None for no limit
+            retries (int): number of times to retry a failed request
+            backoff (float): seconds to wait before the first retry, doubled
+                for each retry after that
+            api_url (unicode): url of the ACS API
+            cache (censuscache.CensusCache): if given, only responses that
+                are not cached are requested, and they are then stored
+
+        Returns:
+            Marginals: marginals fetched from the census API.  Its
+                `fetch_report` (censusfetch.FetchReport) lists the tracts or
+                counties that failed, and why.
+
+        """
+        from doppelganger.censusfetch import CensusFetcher
+
+        mappings = Marginals._select_pumas(puma_tract_mappings, state, pumas)
+        if by_county:
+            units = [(county_key, '*') for county_key in pandas.unique(mappings['COUNTYFP'])]
+        else:
+            units = list(zip(mappings['COUNTYFP'], mappings['TRACTCE']))
+        queries = [
+            ((unit, category), Marginals._census_params(
+                census_key, Marginals._control_fields(control_cat), state, *unit))
+            for unit in units for category, control_cat in CONTROLS.items()
+        ]
+        fetcher = CensusFetcher(api_url, concurrency=concurrency, rate=rate, retries=retries,
+                                backoff=backoff, cache=cache)
+        responses, report = fetcher.fetch_all(queries)
+
+        tract_controls = []
+        for unit in units:
+            keys = [(unit, category) for category in CONTROLS]
+            if all(key in responses for key in keys):
+                frames = [Marginals._response_frame(responses[key]) for key in keys]
+                try:
+                    tract_controls.append(Marginals._tract_controls(frames, unit[0]))
+                except CensusFetchException as e:
+                    report.failed[(unit, 'controls')] = str(e)
+        marginals = Marginals._join_mappings(mappings, tract_controls)
+        marginals.fetch_report = report
+        return marginals
+
+    @staticmethod
+    def from_census_data(puma_tract_mappings, census_key, state=None, pumas=None, cache=None):
         """Fetch marginal sums from the census API.
 
         Args:
-            puma_tract_mappings (dict): mappings of the form {
+            puma_tract_mappings (PumaTractMapping or iterable of dict):
+                mapping of PUMAs to tracts, or mappings of the form {
                 STATEFP -> state id,
                 COUNTYFP -> county id
                 PUMA5CE -> puma id
                 TRACTCE -> tract id
             }
-                of PUMAs to fetch data for
+                of PUMAs to fetch data for.  A PumaTractMapping looks up
+                the tracts of the pumas without scanning every mapping.
 
             census_key (unicode): census API key
 
@@ -107,19 +402,22 @@ class Marginals(object):
                 parameter is not passed in will fetch for all pumas in
                 puma_tract_mappings
 
+            cache (censuscache.CensusCache): if given, reuse and store
+                responses in this cache
+
         Returns:
             Marginals: marginals fetched from the census API
 
+        See `from_census_data_by_county` to fetch with far fewer requests.
+
         """
         data = []
         if not pumas or not state:
             raise ValueError('''Please supply a state fips code and a puma.
                     https://www.census.gov/geo/reference/ansi_statetables.html''')
 
-        for line in puma_tract_mappings:
-            if state is None or pumas is None\
-                    or line['STATEFP'] != state or line['PUMA5CE'] not in pumas:
-                continue
+        mappings = Marginals._select_mappings(puma_tract_mappings, state, pumas)
+        for line in mappings.to_dict('records'):
             state_key = line['STATEFP']
             tract_key = line['TRACTCE']
             puma_key = line['PUMA5CE']
@@ -132,7 +430,7 @@ class Marginals(object):
                     control_cat.values()) for key in sublist]
                 try:
                     full_controls = Marginals._fetch_from_census(
-                        census_key, key_list, tract_key, state_key, county_key
+                        census_key, key_list, tract_key, state_key, county_key, cache=cache
                     )
                 except CensusFetchException:
                     print('Skip puma {} tract {}'.format(puma_key, tract_key))
@@ -156,6 +454,119 @@ class Marginals(object):
                    'TRACTCE'] + list(CONTROL_NAMES)
         return Marginals(pandas.DataFrame(data, columns=columns))
 
+    @staticmethod
+    def _summary_file_column(variable):
+        """Summary file name of an API variable, e.g. B01001_E003 for
+        B01001_003E."""
+        table, cell = variable.split('_')
+        return '{}_E{}'.format(table, cell[:-1])
+
+    @staticmethod
+    def _read_summary_table(path, variables, geo_ids, sep, chunksize):
+        """Stream a summary file table, keeping only the given variables of
+        the given tracts.
+
+        Returns:
+            DataFrame: indexed by tract GEO_ID, with a column per variable
+        """
+        variable_by_column = {}
+        for variable in variables:
+            variable_by_column[variable] = variable
+            variable_by_column[Marginals._summary_file_column(variable)] = variable
+        reader = pandas.read_csv(
+            path, sep=sep, chunksize=chunksize, dtype={'GEO_ID': str},
+            usecols=lambda column: column == 'GEO_ID' or column in variable_by_column
+        )
+        chunks = []
+        for chunk in reader:
+            chunk_geo_ids = chunk['GEO_ID'].str.slice(len(SUMMARY_TRACT_GEO_ID_PREFIX))
+            keep = (chunk['GEO_ID'].str.startswith(SUMMARY_TRACT_GEO_ID_PREFIX) &
+                    chunk_geo_ids.isin(geo_ids))
+            chunk = chunk[keep].drop('GEO_ID', axis=1).rename(columns=variable_by_column)
+            chunk.index = chunk_geo_ids[keep].values
+            chunks.append(chunk)
+        if not chunks:
+            return pandas.DataFrame(columns=list(variables))
+        table = pandas.concat(chunks)
+        missing = [variable for variable in variables if variable not in table]
+        if missing:
+            raise ValueError('{} does not have the variables {}'.format(path, missing))
+        return table[list(variables)]
+
+    @staticmethod
+    def from_summary_files(table_files, puma_tract_mappings, state=None, pumas=None,
+                           sep='|', chunksize=SUMMARY_FILE_CHUNK_SIZE):
+        """Build marginals from local ACS summary file tables, with no
+        requests to the census API.
+
+        Each table is a file of the table-based summary files, published
+        from the 2021 ACS on, e.g. acsdt5y2021-b01001.dat: a delimited file
+        with a GEO_ID column, e.g. 1400000US06075023001 for a tract, and a
+        column per estimate, named either as in the summary files
+        (B01001_E003) or as in the API (B01001_003E).  The sequence files of
+        earlier years, keyed by LOGRECNO and joined to a geography file, are
+        not supported; fetch those years with `from_census_data` instead.
+
+        Files are streamed a chunk at a time, reading only the columns that
+        make up `CONTROLS`, and only rows of mapped tracts are kept.  Files
+        may be compressed, e.g. acsdt5y2021-b01001.dat.gz.
+
+        Args:
+            table_files (dict(unicode, unicode)): table id -> path of the
+                table file, for tables B11016 and B01001
+            puma_tract_mappings (PumaTractMapping or iterable of dict): see
+                `from_census_data`
+            state (unicode): state fips code, or None for every state
+            pumas (iterable of unicode): pumas to build marginals for, or
+                None for every puma of the state
+            sep (unicode): delimiter of the table files
+            chunksize (int): number of rows to read at a time
+
+        Returns:
+            Marginals: marginals of every mapped tract in the summary files,
+                with the same columns as `from_census_data`
+
+        """
+        if isinstance(puma_tract_mappings, PumaTractMapping):
+            mappings = puma_tract_mappings.select(state, pumas)
+        elif state is None:
+            mappings = pandas.DataFrame(list(puma_tract_mappings), columns=list(GEOGRAPHY_COLUMNS))
+        elif pumas is None:
+            mappings = pandas.DataFrame(
+                [line for line in puma_tract_mappings if line['STATEFP'] == state],
+                columns=list(GEOGRAPHY_COLUMNS))
+        else:
+            mappings = Marginals._select_mappings(puma_tract_mappings, state, pumas)
+        mapped_geo_ids = mappings['STATEFP'] + mappings['COUNTYFP'] + mappings['TRACTCE']
+
+        variables_by_table = {}
+        for control_cat in CONTROLS.values():
+            for variable in Marginals._control_fields(control_cat):
+                variables_by_table.setdefault(variable.split('_')[0], []).append(variable)
+        missing = sorted(set(variables_by_table) - set(table_files))
+        if missing:
+            raise ValueError('Please supply files of the tables {}'.format(missing))
+
+        unique_geo_ids = pandas.unique(mapped_geo_ids)
+        tables = [
+            Marginals._read_summary_table(
+                table_files[table], sorted(set(variables)), unique_geo_ids, sep, chunksize)
+            for table, variables in sorted(variables_by_table.items())
+        ]
+        estimates = pandas.concat(tables, axis=1, join='inner').fillna(0)
+
+        controls = pandas.DataFrame(index=estimates.index)
+        for control_cat in CONTROLS.values():
+            for sum_key, sum_cat in control_cat.items():
+                controls[sum_key] = estimates[list(sum_cat)].sum(axis=1).astype('int64')
+        controls = controls.astype(str)
+        controls.index.name = 'GEO_ID'
+
+        data = mappings.assign(GEO_ID=mapped_geo_ids.values).merge(
+            controls.reset_index(), on='GEO_ID', how='inner')
+        columns = list(GEOGRAPHY_COLUMNS) + list(CONTROL_NAMES)
+        return Marginals(data[columns].reset_index(drop=True))
+
     @staticmethod
     def from_csv(infile, state=None, puma=None):
         """Load marginals from file.
@@ -182,3 +593,32 @@ class Marginals(object):
 
         """
         self.data.to_csv(outfile)
+
+    @staticmethod
+    def from_dataset(path, filters=None, columns=None, format='parquet'):
+        """Load marginals from a dataset.
+
+        Args:
+            path (unicode): directory of the dataset
+            filters (dict(unicode, value or list)): read only matching rows,
+                e.g. {'COUNTYFP': '061'}.  Filters on the partition columns
+                skip the files of other partitions.
+            columns (list(unicode)): columns to read, all if None
+            format (unicode): 'parquet' or 'arrow'
+
+        Returns:
+            Marginals: marginals read from the dataset
+
+        """
+        return Marginals(datasets.read_dataset(path, columns, filters, DATASET_DTYPES, format))
+
+    def write_dataset(self, path, partition_by=('PUMA5CE',), format='parquet'):
+        """Write marginals to a dataset
+
+        Args:
+            path (unicode): directory to write to
+            partition_by (iterable(unicode)): columns to partition by
+            format (unicode): 'parquet' or 'arrow'
+
+        """
+        datasets.write_dataset(self.data, path, partition_by, DATASET_DTYPES, format)
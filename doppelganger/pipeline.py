@@ -0,0 +1,512 @@
+# Copyright 2017 Sidewalk Labs | https://www.apache.org/licenses/LICENSE-2.0
+
+"""Run the whole population synthesis as a pipeline of checkpointed stages.
+
+The stages of the example notebooks (cleaning, marginals, allocation,
+training and generation) form a DAG.  Each stage writes its artifacts to a
+directory named by a hash of everything it depends on: its parameters, the
+contents of its input files and the contents of the artifacts of the stages
+it depends on.  A stage whose directory is complete is skipped, so rerunning
+a pipeline only redoes what changed, and a crashed run resumes after the
+last completed stage.  Stages whose dependencies are complete run
+concurrently, e.g. allocation and the training of both models.
+
+From python:
+
+    pipeline = build_pipeline('output', 'config.json', 'households.csv',
+                              'persons.csv', marginals_csv='marginals.csv',
+                              puma='00106')
+    artifacts = pipeline.run(processes=3)
+    population = Population.from_csvs(
+        os.path.join(artifacts['population'], 'generated_people.csv'),
+        os.path.join(artifacts['population'], 'generated_households.csv'))
+
+or from the command line:
+
+    python -m doppelganger.pipeline output --config config.json \\
+        --households households.csv --persons persons.csv \\
+        --marginals marginals.csv --puma 00106 --processes 3
+"""
+
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+from builtins import str
+
+import argparse
+from collections import OrderedDict
+import hashlib
+import json
+import logging
+from multiprocessing import Pipe, Process
+import os
+import shutil
+import time
+
+import pandas
+
+from doppelganger.hashing import callable_name, file_digest
+
+# Changes whenever stages give different artifacts for the same inputs, so
+# that older artifacts are not reused
+PIPELINE_VERSION = 1
+
+MANIFEST_FILENAME = 'manifest.json'
+
+# Seconds between checks of running stages
+POLL_INTERVAL = 0.05
+
+
+def directory_digest(directory):
+    """sha256 of the names and contents of every file in a directory."""
+    digest = hashlib.sha256()
+    for root, directories, filenames in os.walk(directory):
+        directories.sort()
+        for filename in sorted(filenames):
+            path = os.path.join(root, filename)
+            if os.path.relpath(path, directory) == MANIFEST_FILENAME:
+                continue
+            digest.update(os.path.relpath(path, directory).encode('utf-8'))
+            digest.update(file_digest(path).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _describe(value):
+    """JSON-serializable description of a parameter, e.g. of a segmenter."""
+    if callable(value):
+        return callable_name(value)
+    return str(value)
+
+
+class Stage(object):
+
+    def __init__(self, name, function, depends_on=(), files=None, params=None, options=None):
+        """
+        Args:
+            name (unicode): unique name of the stage
+            function (function): called with (inputs, params, options,
+                output_directory) to write the stage's artifacts to
+                output_directory.  inputs maps the name of each dependency
+                to the directory of its artifacts, and the name of each
+                input file to its path.  Must be picklable, i.e. defined at
+                module level, to run in parallel.
+            depends_on (iterable(unicode)): names of the stages whose
+                artifacts this stage reads
+            files (dict(unicode, unicode)): name -> path of the input files,
+                whose contents are hashed
+            params (dict): parameters that change the artifacts, hashed.
+                Functions are identified by their name.
+            options (dict): parameters that do not change the artifacts, and
+                are not hashed, e.g. a census API key or a process count
+        """
+        self.name = name
+        self.function = function
+        self.depends_on = tuple(depends_on)
+        self.files = dict(files or {})
+        self.params = dict(params or {})
+        self.options = dict(options or {})
+
+    def key(self, dependency_digests):
+        """Hex digest of everything the stage's artifacts depend on.
+
+        Args:
+            dependency_digests (dict(unicode, unicode)): name -> digest of
+                the artifacts of each dependency
+        """
+        description = {
+            'version': PIPELINE_VERSION,
+            'stage': self.name,
+            'function': _describe(self.function),
+            'params': self.params,
+            'files': {name: file_digest(path) for name, path in self.files.items()},
+            'dependencies': {name: dependency_digests[name] for name in self.depends_on},
+        }
+        return hashlib.sha256(json.dumps(
+            description, sort_keys=True, default=_describe).encode('utf-8')).hexdigest()
+
+
+def _run_stage(stage, inputs, directory):
+    """Run a stage into a temporary directory and move it into place, so that
+    a crash never leaves a directory that looks complete."""
+    parent, name = os.path.split(directory)
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    # Remove what failed or killed runs of this stage left behind.  Only one
+    # run may use a pipeline's directory at a time.
+    for entry in os.listdir(parent):
+        if entry.startswith(name + '.tmp-'):
+            shutil.rmtree(os.path.join(parent, entry), ignore_errors=True)
+    temporary = '{}.tmp-{}'.format(directory, os.getpid())
+    os.makedirs(temporary)
+    try:
+        stage.function(inputs, stage.params, stage.options, temporary)
+        digest = directory_digest(temporary)
+        with open(os.path.join(temporary, MANIFEST_FILENAME), 'w') as outfile:
+            json.dump({'stage': stage.name, 'digest': digest}, outfile)
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+        os.rename(temporary, directory)
+    except BaseException:
+        shutil.rmtree(temporary, ignore_errors=True)
+        raise
+    return digest
+
+
+def _stage_process(stage, inputs, directory, connection):
+    """Run a stage in a child process, and send the parent (True, digest) or
+    (False, exception)."""
+    try:
+        digest = _run_stage(stage, inputs, directory)
+    except BaseException as e:
+        logging.exception('Stage {} failed'.format(stage.name))
+        try:
+            connection.send((False, e))
+        except Exception:
+            # The exception cannot be pickled
+            connection.send((False, RuntimeError('Stage {} failed: {!r}'.format(stage.name, e))))
+    else:
+        connection.send((True, digest))
+    finally:
+        connection.close()
+
+
+class Pipeline(object):
+    """A DAG of stages whose artifacts are kept under one directory."""
+
+    def __init__(self, directory, stages):
+        """
+        Args:
+            directory (unicode): directory to keep artifacts in, with a
+                subdirectory per stage and per key
+            stages (iterable(Stage)): stages, in any order
+        """
+        self.directory = directory
+        self.stages = OrderedDict((stage.name, stage) for stage in stages)
+        for stage in self.stages.values():
+            for dependency in stage.depends_on:
+                if dependency not in self.stages:
+                    raise ValueError('Stage {} depends on unknown stage {}'.format(
+                        stage.name, dependency))
+        # Stage name -> 'ran' or 'skipped', of the last run
+        self.last_run = OrderedDict()
+
+    def _required(self, targets):
+        """Names of the targets and everything they depend on."""
+        required = set()
+        pending = list(targets)
+        while pending:
+            name = pending.pop()
+            if name not in self.stages:
+                raise ValueError('Unknown stage {}'.format(name))
+            if name not in required:
+                required.add(name)
+                pending.extend(self.stages[name].depends_on)
+        return required
+
+    def _stage_directory(self, name, key):
+        return os.path.join(self.directory, name, key)
+
+    @staticmethod
+    def _completed_digest(directory):
+        """Artifact digest of a completed stage directory, or None."""
+        try:
+            with open(os.path.join(directory, MANIFEST_FILENAME)) as infile:
+                return json.load(infile)['digest']
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+
+    def run(self, targets=None, processes=1, force=()):
+        """Run the stages whose artifacts are missing or out of date.
+
+        Args:
+            targets (iterable(unicode)): stages to bring up to date, with
+                their dependencies.  All stages if None.
+            processes (int): number of stages to run at once, each in a
+                process of its own.  With 1, stages run one at a time in this
+                process.
+            force (iterable(unicode)): stages to run even if up to date
+
+        Returns:
+            OrderedDict: stage name -> directory of its artifacts, in the
+                order stages completed
+        """
+        required = self._required(targets if targets is not None else self.stages)
+        force = set(force)
+        self.last_run = OrderedDict()
+        digests, artifacts = {}, OrderedDict()
+        # Stage name -> (process, connection, directory) of stages running in
+        # child processes.  Children are not daemonic, so that stages can
+        # start processes of their own, e.g. to generate in parallel.
+        running = OrderedDict()
+        try:
+            while len(artifacts) < len(required):
+                ready = [
+                    name for name in self.stages
+                    if name in required and name not in artifacts and name not in running and
+                    all(dependency in digests for dependency in self.stages[name].depends_on)
+                ]
+                for name in ready:
+                    if processes > 1 and len(running) >= processes:
+                        break
+                    stage = self.stages[name]
+                    directory = self._stage_directory(name, stage.key(digests))
+                    digest = self._completed_digest(directory)
+                    if digest is not None and name not in force:
+                        logging.info('Skip stage {}, it is up to date'.format(name))
+                        digests[name], artifacts[name] = digest, directory
+                        self.last_run[name] = 'skipped'
+                        continue
+                    inputs = dict(stage.files)
+                    inputs.update((dependency, artifacts[dependency])
+                                  for dependency in stage.depends_on)
+                    logging.info('Run stage {}'.format(name))
+                    if processes > 1:
+                        receiver, sender = Pipe(duplex=False)
+                        process = Process(target=_stage_process,
+                                          args=(stage, inputs, directory, sender))
+                        process.start()
+                        sender.close()
+                        running[name] = (process, receiver, directory)
+                    else:
+                        digests[name] = _run_stage(stage, inputs, directory)
+                        artifacts[name] = directory
+                        self.last_run[name] = 'ran'
+                if not ready and not running:
+                    raise ValueError('Stages {} depend on each other in a cycle'.format(
+                        sorted(required.difference(artifacts))))
+                if not running:
+                    continue
+                time.sleep(POLL_INTERVAL)
+                for name, (process, receiver, directory) in list(running.items()):
+                    if receiver.poll():
+                        succeeded, result = receiver.recv()
+                    elif not process.is_alive() and not receiver.poll():
+                        succeeded, result = False, RuntimeError(
+                            'Stage {} exited with code {}'.format(name, process.exitcode))
+                    else:
+                        continue
+                    del running[name]
+                    receiver.close()
+                    process.join()
+                    if not succeeded:
+                        raise result
+                    digests[name] = result
+                    artifacts[name] = directory
+                    self.last_run[name] = 'ran'
+        finally:
+            for process, receiver, _ in running.values():
+                process.terminate()
+                process.join()
+                receiver.close()
+        return artifacts
+
+
+# Stages of population synthesis.  Each reads its inputs with the library's
+# own readers and writes its artifacts with the library's own writers.
+
+CLEANED_FILENAME = 'cleaned.pkl'
+MARGINALS_FILENAME = 'marginals.csv'
+ALLOCATED_HOUSEHOLDS_FILENAME = 'allocated_households.pkl'
+ALLOCATED_PERSONS_FILENAME = 'allocated_persons.pkl'
+MODEL_FILENAME = 'model.json'
+GENERATED_PEOPLE_FILENAME = 'generated_people.csv'
+GENERATED_HOUSEHOLDS_FILENAME = 'generated_households.csv'
+
+
+def clean_stage(inputs, params, options, output_directory):
+    """Clean a PUMS csv of households or persons."""
+    from doppelganger.datasource import PumsData
+    from doppelganger.preprocessing import Preprocessor
+
+    preprocessor = Preprocessor.from_config(params['preprocessing'])
+    cleaned = PumsData.from_csv(inputs['pums']).clean(
+        params['fields'], preprocessor, puma=params['puma'])
+    cleaned.data.to_pickle(os.path.join(output_directory, CLEANED_FILENAME))
+
+
+def marginals_stage(inputs, params, options, output_directory):
+    """Copy marginals from a csv, or fetch them from the census API."""
+    from doppelganger.marginals import Marginals
+    from doppelganger.pumatracts import PumaTractMapping
+
+    if 'marginals' in inputs:
+        marginals = Marginals.from_csv(inputs['marginals'])
+    else:
+        marginals = Marginals.from_census_data_by_county(
+            PumaTractMapping.from_file(inputs['puma_tract_mapping']), options['census_key'],
+            params['state'], [params['puma']])
+    marginals.write(os.path.join(output_directory, MARGINALS_FILENAME))
+
+
+def _cleaned_data(directory):
+    from doppelganger.datasource import CleanedData
+
+    return CleanedData(pandas.read_pickle(os.path.join(directory, CLEANED_FILENAME)))
+
+
+def allocation_stage(inputs, params, options, output_directory):
+    """Allocate households to tracts."""
+    from doppelganger.allocation import HouseholdAllocator
+    from doppelganger.marginals import Marginals
+
+    allocator = HouseholdAllocator.from_cleaned_data(
+        Marginals.from_csv(os.path.join(inputs['marginals'], MARGINALS_FILENAME)),
+        _cleaned_data(inputs['households']), _cleaned_data(inputs['persons']),
+        scale=params['scale'])
+    allocator.allocated_households.to_pickle(
+        os.path.join(output_directory, ALLOCATED_HOUSEHOLDS_FILENAME))
+    allocator.allocated_persons.to_pickle(
+        os.path.join(output_directory, ALLOCATED_PERSONS_FILENAME))
+
+
+def training_stage(inputs, params, options, output_directory):
+    """Train the person or household model on the cleaned data of the
+    stage named by params['data']."""
+    from doppelganger.bayesnets import BayesianNetworkModel, SegmentedData
+
+    training_data = SegmentedData.from_data(
+        _cleaned_data(inputs[params['data']]), list(params['fields']), params['weight_field'],
+        params['segmenter'])
+    model = BayesianNetworkModel.train(training_data, params['structure'], params['fields'])
+    model.write(os.path.join(output_directory, MODEL_FILENAME))
+
+
+def generation_stage(inputs, params, options, output_directory):
+    """Generate the population."""
+    from doppelganger.allocation import HouseholdAllocator
+    from doppelganger.bayesnets import BayesianNetworkModel
+    from doppelganger.populationgen import Population
+
+    allocator = HouseholdAllocator(
+        pandas.read_pickle(os.path.join(inputs['allocation'], ALLOCATED_HOUSEHOLDS_FILENAME)),
+        pandas.read_pickle(os.path.join(inputs['allocation'], ALLOCATED_PERSONS_FILENAME)))
+    person_model = BayesianNetworkModel.from_file(
+        os.path.join(inputs['person_model'], MODEL_FILENAME), params['person_segmenter'])
+    household_model = BayesianNetworkModel.from_file(
+        os.path.join(inputs['household_model'], MODEL_FILENAME), params['household_segmenter'])
+    population = Population.generate(
+        allocator, person_model, household_model, seed=params['seed'],
+        processes=options.get('processes'))
+    population.write(os.path.join(output_directory, GENERATED_PEOPLE_FILENAME),
+                     os.path.join(output_directory, GENERATED_HOUSEHOLDS_FILENAME))
+
+
+def build_pipeline(directory, config_file, households_csv, persons_csv, marginals_csv=None,
+                   puma=None, state=None, puma_tract_mapping=None, census_key=None,
+                   seed=0, scale=1.0, person_segmenter=None, household_segmenter=None,
+                   generation_processes=None):
+    """The pipeline of the full example notebook.
+
+    Stages: households and persons (cleaning), marginals, allocation,
+    person_model and household_model (training) and population (generation).
+
+    Args:
+        directory (unicode): directory to keep artifacts in
+        config_file (unicode): configuration, see `Configuration.from_file`
+        households_csv (unicode): PUMS households csv
+        persons_csv (unicode): PUMS persons csv
+        marginals_csv (unicode): marginals csv.  If None, marginals are
+            fetched from the census API for `state` and `puma`, with
+            `puma_tract_mapping` and `census_key`.
+        puma (unicode): puma to synthesize
+        state (unicode): state fips code of the puma, to fetch marginals
+        puma_tract_mapping (unicode): mapping file, see `PumaTractMapping`
+        census_key (unicode): census API key, which is not hashed
+        seed (int): seed of generation, see `Population.generate`
+        scale (float): fraction of the population to allocate
+        person_segmenter (function): segmenter of the person model, which
+            must be defined at module level to run stages in parallel
+        household_segmenter (function): segmenter of the household model
+        generation_processes (int): processes to generate with
+
+    Returns:
+        Pipeline: the pipeline, to `run`
+    """
+    from doppelganger import inputs
+    from doppelganger.config import Configuration
+
+    configuration = Configuration.from_file(config_file)
+    if marginals_csv is not None:
+        marginals_files, marginals_options = {'marginals': marginals_csv}, {}
+    elif None in (state, puma, puma_tract_mapping, census_key):
+        raise ValueError('Please supply a marginals csv, or a state, puma, '
+                         'puma_tract_mapping and census_key to fetch marginals with.')
+    else:
+        marginals_files = {'puma_tract_mapping': puma_tract_mapping}
+        marginals_options = {'census_key': census_key}
+
+    stages = [
+        Stage('households', clean_stage, files={'pums': households_csv}, params={
+            'fields': sorted(configuration.get_all_household_fields()),
+            'preprocessing': configuration.preprocessing_config,
+            'puma': puma,
+        }),
+        Stage('persons', clean_stage, files={'pums': persons_csv}, params={
+            'fields': sorted(configuration.get_all_person_fields()),
+            'preprocessing': configuration.preprocessing_config,
+            'puma': puma,
+        }),
+        Stage('marginals', marginals_stage, files=marginals_files,
+              params={'state': state, 'puma': puma}, options=marginals_options),
+        Stage('allocation', allocation_stage, depends_on=['households', 'persons', 'marginals'],
+              params={'scale': scale}),
+        Stage('person_model', training_stage, depends_on=['persons'], params={
+            'fields': configuration.person_fields,
+            'structure': configuration.person_structure,
+            'weight_field': inputs.PERSON_WEIGHT.name,
+            'segmenter': person_segmenter,
+            'data': 'persons',
+        }),
+        Stage('household_model', training_stage, depends_on=['households'], params={
+            'fields': configuration.household_fields,
+            'structure': configuration.household_structure,
+            'weight_field': inputs.HOUSEHOLD_WEIGHT.name,
+            'segmenter': household_segmenter,
+            'data': 'households',
+        }),
+        Stage('population', generation_stage,
+              depends_on=['allocation', 'person_model', 'household_model'], params={
+                  'seed': seed,
+                  'person_segmenter': person_segmenter,
+                  'household_segmenter': household_segmenter,
+              }, options={'processes': generation_processes}),
+    ]
+    return Pipeline(directory, stages)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Synthesize a population, skipping the stages that are up to date.')
+    parser.add_argument('directory', help='directory to keep artifacts in')
+    parser.add_argument('--config', required=True, help='configuration json file')
+    parser.add_argument('--households', required=True, help='PUMS households csv')
+    parser.add_argument('--persons', required=True, help='PUMS persons csv')
+    parser.add_argument('--marginals', help='marginals csv, fetched from the census if missing')
+    parser.add_argument('--puma', help='puma to synthesize')
+    parser.add_argument('--state', help='state fips code, to fetch marginals')
+    parser.add_argument('--puma-tract-mapping', help='PUMA to tract mapping, to fetch marginals')
+    parser.add_argument('--census-key', default=os.environ.get('CENSUS_KEY'),
+                        help='census API key, to fetch marginals (default: $CENSUS_KEY)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of generation')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='fraction of the population to allocate')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='number of stages to run at once')
+    parser.add_argument('--target', action='append', help='stage to bring up to date')
+    parser.add_argument('--force', action='append', default=[],
+                        help='stage to run even if up to date')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    pipeline = build_pipeline(
+        args.directory, args.config, args.households, args.persons,
+        marginals_csv=args.marginals, puma=args.puma, state=args.state,
+        puma_tract_mapping=args.puma_tract_mapping, census_key=args.census_key,
+        seed=args.seed, scale=args.scale)
+    artifacts = pipeline.run(args.target, processes=args.processes, force=args.force)
+    for name, directory in artifacts.items():
+        print('{:16} {:8} {}'.format(name, pipeline.last_run[name], directory))
+
+
+if __name__ == '__main__':
+    main()
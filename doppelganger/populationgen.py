@@ -3,10 +3,37 @@
 from __future__ import (
     absolute_import, division, print_function, unicode_literals
 )
+from builtins import str
 
+from collections import OrderedDict
+from multiprocessing import Pool
+
+import numpy as np
 import pandas
 
-from doppelganger import inputs
+from doppelganger import bayesnets, datasets, inputs, seeding, sinks
+from doppelganger.allocation import HouseholdAllocator
+
+# Number of rows per chunk when generating in chunks
+DEFAULT_CHUNK_SIZE = 100000
+
+# Number of tracts kept by a LazyPopulation
+DEFAULT_TRACT_CACHE_SIZE = 64
+
+# Explicit types of population columns in datasets
+DATASET_DTYPES = {
+    inputs.TRACT.name: str,
+    inputs.SERIAL_NUMBER.name: str,
+}
+
+# Fields of the allocation that persons and households are generated from
+_PERSON_EVIDENCE = (inputs.AGE.name, inputs.SEX.name)
+_HOUSEHOLD_EVIDENCE = (inputs.NUM_PEOPLE.name,)
+
+# Internal columns of generation plans
+_SEGMENT = '_segment'
+_PERSON_POSITION = '_person_position'
+_HOUSEHOLD_POSITION = '_household_position'
 
 
 class Population(object):
@@ -27,86 +54,744 @@ class Population(object):
         generated_households = pandas.read_csv(households_infile)
         return Population(generated_people, generated_households)
 
+    @staticmethod
+    def from_dataset(persons_path, households_path, tracts=None, person_columns=None,
+                     household_columns=None, format='parquet'):
+        """Load generated population from datasets partitioned by tract.
+
+        Args:
+            persons_path (unicode): directory of the persons dataset
+            households_path (unicode): directory of the households dataset
+            tracts (list(unicode)): read only these tracts, all if None
+            person_columns (list(unicode)): person columns to read, all if None
+            household_columns (list(unicode)): household columns to read, all
+                if None
+            format (unicode): 'parquet' or 'arrow'
+
+        Returns:
+            Population: generated population
+
+        """
+        filters = {inputs.TRACT.name: tracts} if tracts is not None else None
+        generated_people, generated_households = (
+            datasets.read_dataset(path, columns, filters, DATASET_DTYPES, format)
+            for path, columns in ((persons_path, person_columns),
+                                  (households_path, household_columns))
+        )
+        return Population(generated_people, generated_households)
+
     def __init__(self, generated_people, generated_households):
         self.generated_people = generated_people
         self.generated_households = generated_households
 
     @staticmethod
-    def _extract_person_evidence(allocated_rows, fields, segmenter, household_allocator):
-        """Creates a (python) generator for bayesian network evidence for persons that yields
-         (serial number, evidence, segment, tract, count)
+    def _plan_persons(household_allocator, fields, segmenter):
+        """Join allocated persons to the counts of their households.
+
+        Returns: DataFrame with a row for each (person, tract) pair with a
+            nonzero count, with the serial number, evidence fields, segment,
+            tract and count, in order of person and then tract
         """
-        for _, row in allocated_rows.iterrows():
-            serialno = row[inputs.SERIAL_NUMBER.name]
-            evidence = tuple((field, row[field]) for field in fields)
-            segment = segmenter(row)
-            # Draw repeat information for persons from from the allocator
-            count_info = household_allocator.get_counts(serialno)
-            for tract, count in count_info:
-                yield serialno, evidence, segment, tract, count
+        persons = household_allocator.allocated_persons
+        plan = persons[[inputs.SERIAL_NUMBER.name] + list(fields)].assign(**{
+            _SEGMENT: bayesnets.segment_data(segmenter, persons),
+            _PERSON_POSITION: np.arange(len(persons)),
+        })
+        households = household_allocator.allocated_households
+        counts = households[[inputs.SERIAL_NUMBER.name, inputs.TRACT.name, inputs.COUNT.name]]
+        counts = counts.assign(**{_HOUSEHOLD_POSITION: np.arange(len(households))})
+        counts = counts[counts[inputs.COUNT.name] > 0]
+        plan = pandas.merge(plan, counts, on=inputs.SERIAL_NUMBER.name)
+        return plan.sort_values([_PERSON_POSITION, _HOUSEHOLD_POSITION], kind='mergesort')
 
     @staticmethod
-    def _extract_household_evidence(allocated_rows, fields, segmenter, _):
-        """Creates a (python) generator for bayesian network evidence for households that yields
-         (serial number, evidence, segment, tract, count)
+    def _plan_households(household_allocator, fields, segmenter):
+        """Allocated households with a nonzero count.
+
+        Returns: DataFrame with a row for each household and tract, with the
+            serial number, evidence fields, segment, tract and count
         """
-        for _, row in allocated_rows.iterrows():
-            serialno = row[inputs.SERIAL_NUMBER.name]
-            evidence = tuple((field, row[field]) for field in fields)
-            segment = segmenter(row)
-            # Households store their repeat information directly
-            yield serialno, evidence, segment, row[inputs.TRACT.name], row['count']
+        households = household_allocator.allocated_households
+        plan = households[
+            [inputs.SERIAL_NUMBER.name] + list(fields) + [inputs.TRACT.name, inputs.COUNT.name]
+        ].assign(**{_SEGMENT: bayesnets.segment_data(segmenter, households)})
+        return plan[plan[inputs.COUNT.name] > 0]
 
     @staticmethod
-    def _generate_from_model(household_allocator, data, model, fields, evidence_fn):
+    def _generate_from_model(plan, model, fields, seed=None, stream_name=None,
+                             id_encoder=None):
         """Generate the given fields of the given data generated by the
         given model
+
+        With a seed, each (tract, segment, evidence) key samples from its own
+        random stream, named by stream_name and the key.  With an id_encoder,
+        the output uses the compact schema.
+        """
+        chunks = Population._generate_chunks_from_model(
+            plan, model, fields, seed, stream_name, id_encoder=id_encoder)
+        return pandas.concat(list(chunks))
+
+    @staticmethod
+    def _generate_chunks_from_model(plan, model, fields, seed=None, stream_name=None,
+                                    chunk_size=None, id_encoder=None):
+        """Like _generate_from_model, but yields DataFrames of at most chunk_size rows.
+
+        The chunks' indexes continue from one chunk to the next.  At least one
+        chunk is yielded, even if nothing is generated.
+        """
+        ends = np.cumsum(plan[inputs.COUNT.name].values.astype(np.int64))
+        key_to_rng = {}
+        pending = Population._generate_plan_rows(
+            plan.iloc[0:0], model, fields, seed, stream_name, key_to_rng, id_encoder)
+        start = 0
+        offset = 0
+        while start < len(plan):
+            # Take plan rows until they fill the rest of the chunk, or all of them
+            if chunk_size is None:
+                end = len(plan)
+            else:
+                generated_before = ends[start - 1] if start > 0 else 0
+                target = generated_before + chunk_size - len(pending)
+                end = min(np.searchsorted(ends, target, side='left') + 1, len(plan))
+            generated = Population._generate_plan_rows(
+                plan.iloc[start:end], model, fields, seed, stream_name, key_to_rng, id_encoder)
+            pending = pandas.concat([pending, generated]) if len(pending) else generated
+            start = end
+            while chunk_size is not None and len(pending) >= chunk_size:
+                yield Population._reindexed(pending.iloc[:chunk_size], offset)
+                offset += chunk_size
+                pending = pending.iloc[chunk_size:]
+        if len(pending) or offset == 0:
+            yield Population._reindexed(pending, offset)
+
+    @staticmethod
+    def _reindexed(chunk, offset):
+        chunk = chunk.copy()
+        chunk.index = pandas.RangeIndex(offset, offset + len(chunk))
+        return chunk
+
+    @staticmethod
+    def _generate_plan_rows(plan, model, fields, seed, stream_name, key_to_rng, id_encoder):
+        """Generate the given rows of a plan, sampling once for each distinct key."""
+        compact = id_encoder is not None
+        values = Population._sample_plan(
+            plan, model, fields, seed, stream_name, key_to_rng, compact)
+        counts = plan[inputs.COUNT.name].values.astype(np.int64)
+        repeat_ids = np.arange(len(values)) - np.repeat(np.cumsum(counts) - counts, counts)
+        if not compact:
+            tracts = np.repeat(plan[inputs.TRACT.name].values, counts)
+            serialnos = np.repeat(plan[inputs.SERIAL_NUMBER.name].values, counts)
+            columns = [
+                (inputs.HOUSEHOLD_ID.name, Population._string_household_ids(
+                    tracts, serialnos, repeat_ids)),
+                (inputs.TRACT.name, tracts),
+                (inputs.SERIAL_NUMBER.name, serialnos),
+                (inputs.REPEAT_INDEX.name, repeat_ids),
+            ] + [(field, values[:, i]) for i, field in enumerate(model.fields)]
+            return pandas.DataFrame(OrderedDict(columns))
+        tract_indexes = np.repeat(
+            id_encoder.tract_indexes(plan[inputs.TRACT.name].values), counts)
+        household_indexes = np.repeat(
+            id_encoder.household_indexes(plan[inputs.SERIAL_NUMBER.name].values), counts)
+        return Population._compact_frame(
+            id_encoder, tract_indexes, household_indexes, repeat_ids, model, values)
+
+    @staticmethod
+    def _sample_plan(plan, model, fields, seed, stream_name, key_to_rng, compact):
+        """Sample the rows of a plan, once for each distinct key.
+
+        Rows are grouped by (tract, segment, evidence), each group's samples
+        are drawn with a single call to the model and then scattered back to
+        the rows in order.
+
+        Returns: array with a row for each of the plan's count samples, of
+            values, or with compact, of codes in the model's vocabulary
+        """
+        counts = plan[inputs.COUNT.name].values.astype(np.int64)
+        offsets = np.cumsum(counts) - counts
+        if not compact:
+            values = np.empty((counts.sum(), len(model.fields)), dtype=object)
+        else:
+            values = np.zeros((counts.sum(), len(model.fields)), dtype=np.int64)
+        key_columns = [plan[inputs.TRACT.name].values, plan[_SEGMENT].values] + [
+            plan[field].values for field in fields]
+        for first_row, rows in bayesnets.iterate_groups(key_columns):
+            key = tuple(column[first_row] for column in key_columns)
+            segment, evidence = key[1], tuple(zip(fields, key[2:]))
+            count = counts[rows].sum()
+            kwargs = {}
+            if seed is not None:
+                if key not in key_to_rng:
+                    key_to_rng[key] = seeding.work_unit_rng(seed, stream_name, *key)
+                kwargs['random_state'] = key_to_rng[key]
+            targets = bayesnets.expand_ranges(offsets[rows], counts[rows])
+            if not compact:
+                generated_rows = model.generate(segment, evidence, count=count, **kwargs)
+                values[targets] = np.array(generated_rows, dtype=object).reshape(
+                    len(targets), len(model.fields))
+            else:
+                values[targets], _ = model.generate_batch(
+                    [segment], [key[2:]], [count], evidence_fields=fields, **kwargs)
+        return values
+
+    @staticmethod
+    def _compact_frame(id_encoder, tract_indexes, household_indexes, repeat_ids, model, codes):
+        """DataFrame in the compact schema from indexes and sampled codes"""
+        vocabulary = model.vocabulary()
+        columns = [
+            (inputs.HOUSEHOLD_ID.name, id_encoder.encode(
+                tract_indexes, household_indexes, repeat_ids)),
+            (inputs.TRACT.name, pandas.Categorical.from_codes(
+                tract_indexes, id_encoder.tracts)),
+            (inputs.SERIAL_NUMBER.name, pandas.Categorical.from_codes(
+                household_indexes, id_encoder.serial_numbers)),
+            (inputs.REPEAT_INDEX.name, np.asarray(repeat_ids).astype(np.int32)),
+        ] + [
+            (field, pandas.Categorical.from_codes(codes[:, i], vocabulary[i]))
+            for i, field in enumerate(model.fields)
+        ]
+        return pandas.DataFrame(OrderedDict(columns))
+
+    @staticmethod
+    def _string_household_ids(tracts, serialnos, repeat_ids):
+        """Household ids of the form 'tract-serialno-repeat'"""
+        return (
+            pandas.Series(tracts, dtype=object).astype(str) + '-' +
+            pandas.Series(serialnos, dtype=object).astype(str) + '-' +
+            pandas.Series(repeat_ids).astype(str)
+        ).values
+
+    def with_string_household_ids(self):
+        """Render a compact population in the default schema.
+
+        Returns: Population with household ids of the form
+            'tract-serialno-repeat' and plain object columns in place of
+            categoricals
         """
-        results = []
-        for serialno, evidence, segment, tract, count in evidence_fn(
-                data,
-                fields,
-                model.segmenter,
-                household_allocator
-        ):
-            generated_rows = model.generate(segment, evidence, count=count)
-            for repeat_id, row in enumerate(generated_rows):
-                household_id = '{}-{}-{}'.format(tract, serialno, repeat_id)
-                results.append((household_id, tract, serialno, repeat_id) + row)
-
-        column_names = [inputs.HOUSEHOLD_ID.name, inputs.TRACT.name, inputs.SERIAL_NUMBER.name,
-                        inputs.REPEAT_INDEX.name] + list(model.fields)
-        results_dataframe = pandas.DataFrame(results, columns=column_names)
-        return results_dataframe
-
-    @staticmethod
-    def generate(household_allocator, person_model, household_model):
+        def render(frame):
+            frame = frame.copy()
+            for column in frame:
+                if hasattr(frame[column], 'cat'):
+                    frame[column] = frame[column].astype(object)
+            frame[inputs.HOUSEHOLD_ID.name] = Population._string_household_ids(
+                frame[inputs.TRACT.name].values,
+                frame[inputs.SERIAL_NUMBER.name].values,
+                frame[inputs.REPEAT_INDEX.name].values
+            )
+            return frame
+        return Population(render(self.generated_people), render(self.generated_households))
+
+    @staticmethod
+    def _generation_passes(household_allocator, person_model, household_model):
+        """The (name, plan, model, evidence fields) of each generation pass"""
+        person_fields = list(_PERSON_EVIDENCE)
+        household_fields = list(_HOUSEHOLD_EVIDENCE)
+        return (
+            ('persons', Population._plan_persons(
+                household_allocator, person_fields, person_model.segmenter),
+             person_model, person_fields),
+            ('households', Population._plan_households(
+                household_allocator, household_fields, household_model.segmenter),
+             household_model, household_fields),
+        )
+
+    @staticmethod
+    def generate(household_allocator, person_model, household_model, seed=None, processes=None,
+                 compact=False, joint=False):
         """Create all the persons and households for this population
 
         Args:
             household_allocator (HouseholdAllocator): allocated households
             person_model (BayesianNetworkNodel): optional generative model
             household_model (BayesianNetworkNodel): optional generative model
+            seed (int): seed for reproducible generation.  Every (tract,
+                segment) pair draws from its own stream derived from the seed,
+                so the output does not depend on how the work is split up.
+            processes (int): if given, generate each tract in a pool of this
+                many worker processes, see `generate_by_tract`.  Rows are then
+                grouped by tract.
+            compact (bool): use the compact schema, with int64 household ids
+                from `HouseholdIdEncoder` and categorical columns.  See
+                `with_string_household_ids` for the default rendering.
+            joint (bool): generate households and their persons together in a
+                single pass over the allocation, see `_generate_joint`.  The
+                output always uses the compact schema, and persons are grouped
+                by household.
 
         Returns: Population from the given model
         """
+        if processes is not None:
+            return Population.concat(population for _, population in Population.generate_by_tract(
+                household_allocator, person_model, household_model, seed, processes,
+                compact=compact, joint=joint))
+        id_encoder = (HouseholdIdEncoder.from_allocator(household_allocator)
+                      if compact or joint else None)
+        return Population._generate(
+            household_allocator, person_model, household_model, seed, id_encoder, joint)
 
-        persons = Population._generate_from_model(
-            household_allocator, household_allocator.allocated_persons,
-            person_model, [inputs.AGE.name, inputs.SEX.name], Population._extract_person_evidence
-        )
-        households = Population._generate_from_model(
-            household_allocator, household_allocator.allocated_households,
-            household_model, [inputs.NUM_PEOPLE.name], Population._extract_household_evidence
+    @staticmethod
+    def _generate(household_allocator, person_model, household_model, seed, id_encoder,
+                  joint=False):
+        if joint:
+            return Population._generate_joint(
+                household_allocator, person_model, household_model, seed, id_encoder)
+        persons, households = (
+            Population._generate_from_model(plan, model, fields, seed, name, id_encoder)
+            for name, plan, model, fields in Population._generation_passes(
+                household_allocator, person_model, household_model)
         )
         return Population(persons, households)
 
+    @staticmethod
+    def _generate_joint(household_allocator, person_model, household_model, seed, id_encoder):
+        """Generate each allocated household and its persons in one pass.
+
+        Each (tract, household, repeat) is expanded once, and its persons are
+        found by position in the allocated persons sorted by serial number,
+        rather than by joining persons to households.  Both tables take their
+        keys from the same expanded households, so every person links to a
+        generated household.  Samples are still drawn once per (tract,
+        segment, evidence) key, from the same streams as `generate`.
+        """
+        households_plan = Population._plan_households(
+            household_allocator, _HOUSEHOLD_EVIDENCE, household_model.segmenter)
+        counts = households_plan[inputs.COUNT.name].values.astype(np.int64)
+        plan_tracts = id_encoder.tract_indexes(households_plan[inputs.TRACT.name].values)
+        plan_households = id_encoder.household_indexes(
+            households_plan[inputs.SERIAL_NUMBER.name].values)
+
+        # Members of each plan row, as positions in the allocated persons
+        persons = household_allocator.allocated_persons
+        person_households = id_encoder.serial_numbers.get_indexer(
+            persons[inputs.SERIAL_NUMBER.name].values)
+        order = np.argsort(person_households, kind='mergesort')
+        sorted_households = person_households[order]
+        starts = np.searchsorted(sorted_households, plan_households, side='left')
+        sizes = np.searchsorted(sorted_households, plan_households, side='right') - starts
+        members = order[bayesnets.expand_ranges(starts, sizes)]
+        member_plan_rows = np.repeat(np.arange(len(households_plan)), sizes)
+
+        # Sample persons for each (plan row, member), count times each
+        persons_plan = pandas.DataFrame(OrderedDict(
+            [(inputs.TRACT.name, households_plan[inputs.TRACT.name].values[member_plan_rows]),
+             (_SEGMENT, bayesnets.segment_data(person_model.segmenter, persons)[members]),
+             (inputs.COUNT.name, counts[member_plan_rows])] +
+            [(field, persons[field].values[members]) for field in _PERSON_EVIDENCE]
+        ))
+        person_codes = Population._sample_plan(
+            persons_plan, person_model, list(_PERSON_EVIDENCE), seed, 'persons', {}, True)
+        household_codes = Population._sample_plan(
+            households_plan, household_model, list(_HOUSEHOLD_EVIDENCE), seed, 'households',
+            {}, True)
+
+        # Expand each (tract, household, repeat) once
+        household_rows = np.repeat(np.arange(len(households_plan)), counts)
+        repeat_ids = np.arange(len(household_rows)) - np.repeat(np.cumsum(counts) - counts, counts)
+        households = Population._compact_frame(
+            id_encoder, plan_tracts[household_rows], plan_households[household_rows],
+            repeat_ids, household_model, household_codes)
+
+        # Persons of each expanded household, in member order.  Their samples
+        # are ordered by (plan row, member, repeat).
+        household_sizes = sizes[household_rows]
+        person_households = np.repeat(np.arange(len(household_rows)), household_sizes)
+        member_ids = np.arange(len(person_households)) - np.repeat(
+            np.cumsum(household_sizes) - household_sizes, household_sizes)
+        person_plan_rows = household_rows[person_households]
+        sample_offsets = np.cumsum(sizes * counts) - sizes * counts
+        samples = (sample_offsets[person_plan_rows] + member_ids * counts[person_plan_rows] +
+                   repeat_ids[person_households])
+        persons = Population._compact_frame(
+            id_encoder, plan_tracts[person_plan_rows], plan_households[person_plan_rows],
+            repeat_ids[person_households], person_model, person_codes[samples])
+        return Population(persons, households)
+
+    @staticmethod
+    def generate_chunks(household_allocator, person_model, household_model, seed=None,
+                        chunk_size=DEFAULT_CHUNK_SIZE, compact=False):
+        """Generate the population in chunks of bounded size.
+
+        All persons are generated first, then all households.  The chunks
+        together hold the same rows as `generate` would return, so memory use
+        depends on the chunk size rather than on the size of the population.
+
+        Args:
+            household_allocator (HouseholdAllocator): allocated households
+            person_model (BayesianNetworkNodel): generative model
+            household_model (BayesianNetworkNodel): generative model
+            seed (int): seed for reproducible generation
+            chunk_size (int): maximum number of rows per chunk
+            compact (bool): use the compact schema, see `generate`
+
+        Yields: ('persons' or 'households', DataFrame) for each chunk
+        """
+        id_encoder = HouseholdIdEncoder.from_allocator(household_allocator) if compact else None
+        for name, plan, model, fields in Population._generation_passes(
+                household_allocator, person_model, household_model):
+            for chunk in Population._generate_chunks_from_model(
+                    plan, model, fields, seed, name, chunk_size, id_encoder):
+                yield name, chunk
+
+    @staticmethod
+    def generate_to(household_allocator, person_model, household_model, persons_sink,
+                    households_sink, seed=None, chunk_size=DEFAULT_CHUNK_SIZE, processes=None,
+                    compact=False):
+        """Generate the population straight into sinks without keeping it in memory.
+
+        Args:
+            household_allocator (HouseholdAllocator): allocated households
+            person_model (BayesianNetworkNodel): generative model
+            household_model (BayesianNetworkNodel): generative model
+            persons_sink: sink from `doppelganger.sinks`, or a function that
+                is called with each chunk of persons
+            households_sink: sink or function for chunks of households
+            seed (int): seed for reproducible generation
+            chunk_size (int): maximum number of rows per chunk
+            processes (int): if given, generate each tract in a pool of this
+                many worker processes and write each tract as one chunk, see
+                `generate_by_tract`
+            compact (bool): use the compact schema, see `generate`
+        """
+        name_to_sink = {
+            'persons': sinks.as_sink(persons_sink),
+            'households': sinks.as_sink(households_sink),
+        }
+        try:
+            if processes is None:
+                for name, chunk in Population.generate_chunks(
+                        household_allocator, person_model, household_model, seed, chunk_size,
+                        compact):
+                    name_to_sink[name].write(chunk)
+            else:
+                offsets = {'persons': 0, 'households': 0}
+                for _, population in Population.generate_by_tract(
+                        household_allocator, person_model, household_model, seed, processes,
+                        compact=compact):
+                    for name, chunk in (('persons', population.generated_people),
+                                        ('households', population.generated_households)):
+                        chunk.index = pandas.RangeIndex(
+                            offsets[name], offsets[name] + len(chunk))
+                        offsets[name] += len(chunk)
+                        name_to_sink[name].write(chunk)
+        finally:
+            for sink in name_to_sink.values():
+                sink.close()
+
+    @staticmethod
+    def generate_by_tract(household_allocator, person_model, household_model, seed=None,
+                          processes=None, ordered=True, compact=False, joint=False):
+        """Generate the population one tract at a time in worker processes.
+
+        The models are sent to each worker once, when the pool starts.  With
+        the default fork start method they are not pickled at all; otherwise
+        the models and their segmenters must be picklable.
+
+        Generation is always seeded so that workers do not share a random
+        state.  A seed is drawn if none is given.
+
+        Args:
+            household_allocator (HouseholdAllocator): allocated households
+            person_model (BayesianNetworkNodel): generative model
+            household_model (BayesianNetworkNodel): generative model
+            seed (int): seed for reproducible generation
+            processes (int): number of worker processes.  Generates in this
+                process if 1, uses one worker per cpu if None.
+            ordered (bool): yield tracts in allocation order.  If False, yield
+                each tract as soon as it is done.
+            compact (bool): use the compact schema, see `generate`.  Ids and
+                categories are those of the whole allocation, so the tracts'
+                populations can be concatenated.
+            joint (bool): generate households and persons in one pass, see
+                `generate`
+
+        Yields: (tract, Population) for each tract
+        """
+        if seed is None:
+            seed = seeding.random_seed()
+        id_encoder = (HouseholdIdEncoder.from_allocator(household_allocator)
+                      if compact or joint else None)
+        shards = Population._shard_by_tract(household_allocator)
+        if processes == 1:
+            for tract, households, persons in shards:
+                yield tract, Population._generate_shard(
+                    households, persons, person_model, household_model, seed, id_encoder, joint)
+            return
+
+        pool = Pool(processes, _init_worker,
+                    (person_model, household_model, seed, id_encoder, joint))
+        try:
+            imap = pool.imap if ordered else pool.imap_unordered
+            for tract, population in imap(_generate_shard_in_worker, shards):
+                yield tract, population
+        finally:
+            pool.terminate()
+            pool.join()
+
+    @staticmethod
+    def _shard_by_tract(household_allocator):
+        """Split allocated households by tract, along with the persons allocated to them.
+
+        Yields (tract, households, persons), with rows in allocation order.
+        """
+        tract_to_positions, serialno_to_positions = Population._index_by_tract(
+            household_allocator)
+        for tract, positions in tract_to_positions.items():
+            households, persons = Population._tract_shard(
+                household_allocator, positions, serialno_to_positions)
+            yield tract, households, persons
+
+    @staticmethod
+    def _index_by_tract(household_allocator):
+        """Positions of the allocated households of each tract, in allocation
+        order, and positions of the allocated persons of each serial number.
+        """
+        households = household_allocator.allocated_households
+        persons = household_allocator.allocated_persons
+        tract_to_positions = OrderedDict(
+            (tract, positions) for tract, positions in sorted(
+                households.groupby(inputs.TRACT.name, sort=False).indices.items(),
+                key=lambda item: item[1][0])
+        )
+        return tract_to_positions, persons.groupby(inputs.SERIAL_NUMBER.name).indices
+
+    @staticmethod
+    def _tract_shard(household_allocator, household_positions, serialno_to_positions):
+        """The households at the given positions and the persons allocated to them."""
+        tract_households = household_allocator.allocated_households.iloc[household_positions]
+        serialnos = tract_households.loc[
+            tract_households[inputs.COUNT.name] > 0, inputs.SERIAL_NUMBER.name].unique()
+        positions = [serialno_to_positions[serialno] for serialno in serialnos
+                     if serialno in serialno_to_positions]
+        positions = np.sort(np.concatenate(positions)) if positions else []
+        return tract_households, household_allocator.allocated_persons.iloc[positions]
+
+    @staticmethod
+    def _generate_shard(households, persons, person_model, household_model, seed, id_encoder,
+                        joint=False):
+        return Population._generate(
+            HouseholdAllocator(households, persons), person_model, household_model, seed,
+            id_encoder, joint)
+
+    @staticmethod
+    def concat(populations):
+        """Combine populations, e.g. of separate tracts, into one
+
+        Args:
+            populations (iterable(Population)): populations to combine
+
+        Returns: Population with the persons and households of all populations
+        """
+        populations = list(populations)
+        if not populations:
+            return Population(pandas.DataFrame(), pandas.DataFrame())
+        return Population(
+            pandas.concat([population.generated_people for population in populations],
+                          ignore_index=True),
+            pandas.concat([population.generated_households for population in populations],
+                          ignore_index=True)
+        )
+
     def write(self, persons_outfile, households_outfile):
         """Write population to the given file
 
         Args:
-            outfile (unicode): path to write to
+            persons_outfile (unicode): path to write persons to
+            households_outfile (unicode): path to write households to
+
+        """
+        self.write_to(sinks.CsvSink(persons_outfile), sinks.CsvSink(households_outfile))
+
+    def write_dataset(self, persons_path, households_path, format='parquet'):
+        """Write population to datasets partitioned by tract
+
+        Args:
+            persons_path (unicode): directory to write persons to
+            households_path (unicode): directory to write households to
+            format (unicode): 'parquet' or 'arrow'
+
+        """
+        self.write_to(*(
+            sinks.DatasetSink(path, [inputs.TRACT.name], DATASET_DTYPES, format)
+            for path in (persons_path, households_path)
+        ))
+
+    def write_to(self, persons_sink, households_sink):
+        """Write population to the given sinks
+
+        Args:
+            persons_sink: sink from `doppelganger.sinks`, or a function that
+                is called with the persons
+            households_sink: sink or function for the households
+
+        """
+        for data, sink in ((self.generated_people, persons_sink),
+                           (self.generated_households, households_sink)):
+            sink = sinks.as_sink(sink)
+            try:
+                sink.write(data)
+            finally:
+                sink.close()
+
+
+class LazyPopulation(object):
+    """Population of an allocation, generated one tract at a time on demand.
+
+    The allocation is indexed by tract up front, and a tract's persons and
+    households are only generated when it is requested.  Generation is
+    seeded, so a tract is the same every time it is requested, whether it is
+    generated again or read from the cache, and is the same as that tract in
+    `Population.generate` with the same seed.  The most recently requested
+    tracts are cached.
+    """
+
+    def __init__(self, household_allocator, person_model, household_model, seed=None,
+                 cache_size=DEFAULT_TRACT_CACHE_SIZE, compact=False):
+        """
+        Args:
+            household_allocator (HouseholdAllocator): allocated persons and
+                households
+            person_model (BayesianNetworkModel): model of persons
+            household_model (BayesianNetworkModel): model of households
+            seed (int): seed for generation.  If None, a seed is drawn once,
+                and kept for the life of this object.
+            cache_size (int): maximum number of tracts to keep
+            compact (bool): use the compact schema, see `Population.generate`
+        """
+        self.household_allocator = household_allocator
+        self.person_model = person_model
+        self.household_model = household_model
+        self.seed = seeding.random_seed() if seed is None else seed
+        self.cache_size = cache_size
+        self.id_encoder = (
+            HouseholdIdEncoder.from_allocator(household_allocator) if compact else None)
+        self.tract_to_positions, self.serialno_to_positions = Population._index_by_tract(
+            household_allocator)
+        self.cache = OrderedDict()
+
+    @property
+    def tracts(self):
+        """The allocated tracts, in allocation order."""
+        return list(self.tract_to_positions)
+
+    def __len__(self):
+        return len(self.tract_to_positions)
+
+    def __iter__(self):
+        return iter(self.tract_to_positions)
+
+    def __contains__(self, tract):
+        return tract in self.tract_to_positions
+
+    def __getitem__(self, tract):
+        """The population of one tract
+
+        Raises:
+            KeyError: if the tract is not allocated
+        """
+        if tract in self.cache:
+            self.cache[tract] = self.cache.pop(tract)
+            return self.cache[tract]
+        households, persons = Population._tract_shard(
+            self.household_allocator, self.tract_to_positions[tract],
+            self.serialno_to_positions)
+        population = Population._generate_shard(
+            households, persons, self.person_model, self.household_model, self.seed,
+            self.id_encoder)
+        if self.cache_size > 0:
+            self.cache[tract] = population
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return population
+
+    def get(self, tracts):
+        """The combined population of the given tracts
+
+        Args:
+            tracts (iterable(unicode)): tracts to include
+
+        Returns: Population with the persons and households of the tracts
+        """
+        return Population.concat(self[tract] for tract in tracts)
+
+
+class HouseholdIdEncoder(object):
+    """Compact 64-bit household ids.
+
+    An id packs the index of a household's tract, the index of its serial
+    number and its repeat index into a single integer, so persons and
+    households can be joined on one int64 column.  Indexes are positions in
+    the sorted tracts and serial numbers of the whole allocation, which keeps
+    ids the same however generation is split up.
+    """
 
+    TRACT_BITS = 20
+    HOUSEHOLD_BITS = 24
+    REPEAT_BITS = 19
+
+    def __init__(self, tracts, serial_numbers):
+        self.tracts = pandas.Index(tracts)
+        self.serial_numbers = pandas.Index(serial_numbers)
+        if len(self.tracts) > 1 << self.TRACT_BITS:
+            raise ValueError('Too many tracts for compact household ids')
+        if len(self.serial_numbers) > 1 << self.HOUSEHOLD_BITS:
+            raise ValueError('Too many households for compact household ids')
+
+    @staticmethod
+    def from_allocator(household_allocator):
+        households = household_allocator.allocated_households
+        return HouseholdIdEncoder(
+            sorted(pandas.unique(households[inputs.TRACT.name])),
+            sorted(pandas.unique(households[inputs.SERIAL_NUMBER.name]))
+        )
+
+    @staticmethod
+    def _indexes(index, values, name):
+        indexes = index.get_indexer(values)
+        if (indexes < 0).any():
+            raise ValueError('Unknown {} {}'.format(name, values[np.argmin(indexes)]))
+        return indexes
+
+    def tract_indexes(self, tracts):
+        return self._indexes(self.tracts, tracts, 'tract')
+
+    def household_indexes(self, serial_numbers):
+        return self._indexes(self.serial_numbers, serial_numbers, 'serial number')
+
+    def encode(self, tract_indexes, household_indexes, repeat_indexes):
+        """Pack indexes into int64 household ids."""
+        repeat_indexes = np.asarray(repeat_indexes, dtype=np.int64)
+        if len(repeat_indexes) and repeat_indexes.max() >= 1 << self.REPEAT_BITS:
+            raise ValueError('Too many repeats for compact household ids')
+        tract_shift = self.HOUSEHOLD_BITS + self.REPEAT_BITS
+        return (
+            (np.asarray(tract_indexes, dtype=np.int64) << tract_shift) |
+            (np.asarray(household_indexes, dtype=np.int64) << self.REPEAT_BITS) |
+            repeat_indexes
+        )
+
+    def decode(self, household_ids):
+        """Unpack int64 household ids.
+
+        Returns: (tract indexes, household indexes, repeat indexes)
         """
-        self.generated_people.to_csv(persons_outfile)
-        self.generated_households.to_csv(households_outfile)
+        household_ids = np.asarray(household_ids, dtype=np.int64)
+        return (
+            household_ids >> (self.HOUSEHOLD_BITS + self.REPEAT_BITS),
+            (household_ids >> self.REPEAT_BITS) & ((1 << self.HOUSEHOLD_BITS) - 1),
+            household_ids & ((1 << self.REPEAT_BITS) - 1)
+        )
+
+
+# Worker state for process pools.  Set once per worker so the models are not
+# sent along with every shard.
+_worker_models = None
+
+
+def _init_worker(person_model, household_model, seed, id_encoder, joint):
+    global _worker_models
+    _worker_models = (person_model, household_model, seed, id_encoder, joint)
+
+
+def _generate_shard_in_worker(shard):
+    tract, households, persons = shard
+    return tract, Population._generate_shard(households, persons, *_worker_models)
@@ -7,6 +7,7 @@ from __future__ import (
     absolute_import, division, print_function, unicode_literals
 )
 
+from collections import OrderedDict
 import sys
 
 import pandas
@@ -17,10 +18,12 @@ from doppelganger import inputs
 class Preprocessor(object):
 
     def __init__(
-        self, input_to_preprocessor=None, input_to_possible_values=None
+        self, input_to_preprocessor=None, input_to_possible_values=None, config=None
     ):
         self.input_to_preprocessor = input_to_preprocessor or {}
         self.input_to_possible_values = input_to_possible_values or {}
+        # Config the preprocessor was made from, if any
+        self.config = config
 
     def process_dataframe(self, dataframe, fields, name_map):
         """Extract the data types from the given DataFrames and process them
@@ -35,12 +38,12 @@ class Preprocessor(object):
         Returns: pandas.DataFrame of the given fields, processed
 
         """
-        cleaned_dataframe = pandas.DataFrame()
+        cleaned_columns = OrderedDict()
         for field_name in fields:
             if field_name in self.input_to_preprocessor:
                 procesessor = self.input_to_preprocessor[field_name]
             elif field_name in inputs.NAME_TO_DATATYPE:
-                procesessor = inputs.NAME_TO_DATATYPE[field_name].process
+                procesessor = None
             else:
                 print('Unknown data field {}'.format(
                     field_name), file=sys.stderr)
@@ -49,15 +52,20 @@ class Preprocessor(object):
             data_type = inputs.NAME_TO_DATATYPE[field_name]
             dirty_name = name_map[field_name]
             if dirty_name in dataframe:
-                cleaned_dataframe[data_type.name] = dataframe[
-                    dirty_name].apply(procesessor)
+                column = dataframe[dirty_name]
             elif dirty_name.upper() in dataframe:
-                cleaned_dataframe[data_type.name] = dataframe[
-                    dirty_name.upper()].apply(procesessor)
+                column = dataframe[dirty_name.upper()]
             else:
                 print('Missing data field {}'.format(
                     field_name), file=sys.stderr)
-        return cleaned_dataframe
+                continue
+            # Processors with a vectorized variant process the whole column
+            # at once, others are applied element by element
+            if procesessor is None:
+                cleaned_columns[data_type.name] = data_type.process_series(column)
+            else:
+                cleaned_columns[data_type.name] = inputs.process_series(procesessor, column)
+        return pandas.DataFrame(cleaned_columns)
 
     def get_possible_values(self, field):
         field = inputs.NAME_TO_DATATYPE[field]
@@ -80,4 +88,4 @@ class Preprocessor(object):
                 )
                 field_to_preprocessor[field] = preprocessor
                 field_to_possible_values[field] = labels
-        return Preprocessor(field_to_preprocessor, field_to_possible_values)
+        return Preprocessor(field_to_preprocessor, field_to_possible_values, config)
@@ -0,0 +1,133 @@
+# Copyright 2017 Sidewalk Labs | https://www.apache.org/licenses/LICENSE-2.0
+
+"""Indexed mapping between PUMAs and census tracts.
+
+The census publishes which tracts make up each PUMA as a csv, e.g.
+examples/sample_data/2010_puma_tract_mapping.txt.zip.  `PumaTractMapping`
+reads it, zipped or not, in one pass and indexes it both ways, so looking up
+the tracts of some PUMAs costs the size of the result rather than a scan of
+the file.
+
+    mapping = PumaTractMapping.from_file('2010_puma_tract_mapping.txt.zip')
+    marginals = Marginals.from_census_data_by_county(
+        mapping, census_key, state='06', pumas=['07507'])
+"""
+
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+
+from contextlib import contextmanager
+import zipfile
+
+import numpy as np
+import pandas
+
+# Columns of a mapping, as in the census file
+GEOGRAPHY_COLUMNS = ('STATEFP', 'COUNTYFP', 'PUMA5CE', 'TRACTCE')
+
+
+@contextmanager
+def _open_mapping_file(path):
+    """File object of a mapping csv, or of the csv inside a zip archive.
+
+    The file, and the archive it is in, are closed on leaving the context.
+    """
+    if not zipfile.is_zipfile(path):
+        with open(path, 'rb') as infile:
+            yield infile
+        return
+    with zipfile.ZipFile(path) as archive:
+        # Skip directories and the resource forks of archives made on a mac
+        names = [name for name in archive.namelist()
+                 if not name.endswith('/') and not name.startswith('__MACOSX/')]
+        if len(names) != 1:
+            raise ValueError('Expected one mapping file in {}, found {}'.format(path, names))
+        with archive.open(names[0]) as member:
+            yield member
+
+
+class PumaTractMapping(object):
+    """Which tracts make up each PUMA, indexed by (state, PUMA) and by
+    (state, tract).
+
+    Iterating over a mapping yields a dict per tract, so it can be passed
+    anywhere a csv.DictReader of the mapping file was expected.
+    """
+
+    def __init__(self, data):
+        """
+        Args:
+            data (DataFrame): one row per tract, with the STATEFP, COUNTYFP,
+                PUMA5CE and TRACTCE of the tract as strings
+        """
+        self.data = data[list(GEOGRAPHY_COLUMNS)].reset_index(drop=True)
+        # (state, puma) -> positions of its tracts, in file order
+        self._puma_index = self.data.groupby(['STATEFP', 'PUMA5CE'], sort=False).indices
+        # (state, tract) -> positions of the tract.  Tract codes are only
+        # unique within a county, so a state can have several.
+        self._tract_index = self.data.groupby(['STATEFP', 'TRACTCE'], sort=False).indices
+
+    @staticmethod
+    def from_file(path):
+        """Load a mapping csv, e.g. 2010_puma_tract_mapping.txt, or a zip
+        archive of it."""
+        with _open_mapping_file(path) as infile:
+            data = pandas.read_csv(infile, usecols=list(GEOGRAPHY_COLUMNS), dtype=str)
+        return PumaTractMapping(data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __iter__(self):
+        for row in self.data.itertuples(index=False):
+            yield dict(zip(GEOGRAPHY_COLUMNS, row))
+
+    def _puma_positions(self, state, pumas):
+        positions = [self._puma_index[(state, puma)] for puma in pumas
+                     if (state, puma) in self._puma_index]
+        if not positions:
+            return np.array([], dtype=np.intp)
+        return np.sort(np.concatenate(positions))
+
+    def select(self, state=None, pumas=None):
+        """Rows of the tracts in the given PUMAs of a state, in file order.
+
+        Args:
+            state (unicode): state fips code, or None for every state
+            pumas (iterable of unicode): PUMA codes, or None for every PUMA
+                of the state
+
+        Returns:
+            DataFrame: with columns STATEFP, COUNTYFP, PUMA5CE, TRACTCE
+        """
+        if state is None:
+            if pumas is not None:
+                raise ValueError('Please supply the state fips code of the pumas.')
+            return self.data.copy()
+        if pumas is None:
+            pumas = [puma for state_key, puma in self._puma_index if state_key == state]
+        rows = self.data.iloc[self._puma_positions(state, set(pumas))]
+        return rows.reset_index(drop=True)
+
+    def tracts(self, state=None, pumas=None):
+        """(county, tract) codes of the tracts in the given PUMAs of a state."""
+        rows = self.select(state, pumas)
+        return list(zip(rows['COUNTYFP'], rows['TRACTCE']))
+
+    def locate(self, state, tract):
+        """(county, PUMA) codes of every tract with this code in the state.
+
+        Returns:
+            list((unicode, unicode)): empty if there is no such tract
+        """
+        positions = self._tract_index.get((state, tract), [])
+        rows = self.data.iloc[positions]
+        return list(zip(rows['COUNTYFP'], rows['PUMA5CE']))
+
+    def puma(self, state, county, tract):
+        """PUMA code of a tract, or None if the tract is not mapped."""
+        for county_key, puma_key in self.locate(state, tract):
+            if county_key == county:
+                return puma_key
+        return None
@@ -0,0 +1,92 @@
+# Copyright 2017 Sidewalk Labs | https://www.apache.org/licenses/LICENSE-2.0
+
+"""Deterministic random number streams for population generation.
+
+Each unit of generation work, e.g. the persons of one segment in one tract,
+draws from its own stream.  A stream is a child of the user's seed whose
+`numpy.random.SeedSequence` spawn key is derived from the unit's key, so it
+depends only on the seed and the key and never on the order in which units
+are processed.  Generated output is then identical however the work is split
+among processes.
+
+`numpy.random.Generator` and `SeedSequence` need numpy 1.17, which does not
+support Python 2.  With an older numpy, each stream is a `RandomState`
+seeded from the seed and the key instead.  Streams are still independent of
+the order of work, but draw different numbers than on a newer numpy.
+"""
+
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+from builtins import str
+
+import hashlib
+import os
+
+import numpy as np
+
+# numpy >= 1.17
+HAS_GENERATOR = hasattr(np.random, 'Generator') and hasattr(np.random, 'SeedSequence')
+
+
+def _stable_int(value):
+    """A 64-bit integer derived from the string form of the given value.
+
+    Unlike `hash`, this does not change between processes or runs.
+    """
+    digest = hashlib.sha256(str(value).encode('utf-8')).hexdigest()
+    return int(digest[:16], 16)
+
+
+def work_unit_seed_sequence(seed, *key):
+    """The seed sequence of the work unit with the given key.
+
+    Args:
+        seed (int): the user's seed for the whole population
+        key: parts of the unit's key, e.g. ('persons', tract, segment)
+
+    Returns:
+        numpy.random.SeedSequence: child of seed for this unit.  If numpy is
+            older than 1.17, an array of 32-bit words derived from the seed
+            and the key instead, to seed a numpy.random.RandomState with.
+    """
+    if HAS_GENERATOR:
+        return np.random.SeedSequence(seed, spawn_key=tuple(_stable_int(part) for part in key))
+    words = []
+    for part in (seed,) + key:
+        value = _stable_int(part)
+        words.extend([value >> 32, value & 0xFFFFFFFF])
+    return np.array(words, dtype=np.uint32)
+
+
+def work_unit_rng(seed, *key):
+    """A random number generator for the work unit with the given key.
+
+    Args:
+        seed (int): the user's seed for the whole population
+        key: parts of the unit's key, e.g. ('persons', tract, segment)
+
+    Returns:
+        numpy.random.Generator: independent stream for this unit, or a
+            numpy.random.RandomState if numpy is older than 1.17
+    """
+    sequence = work_unit_seed_sequence(seed, *key)
+    if HAS_GENERATOR:
+        return np.random.Generator(np.random.PCG64(sequence))
+    return np.random.RandomState(sequence)
+
+
+def random_seed():
+    """A fresh seed from the operating system's entropy, to use when the
+    user gives none."""
+    if HAS_GENERATOR:
+        return np.random.SeedSequence().entropy
+    return int(hashlib.sha256(os.urandom(32)).hexdigest(), 16)
+
+
+def uniform(random_state, shape):
+    """Uniform draws in [0, 1) from a Generator, a RandomState or the
+    numpy.random module."""
+    if isinstance(random_state, np.random.RandomState) or random_state is np.random:
+        return random_state.random_sample(shape)
+    return random_state.random(shape)
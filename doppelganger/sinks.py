@@ -0,0 +1,119 @@
+# Copyright 2017 Sidewalk Labs | https://www.apache.org/licenses/LICENSE-2.0
+
+"""Destinations for data written one chunk at a time.
+
+A sink receives DataFrames with `write` and is finished with `close`.  The
+chunks written to a sink must all have the same columns.  Sinks let large
+outputs, such as a generated population, be written without ever holding the
+whole output in memory.
+"""
+
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+from builtins import str
+
+from doppelganger import datasets
+
+
+class CsvSink(object):
+    """Writes chunks to one csv file, with a single header row."""
+
+    def __init__(self, path):
+        self.path = path
+        self.chunks_written = 0
+
+    def write(self, chunk):
+        if self.chunks_written == 0:
+            chunk.to_csv(self.path)
+        else:
+            chunk.to_csv(self.path, mode='a', header=False)
+        self.chunks_written += 1
+
+    def close(self):
+        pass
+
+
+class ParquetSink(object):
+    """Writes chunks to one parquet file, one row group per chunk.
+
+    Requires pyarrow.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.writer = None
+
+    def write(self, chunk):
+        import pyarrow
+        import pyarrow.parquet
+
+        table = pyarrow.Table.from_pandas(chunk, preserve_index=False)
+        if self.writer is None:
+            self.writer = pyarrow.parquet.ParquetWriter(self.path, table.schema)
+        self.writer.write_table(table)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+class DatasetSink(object):
+    """Writes chunks to a partitioned dataset, see `doppelganger.datasets`.
+
+    Each partition written replaces the partition of the same value in an
+    existing dataset.  Other partitions are left in place.
+    """
+
+    def __init__(self, path, partition_by=(), dtypes=None, format='parquet'):
+        self.path = path
+        self.partition_by = list(partition_by)
+        self.dtypes = dtypes
+        self.format = format
+        self.chunks_written = 0
+        self.partitions_written = set()
+
+    def _write(self, chunk, replace):
+        if len(chunk) == 0 and self.chunks_written > 0:
+            return
+        template = 'part-{}-{{i}}.{}'.format(self.chunks_written, datasets.extension(self.format))
+        datasets.write_dataset(chunk, self.path, self.partition_by, self.dtypes, self.format,
+                               basename_template=template, replace=replace)
+
+    def write(self, chunk):
+        if not self.partition_by:
+            self._write(chunk, replace=self.chunks_written == 0)
+        else:
+            partitions = list(zip(*(chunk[column].astype(str) for column in self.partition_by)))
+            is_new = [partition not in self.partitions_written for partition in partitions]
+            is_old = [not new for new in is_new]
+            self._write(chunk[is_new], replace=True)
+            self._write(chunk[is_old], replace=False)
+            self.partitions_written.update(partitions)
+        self.chunks_written += 1
+
+    def close(self):
+        pass
+
+
+class CallbackSink(object):
+    """Passes each chunk to a function."""
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def write(self, chunk):
+        self.callback(chunk)
+
+    def close(self):
+        pass
+
+
+def as_sink(sink):
+    """Wrap plain functions in a CallbackSink, and leave sinks as they are."""
+    if hasattr(sink, 'write'):
+        return sink
+    if callable(sink):
+        return CallbackSink(sink)
+    raise TypeError('Expected a sink or a function, got {}'.format(sink))
@@ -0,0 +1,400 @@
+# Copyright 2017 Sidewalk Labs | https://www.apache.org/licenses/LICENSE-2.0
+
+"""Learning Bayesian network structures from weighted counts.
+
+Writing a network structure by hand with `define_bayes_net_structure` gets
+unwieldy once a model has more than a handful of fields.  This module searches
+for a structure instead, either as a Chow-Liu tree or by greedy hill-climbing
+on the BIC score with a bound on the number of parents per node.
+
+Both searches work from `WeightedCounts`, which collapses the training data
+into integer-coded distinct rows with weights.  Family statistics are computed
+from those counts and cached, so the cost of the search depends on the number
+of distinct rows rather than on the (weight-expanded) size of the training
+data.  The structures returned use the same format as
+`define_bayes_net_structure` and can be passed straight to
+`BayesianNetworkModel.train`.
+"""
+
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+from builtins import range
+
+from collections import Counter
+import itertools
+from multiprocessing import Pool
+
+import numpy as np
+import pandas
+
+
+class WeightedCounts(object):
+    """Integer-coded distinct rows of training data and their weights.
+
+    Column i of `codes` holds the codes of field i.  `vocabulary[i][code]` is
+    the value that code stands for.
+    """
+
+    def __init__(self, codes, weights, vocabulary, fields):
+        self.codes = codes
+        self.weights = weights
+        self.vocabulary = vocabulary
+        self.fields = fields
+        self.cardinalities = tuple(max(len(values), 1) for values in vocabulary)
+        self.total = float(weights.sum())
+        self._family_score_cache = {}
+
+    @staticmethod
+    def from_rows(rows, fields):
+        """Count rows of data, with each row counted once.
+
+        Args:
+            rows (iterable(tuple)): rows with one value for each field
+            fields (list(unicode)): field names, in the column order of rows
+
+        Returns:
+            WeightedCounts: counts of the distinct rows
+        """
+        counter = Counter(tuple(row) for row in rows)
+        frame = pandas.DataFrame(list(counter.keys()), columns=list(fields))
+        weights = np.array(list(counter.values()), dtype=np.float64)
+        return WeightedCounts._from_frame(frame, weights, fields)
+
+    @staticmethod
+    def from_segmented_data(segmented_data, fields, segments=None):
+        """Count the rows of the given segments of training data.
+
+        Args:
+            segmented_data (SegmentedData): data as passed to
+                `BayesianNetworkModel.train`
+            fields (list(unicode)): field names, in the column order of the
+                training data
+            segments (iterable): segments to count.  Counts all segments if
+                not given, which learns one structure shared by all of them.
+
+        Returns:
+            WeightedCounts: counts of the distinct rows
+        """
+        if segments is None:
+            segments = segmented_data.types()
+        rows = itertools.chain.from_iterable(
+            segmented_data.type_to_data[segment] for segment in segments)
+        return WeightedCounts.from_rows(rows, fields)
+
+    @staticmethod
+    def from_cleaned_data(cleaned_data, fields, weight_field=None):
+        """Count rows of cleaned data without expanding them by weight.
+
+        Args:
+            cleaned_data (CleanedData): data to count
+            fields (list(unicode)): fields to count
+            weight_field (unicode): name of the int field that shows how much
+                each row should be weighted
+
+        Returns:
+            WeightedCounts: counts of the distinct rows
+        """
+        data = cleaned_data.data
+        if weight_field:
+            weights = data[weight_field].values.astype(np.float64)
+        else:
+            weights = np.ones(len(data))
+        return WeightedCounts._from_frame(data, weights, fields)
+
+    @staticmethod
+    def _from_frame(frame, weights, fields):
+        codes = np.empty((len(frame), len(fields)), dtype=np.int64)
+        vocabulary = []
+        for i, field in enumerate(fields):
+            codes[:, i], values = pandas.factorize(frame[field])
+            vocabulary.append(list(values))
+        if (codes < 0).any():
+            raise ValueError('Training data cannot contain missing data')
+        # Number the distinct rows one column at a time, refactorizing so that
+        # the numbers stay below the number of rows.  np.unique(axis=0) would
+        # need numpy 1.13.
+        row_ids = np.zeros(len(codes), dtype=np.int64)
+        for i in range(len(fields)):
+            row_ids = pandas.factorize(row_ids * max(len(vocabulary[i]), 1) + codes[:, i])[0]
+        _, first_rows, inverse = np.unique(row_ids, return_index=True, return_inverse=True)
+        codes = codes[first_rows]
+        weights = np.bincount(inverse.ravel(), weights=weights, minlength=len(codes))
+        return WeightedCounts(codes, weights, vocabulary, list(fields))
+
+    def family_counts(self, child, parents):
+        """Contingency table of a node and its parents.
+
+        Returns:
+            numpy array with a row for each parent configuration that occurs
+                in the data and a column for each value of the child
+        """
+        return _family_counts(self.codes, self.weights, self.cardinalities, child, parents)
+
+    def family_score(self, child, parents):
+        """BIC score of a node given its parents, cached."""
+        key = (child, tuple(sorted(parents)))
+        if key not in self._family_score_cache:
+            self._family_score_cache[key] = _bic_family_score(
+                self.codes, self.weights, self.cardinalities, self.total, *key)
+        return self._family_score_cache[key]
+
+    def score_families(self, families, pool=None):
+        """Score many (child, parents) families, in parallel when given a pool.
+
+        Args:
+            families (iterable((int, tuple(int)))): families to score
+            pool (multiprocessing.Pool): pool created with `make_pool`.
+                Scores in this process if not given.
+        """
+        missing = sorted(set(
+            (child, tuple(sorted(parents))) for child, parents in families
+            if (child, tuple(sorted(parents))) not in self._family_score_cache
+        ))
+        if pool is not None and len(missing) > 1:
+            scores = pool.map(_score_family_in_worker, missing)
+            self._family_score_cache.update(zip(missing, scores))
+        for family in missing:
+            self.family_score(*family)
+
+    def make_pool(self, processes):
+        """Create a process pool whose workers each hold a copy of the counts.
+
+        Returns None when processes is None or 1, which means score in this
+        process.  Callers are responsible for closing the pool.
+        """
+        if processes is None or processes <= 1:
+            return None
+        return Pool(processes, _init_worker,
+                    (self.codes, self.weights, self.cardinalities, self.total))
+
+    def score(self, structure):
+        """BIC score of a whole structure."""
+        return sum(self.family_score(child, parents) for child, parents in enumerate(structure))
+
+
+def _family_counts(codes, weights, cardinalities, child, parents):
+    parents = tuple(parents)
+    if parents:
+        configurations = np.ravel_multi_index(
+            tuple(codes[:, parent] for parent in parents),
+            tuple(cardinalities[parent] for parent in parents)
+        )
+        # Only configurations seen in the data get a row
+        _, configurations = np.unique(configurations, return_inverse=True)
+        n_configurations = configurations.max() + 1
+    else:
+        configurations = np.zeros(len(codes), dtype=np.int64)
+        n_configurations = 1
+    n_values = cardinalities[child]
+    counts = np.bincount(configurations.ravel() * n_values + codes[:, child],
+                         weights=weights, minlength=n_configurations * n_values)
+    return counts.reshape(n_configurations, n_values)
+
+
+def _bic_family_score(codes, weights, cardinalities, total, child, parents):
+    counts = _family_counts(codes, weights, cardinalities, child, parents)
+    configuration_totals = counts.sum(axis=1, keepdims=True)
+    nonzero = counts > 0
+    log_likelihood = np.sum(
+        counts[nonzero] *
+        np.log((counts / np.maximum(configuration_totals, 1e-300))[nonzero])
+    )
+    n_parameters = (cardinalities[child] - 1) * np.prod(
+        [cardinalities[parent] for parent in parents], dtype=np.float64)
+    return float(log_likelihood - 0.5 * np.log(max(total, 1.0)) * n_parameters)
+
+
+def _mutual_information(codes, weights, cardinalities, total, pair):
+    """Mutual information of two fields, in nats."""
+    first, second = pair
+    joint = _family_counts(codes, weights, cardinalities, first, (second,)) / total
+    outer = joint.sum(axis=1, keepdims=True) * joint.sum(axis=0, keepdims=True)
+    nonzero = joint > 0
+    return float(np.sum(joint[nonzero] * np.log(joint[nonzero] / outer[nonzero])))
+
+
+# Worker state for process pools.  Set once per worker so the counts are not
+# pickled along with every task.
+_worker_counts = None
+
+
+def _init_worker(codes, weights, cardinalities, total):
+    global _worker_counts
+    _worker_counts = (codes, weights, cardinalities, total)
+
+
+def _score_family_in_worker(family):
+    return _bic_family_score(*(_worker_counts + family))
+
+
+def _mutual_information_in_worker(pair):
+    return _mutual_information(*(_worker_counts + (pair,)))
+
+
+def _close_pool(pool):
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+
+def _orient_forest(n_nodes, edges, root):
+    """Turn an undirected forest into a structure with edges pointing away
+    from the root of each tree: `root` for its own tree, and the lowest
+    numbered node for the others."""
+    neighbors = {node: set() for node in range(n_nodes)}
+    for first, second in edges:
+        neighbors[first].add(second)
+        neighbors[second].add(first)
+    parents = [()] * n_nodes
+    visited = set()
+    for tree_root in [root] + list(range(n_nodes)):
+        if tree_root in visited:
+            continue
+        visited.add(tree_root)
+        frontier = [tree_root]
+        while frontier:
+            node = frontier.pop()
+            for neighbor in sorted(neighbors[node] - visited):
+                parents[neighbor] = (node,)
+                visited.add(neighbor)
+                frontier.append(neighbor)
+    return tuple(parents)
+
+
+def learn_chow_liu_structure(counts, root=0, processes=None):
+    """Learn the maximum-likelihood tree-shaped structure.
+
+    Mutual information is computed for each pair of fields and the maximum
+    spanning forest over the pairs with positive mutual information is
+    oriented away from the root, or away from the lowest numbered field of
+    trees that do not contain the root.  Fields that are independent of
+    every other field are not given parents.
+
+    Args:
+        counts (WeightedCounts): training data
+        root (int): index of the field to use as the root of the tree
+        processes (int): number of worker processes used to score pairs
+
+    Returns: bayes net structure in the format of define_bayes_net_structure
+    """
+    n_fields = len(counts.fields)
+    pairs = list(itertools.combinations(range(n_fields), 2))
+    pool = counts.make_pool(processes)
+    try:
+        if pool is not None:
+            information = pool.map(_mutual_information_in_worker, pairs)
+        else:
+            information = [
+                _mutual_information(counts.codes, counts.weights, counts.cardinalities,
+                                    counts.total, pair)
+                for pair in pairs
+            ]
+    finally:
+        _close_pool(pool)
+
+    # Kruskal's algorithm for the maximum spanning forest over the pairs
+    # that share information
+    component = list(range(n_fields))
+
+    def find(node):
+        while component[node] != node:
+            component[node] = component[component[node]]
+            node = component[node]
+        return node
+
+    edges = []
+    for value, (first, second) in sorted(
+            zip(information, pairs), key=lambda item: (-item[0], item[1])):
+        if value <= 0:
+            break
+        first_component, second_component = find(first), find(second)
+        if first_component != second_component:
+            component[first_component] = second_component
+            edges.append((first, second))
+    return _orient_forest(n_fields, edges, root)
+
+
+def _is_ancestor(parents, ancestor, node):
+    """Whether there is a directed path from ancestor to node."""
+    stack = [node]
+    seen = set()
+    while stack:
+        current = stack.pop()
+        if current == ancestor:
+            return True
+        if current in seen:
+            continue
+        seen.add(current)
+        stack.extend(parents[current])
+    return False
+
+
+def _candidate_moves(parents, max_parents):
+    """Yield the (child, new parents) families changed by each legal single-edge move."""
+    n_fields = len(parents)
+    for child in range(n_fields):
+        for parent in range(n_fields):
+            if parent == child:
+                continue
+            if parent in parents[child]:
+                removed = parents[child] - {parent}
+                yield ((child, removed),)
+                # Reverse parent -> child to child -> parent
+                if len(parents[parent]) < max_parents:
+                    reduced = dict(enumerate(parents))
+                    reduced[child] = removed
+                    if not _is_ancestor(reduced, parent, child):
+                        yield ((child, removed), (parent, parents[parent] | {child}))
+            elif len(parents[child]) < max_parents \
+                    and not _is_ancestor(parents, child, parent):
+                yield ((child, parents[child] | {parent}),)
+
+
+def learn_hill_climb_structure(counts, max_parents=2, initial_structure=None,
+                               max_iterations=None, processes=None):
+    """Learn a structure by greedy hill-climbing on the BIC score.
+
+    Each step adds, removes or reverses the single edge that improves the
+    score most, never exceeding `max_parents` parents per node, until no move
+    improves the score.
+
+    Args:
+        counts (WeightedCounts): training data
+        max_parents (int): maximum number of parents per node
+        initial_structure (iterable(iterable(int))): structure to start from,
+            e.g. from learn_chow_liu_structure.  Starts from no edges if not
+            given.
+        max_iterations (int): stop after this many moves
+        processes (int): number of worker processes used to score the
+            candidate families of each step
+
+    Returns: bayes net structure in the format of define_bayes_net_structure
+    """
+    n_fields = len(counts.fields)
+    if initial_structure is None:
+        initial_structure = [()] * n_fields
+    parents = [frozenset(node_parents) for node_parents in initial_structure]
+    pool = counts.make_pool(processes)
+    iteration = 0
+    try:
+        while max_iterations is None or iteration < max_iterations:
+            moves = list(_candidate_moves(parents, max_parents))
+            counts.score_families((family for move in moves for family in move), pool=pool)
+            best_move, best_delta = None, 1e-9
+            for move in moves:
+                delta = sum(
+                    counts.family_score(child, new_parents) -
+                    counts.family_score(child, parents[child])
+                    for child, new_parents in move
+                )
+                if delta > best_delta:
+                    best_move, best_delta = move, delta
+            if best_move is None:
+                break
+            for child, new_parents in best_move:
+                parents[child] = frozenset(new_parents)
+            iteration += 1
+    finally:
+        _close_pool(pool)
+    return tuple(tuple(sorted(node_parents)) for node_parents in parents)
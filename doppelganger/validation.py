@@ -0,0 +1,218 @@
+# Copyright 2017 Sidewalk Labs | https://www.apache.org/licenses/LICENSE-2.0
+
+"""Compare a generated population with the marginals it was fit to.
+
+Counts are accumulated one chunk at a time, so a population can be validated
+as it is generated, e.g. from `Population.generate_chunks`, or read back
+partition by partition, without ever holding it all in memory.  Rows are
+counted with `np.bincount` over integer codes of (tract, control value).
+
+    validator = PopulationValidator(marginals)
+    for name, chunk in Population.generate_chunks(allocator, person_model, household_model):
+        validator.add_chunk(name, chunk)
+    report = validator.report()
+"""
+
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+from builtins import str
+
+from collections import OrderedDict
+
+import numpy as np
+import pandas
+
+from doppelganger import datasets, inputs
+from doppelganger.marginals import CONTROLS
+
+PERSONS = 'persons'
+HOUSEHOLDS = 'households'
+
+# Control category to the population table and field that it controls
+CONTROL_CATEGORY_FIELDS = {
+    'hh_size': (HOUSEHOLDS, inputs.NUM_PEOPLE),
+    'age': (PERSONS, inputs.AGE),
+}
+
+# Control of the total number of rows of a table
+TOTAL_CONTROL = 'count'
+
+# Tract column of marginals
+MARGINALS_TRACT = 'TRACTCE'
+
+
+def _controls_by_table():
+    """Table -> (field, control names) of the controls on that table."""
+    table_to_controls = OrderedDict()
+    for category, controls in CONTROLS.items():
+        table, field = CONTROL_CATEGORY_FIELDS[category]
+        table_to_controls[table] = (field, list(controls))
+    return table_to_controls
+
+
+def _codes(values, index):
+    """Positions of the values in the index, or -1 for values not in it.
+
+    Categorical values are looked up once per category.
+    """
+    if hasattr(values, 'cat'):
+        category_codes = index.get_indexer(values.cat.categories.astype(str))
+        codes = values.cat.codes.values
+        return np.where(codes < 0, -1, category_codes[codes])
+    return index.get_indexer(pandas.Series(values).astype(str).values)
+
+
+class PopulationValidator(object):
+    """Accumulates counts of a population per tract and control."""
+
+    def __init__(self, marginals):
+        """
+        Args:
+            marginals (Marginals): the marginals the population was fit to.
+                Rows of the same tract are summed.
+        """
+        data = marginals.data
+        self.tracts = pandas.Index(pandas.unique(data[MARGINALS_TRACT].astype(str)))
+        self.controls = [control for _, (_, controls) in _controls_by_table().items()
+                         for control in controls if control in data]
+        tract_codes = _codes(data[MARGINALS_TRACT], self.tracts)
+        self.expected = np.zeros((len(self.tracts), len(self.controls)))
+        for i, control in enumerate(self.controls):
+            self.expected[:, i] = np.bincount(
+                tract_codes, weights=data[control].astype(float).values,
+                minlength=len(self.tracts))
+        self.observed = np.zeros((len(self.tracts), len(self.controls)), dtype=np.int64)
+        self.unmatched_rows = {PERSONS: 0, HOUSEHOLDS: 0}
+
+    def _add(self, table, chunk):
+        if len(chunk) == 0:
+            return
+        field, controls = _controls_by_table()[table]
+        tract_codes = _codes(chunk[inputs.TRACT.name], self.tracts)
+        matched = tract_codes >= 0
+        self.unmatched_rows[table] += int((~matched).sum())
+        tract_codes = tract_codes[matched]
+        n_tracts = len(self.tracts)
+
+        value_controls = [control for control in controls
+                          if control != TOTAL_CONTROL and control in self.controls]
+        if value_controls and field.name in chunk:
+            value_codes = _codes(chunk[field.name], pandas.Index(value_controls))[matched]
+            counted = value_codes >= 0
+            counts = np.bincount(
+                tract_codes[counted] * len(value_controls) + value_codes[counted],
+                minlength=n_tracts * len(value_controls)
+            ).reshape(n_tracts, len(value_controls))
+            for i, control in enumerate(value_controls):
+                self.observed[:, self.controls.index(control)] += counts[:, i]
+        if TOTAL_CONTROL in controls and TOTAL_CONTROL in self.controls:
+            self.observed[:, self.controls.index(TOTAL_CONTROL)] += np.bincount(
+                tract_codes, minlength=n_tracts)
+
+    def add_persons(self, chunk):
+        """Count a DataFrame of generated persons."""
+        self._add(PERSONS, chunk)
+
+    def add_households(self, chunk):
+        """Count a DataFrame of generated households."""
+        self._add(HOUSEHOLDS, chunk)
+
+    def add_chunk(self, name, chunk):
+        """Count a chunk from `Population.generate_chunks`.
+
+        Args:
+            name (unicode): 'persons' or 'households'
+            chunk (DataFrame): generated rows
+        """
+        if name not in self.unmatched_rows:
+            raise ValueError('Unknown population table {}'.format(name))
+        self._add(name, chunk)
+
+    def add_population(self, population):
+        """Count a Population, e.g. of one tract."""
+        self.add_persons(population.generated_people)
+        self.add_households(population.generated_households)
+
+    def add_dataset(self, persons_path, households_path, tracts=None, format='parquet'):
+        """Count a population written with `Population.write_dataset`.
+
+        Only the columns that are validated are read, one batch at a time.
+
+        Args:
+            persons_path (unicode): directory of the persons dataset
+            households_path (unicode): directory of the households dataset
+            tracts (list(unicode)): count only these tracts, all if None
+            format (unicode): 'parquet' or 'arrow'
+        """
+        filters = {inputs.TRACT.name: tracts} if tracts is not None else None
+        for table, path in ((PERSONS, persons_path), (HOUSEHOLDS, households_path)):
+            field, _ = _controls_by_table()[table]
+            columns = [inputs.TRACT.name, field.name]
+            for chunk in datasets.iter_dataset(path, columns, filters, format=format):
+                self._add(table, chunk)
+
+    def counts(self):
+        """Observed and expected counts of each tract and control.
+
+        Returns:
+            DataFrame: indexed by tract, with columns (control, 'observed')
+                and (control, 'expected')
+        """
+        columns = pandas.MultiIndex.from_product([self.controls, ['observed', 'expected']])
+        values = np.stack([self.observed, self.expected], axis=2).reshape(len(self.tracts), -1)
+        return pandas.DataFrame(values, index=self.tracts, columns=columns)
+
+    def report(self):
+        """Error metrics of each control, over all tracts.
+
+        Returns:
+            DataFrame: indexed by control, with columns
+                observed: total generated count
+                expected: total marginal count
+                absolute_error: sum over tracts of |observed - expected|
+                mean_absolute_error: mean over tracts of |observed - expected|
+                rmse: root mean squared error over tracts
+                srmse: rmse divided by the mean expected count of a tract
+        """
+        return pandas.DataFrame(OrderedDict(
+            (name, values) for name, values in _error_metrics(self.observed, self.expected)
+        ), index=pandas.Index(self.controls, name='control'))
+
+    def total_srmse(self):
+        """Standardized root mean squared error over every tract and control."""
+        observed, expected = self.observed.ravel(), self.expected.ravel()
+        return float(_srmse(np.sqrt(np.mean((observed - expected) ** 2)), expected.mean()))
+
+
+def _srmse(rmse, mean_expected):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(mean_expected > 0, rmse / mean_expected, np.nan)
+
+
+def _error_metrics(observed, expected):
+    errors = observed - expected
+    rmse = np.sqrt(np.mean(errors ** 2, axis=0))
+    return [
+        ('observed', observed.sum(axis=0)),
+        ('expected', expected.sum(axis=0)),
+        ('absolute_error', np.abs(errors).sum(axis=0)),
+        ('mean_absolute_error', np.abs(errors).mean(axis=0)),
+        ('rmse', rmse),
+        ('srmse', _srmse(rmse, expected.mean(axis=0))),
+    ]
+
+
+def validate(population, marginals):
+    """Error metrics of a population against the marginals it was fit to.
+
+    Args:
+        population (Population): generated population
+        marginals (Marginals): marginals the population was fit to
+
+    Returns:
+        DataFrame: see `PopulationValidator.report`
+    """
+    validator = PopulationValidator(marginals)
+    validator.add_population(population)
+    return validator.report()
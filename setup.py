@@ -4,6 +4,10 @@
 
 from setuptools import setup
 
+# Datasets, Parquet sinks and the cleaned data cache.  pyarrow.dataset needs
+# pyarrow 1.0, which does not support python 2.
+PARQUET_REQUIRES = ['pyarrow>=1.0.0; python_version >= "3"']
+
 setup(
     name="doppelganger",
     version="0.1.0",
@@ -21,13 +25,15 @@ setup(
         'future>=0.16.0'
     ],
     extras_require={
+        'parquet': PARQUET_REQUIRES,
         'tests': [
             'flake8>=2.5.4',
             'mock>=2.0.0',
             'nose>=1.3.4',
             'coveralls>=1.1',
             'pytest',
-        ],
+            'sqlalchemy>=1.0.0',
+        ] + PARQUET_REQUIRES,
     },
 
 )
@@ -6,9 +6,10 @@ from __future__ import (
 
 from mock import MagicMock, patch
 import unittest
+import numpy as np
 import pandas
 
-from doppelganger import HouseholdAllocator
+from doppelganger import CleanedData, HouseholdAllocator, Marginals
 
 
 class TestAllocation(unittest.TestCase):
@@ -28,3 +29,63 @@ class TestAllocation(unittest.TestCase):
         allocator.write(person_file='persons_file', household_file='households_file')
         persons.to_csv.assert_called_once_with('persons_file')
         households.to_csv.assert_called_once_with('households_file')
+
+    def test_scaled_allocation(self):
+        households = CleanedData(pandas.DataFrame({
+            'serial_number': ['a', 'b', 'c', 'd'],
+            'num_people': ['1', '2', '3', '4+'],
+            'household_weight': [10, 20, 30, 40],
+            'puma': ['00100'] * 4,
+        }))
+        persons = CleanedData(pandas.DataFrame({
+            'serial_number': ['a', 'b', 'b', 'c', 'c', 'c', 'd', 'd', 'd', 'd'],
+            'age': ['0-17', '18-34', '35-64', '65+', '0-17', '18-34', '35-64', '65+', '0-17',
+                    '18-34'],
+            'sex': ['M', 'F'] * 5,
+            'person_weight': [10] * 10,
+            'puma': ['00100'] * 10,
+        }))
+        marginals = Marginals(pandas.DataFrame({
+            'TRACTCE': ['000100'],
+            '1': ['100'], '2': ['200'], '3': ['300'], '4+': ['400'],
+            '0-17': ['500'], '18-34': ['500'], '35-64': ['500'], '65+': ['500'],
+        }))
+
+        def balance(hh_table, A, B, w, mu, meta_mu):
+            return np.asarray(w, dtype=float), None, None
+
+        with patch('doppelganger.allocation.balance_multi_cvx', MagicMock(side_effect=balance)) \
+                as balance_multi_cvx, \
+                patch('doppelganger.allocation.discretize_multi_weights',
+                      MagicMock(side_effect=lambda hh_table, x: np.zeros(x.shape))):
+            allocator = HouseholdAllocator.from_cleaned_data(
+                marginals, households, persons, scale=0.1)
+
+        _, A, B, w, _, _ = balance_multi_cvx.call_args[0]
+        self.assertSequenceEqual(A.tolist(), [[10, 20, 30, 40]])
+        self.assertSequenceEqual(B.tolist(), [[10, 20, 30, 40]])
+        self.assertSequenceEqual(np.ravel(w).tolist(), [1, 2, 3, 4])
+        self.assertSequenceEqual(allocator.allocated_households['count'].tolist(), [1, 2, 3, 4])
+        error = allocator.scaling_error
+        self.assertSequenceEqual(error['target'].tolist(), [10, 20, 30, 40, 50, 50, 50, 50])
+        self.assertSequenceEqual(error['allocated'].tolist(), [1, 2, 3, 4, 8, 9, 6, 7])
+        self.assertAlmostEqual(error.loc['1', 'relative_error'], -0.9)
+
+    def test_format_categorical_data(self):
+        households = CleanedData(pandas.DataFrame({
+            'serial_number': ['a', 'b'],
+            'num_people': ['1', '4+'],
+            'household_weight': [10, 20],
+        }))
+        persons = CleanedData(pandas.DataFrame({
+            'serial_number': ['a', 'b', 'b'],
+            'age': ['0-17', '18-34', '65+'],
+            'sex': ['M', 'F', 'M'],
+        }))
+        expected = HouseholdAllocator._format_data(households.data, persons.data)
+        actual = HouseholdAllocator._format_data(
+            households.categorize().data, persons.categorize().data)
+        for expected_data, actual_data in zip(expected, actual):
+            pandas.testing.assert_frame_equal(
+                expected_data, actual_data.astype(expected_data.dtypes.to_dict()))
+        self.assertSequenceEqual(actual[0]['65+'].tolist(), [0, 1])
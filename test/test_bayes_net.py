@@ -15,6 +15,7 @@ from doppelganger import (
     bayesnets,
     inputs,
     datasource,
+    seeding,
     BayesianNetworkModel,
     Preprocessor
 )
@@ -142,6 +143,27 @@ class BayesNetTests(unittest.TestCase):
         self.assertEqual(len(training_data.type_to_data[self._one_person_house()]), 2)
         self.assertEqual(len(training_data.type_to_data[self._two_person_house()]), 2)
 
+    def test_read_households_vectorized_segmenter(self):
+        household_data = self._mock_household_input()
+        segmenter = bayesnets.vectorized_segmenter(lambda data: data['num_people'])
+        training_data = bayesnets.SegmentedData.from_data(
+            household_data, self._household_fields(), segmenter=segmenter
+        )
+        self.assertEqual(len(training_data.type_to_data[self._one_person_house()]), 2)
+        self.assertEqual(len(training_data.type_to_data[self._two_person_house()]), 1)
+
+    def test_segment_data(self):
+        data = self._mock_household_input().data
+        per_row = bayesnets.segment_data(self._household_segmenter(), data)
+        vectorized = bayesnets.segment_data(
+            bayesnets.vectorized_segmenter(lambda data: data['num_people'].values), data)
+        self.assertSequenceEqual(list(per_row), ['1', '2', '1'])
+        self.assertSequenceEqual(list(vectorized), ['1', '2', '1'])
+        self.assertSequenceEqual(
+            list(bayesnets.segment_data(bayesnets.default_segmenter, data)),
+            ['one_segment'] * 3
+        )
+
     def test_read_people_weighted(self):
         people_data = self._mock_people_input(weight=3)
         training_data = bayesnets.SegmentedData.from_data(
@@ -369,3 +391,55 @@ class BayesNetTests(unittest.TestCase):
             household_model_new = BayesianNetworkModel.from_file(
                 'file', self._household_segmenter())
             _check_network(household_model_new)
+
+    def test_vocabulary(self):
+        _, person_model = self._mock_household_collection()
+        vocabulary = person_model.vocabulary()
+        self.assertSequenceEqual(vocabulary[0], ['0-17', '18-34', '35-64', '65+'])
+        self.assertSequenceEqual(vocabulary[1], ['F', 'M'])
+
+    def test_generate_batch(self):
+        _, person_model = self._mock_household_collection()
+        evidence = pandas.DataFrame({inputs.AGE.name: ['65+', '0-17', '65+']})
+        codes, vocabulary = person_model.generate_batch(
+            [self._two_person_house(), self._one_person_house(), self._two_person_house()],
+            evidence, [2, 3, 1]
+        )
+        self.assertEqual(codes.shape, (6, 3))
+        age_index = self._person_fields().index(inputs.AGE.name)
+        ages = [vocabulary[age_index][code] for code in codes[:, age_index]]
+        self.assertSequenceEqual(ages, ['65+', '65+', '0-17', '0-17', '0-17', '65+'])
+        sex_index = self._person_fields().index(inputs.SEX.name)
+        sexes = [vocabulary[sex_index][code] for code in codes[:, sex_index]]
+        self.assertSequenceEqual(sexes, ['M', 'M', 'M', 'M', 'M', 'M'])
+
+    def test_generate_batch_array_evidence(self):
+        _, person_model = self._mock_household_collection()
+        codes, vocabulary = person_model.generate_batch(
+            [self._two_person_house()], [['F']], [4], evidence_fields=[inputs.SEX.name],
+            random_state=numpy.random.RandomState(0)
+        )
+        self.assertEqual(codes.shape, (4, 3))
+        sex_index = self._person_fields().index(inputs.SEX.name)
+        self.assertSetEqual(set(vocabulary[sex_index][code] for code in codes[:, sex_index]),
+                            {'F'})
+
+    def test_generate_batch_empty(self):
+        _, person_model = self._mock_household_collection()
+        codes, _ = person_model.generate_batch([], pandas.DataFrame({inputs.AGE.name: []}), [])
+        self.assertEqual(codes.shape, (0, 3))
+
+    def test_generate_seeded(self):
+        _, person_model = self._mock_household_collection()
+        evidence = ((str('age'), str('65+')),)
+
+        def generate():
+            rng = seeding.work_unit_rng(1, 'persons', 'tract1', self._two_person_house())
+            return person_model.generate(self._two_person_house(), evidence, 10, rng)
+
+        people = generate()
+        self.assertEqual(len(people), 10)
+        age_index = self._person_fields().index(inputs.AGE.name)
+        for person in people:
+            self.assertEqual(person[age_index], '65+')
+        self.assertSequenceEqual(people, generate())
@@ -0,0 +1,64 @@
+# Copyright 2017 Sidewalk Labs | https://www.apache.org/licenses/LICENSE-2.0
+
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import MagicMock
+
+from doppelganger.censuscache import cache_key, CensusCache, CensusCacheMiss
+
+
+class CensusCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'cache.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _params(self, tract='000100', fields='B01001_003E,B01001_004E', key='secret'):
+        return {'get': fields, 'for': 'tract:' + tract, 'in': 'state:06 county:075', 'key': key}
+
+    def test_cache_key(self):
+        self.assertEqual(
+            cache_key('url', self._params()),
+            cache_key('url', self._params(fields='B01001_004E,B01001_003E', key='other')))
+        self.assertNotEqual(cache_key('url', self._params()),
+                            cache_key('url', self._params(tract='000200')))
+        self.assertNotEqual(cache_key('url', self._params()), cache_key('url2', self._params()))
+
+    def test_fetch(self):
+        request = MagicMock(return_value=[['a'], ['1']])
+        cache = CensusCache(self.path)
+        self.assertEqual(cache.fetch('url', self._params(), request), [['a'], ['1']])
+        cache.close()
+
+        # Responses persist, and are not requested again
+        cache = CensusCache(self.path, offline=True)
+        self.assertEqual(cache.fetch('url', self._params(), request), [['a'], ['1']])
+        self.assertEqual(request.call_count, 1)
+        self.assertRaises(CensusCacheMiss, cache.fetch, 'url', self._params('000200'), request)
+        self.assertDictEqual(cache.stats(), {
+            'hits': 1, 'misses': 1, 'evictions': 0, 'entries': 1, 'bytes': len('[["a"], ["1"]]')
+        })
+        cache.close()
+
+    def test_eviction(self):
+        cache = CensusCache(':memory:', max_bytes=20)
+        cache.put('first', ['x' * 5])
+        cache.put('second', ['y' * 5])
+        cache.get('first')
+        cache.put('third', ['z' * 5])
+        # The least recently used response is evicted
+        self.assertIsNone(cache.get('second'))
+        self.assertEqual(cache.get('first'), ['x' * 5])
+        self.assertEqual(cache.stats()['evictions'], 1)
+        cache.clear()
+        self.assertEqual(cache.stats()['entries'], 0)
@@ -0,0 +1,91 @@
+# Copyright 2017 Sidewalk Labs | https://www.apache.org/licenses/LICENSE-2.0
+
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+
+import sys
+import unittest
+
+from mock import MagicMock, patch
+import requests
+
+if sys.version_info >= (3, 5):
+    import asyncio
+    from doppelganger import censusfetch
+
+
+@unittest.skipIf(sys.version_info < (3, 5), 'requires asyncio')
+class CensusFetchTest(unittest.TestCase):
+
+    def test_token_bucket(self):
+        now = [0.]
+        bucket = censusfetch.TokenBucket(rate=2, capacity=2, clock=lambda: now[0])
+        sleeps = []
+        loop = asyncio.new_event_loop()
+
+        # Without async syntax, which python 2 cannot parse
+        def sleep(seconds):
+            sleeps.append(seconds)
+            now[0] += seconds
+            slept = loop.create_future()
+            slept.set_result(None)
+            return slept
+
+        try:
+            with patch('asyncio.sleep', sleep):
+                for _ in range(4):
+                    loop.run_until_complete(bucket.acquire())
+        finally:
+            loop.close()
+        # A burst of two, then one every half second
+        self.assertSequenceEqual(sleeps, [0.5, 0.5])
+        self.assertRaises(ValueError, censusfetch.TokenBucket, 0)
+
+    def test_fetch_all(self):
+        responses = {
+            'ok': MagicMock(status_code=200, json=MagicMock(return_value=[['a'], ['1']])),
+            'missing': MagicMock(status_code=404, raise_for_status=MagicMock(
+                side_effect=requests.HTTPError('404 Not Found'))),
+            'busy': MagicMock(status_code=503),
+        }
+
+        def get(url, params, timeout):
+            return responses[params['q']]
+
+        fetcher = censusfetch.CensusFetcher('http://census', retries=1, backoff=0)
+        with patch('requests.Session.get', MagicMock(side_effect=get)):
+            results, report = fetcher.fetch_all(
+                [(name, {'q': name}) for name in ('ok', 'missing', 'busy')])
+
+        self.assertDictEqual(dict(results), {'ok': [['a'], ['1']]})
+        self.assertSequenceEqual(report.succeeded, ['ok'])
+        self.assertSequenceEqual(list(report.failed), ['missing', 'busy'])
+        self.assertIn('HTTP 503', report.failed['busy'])
+        # Only the server error is retried
+        self.assertEqual(report.requests, 4)
+        self.assertEqual(report.retries, 1)
+        self.assertFalse(report.complete)
+
+    def test_fetch_all_in_running_loop(self):
+        response = MagicMock(status_code=200, json=MagicMock(return_value=[['a'], ['1']]))
+        fetcher = censusfetch.CensusFetcher('http://census', backoff=0)
+        fetched = []
+        loop = asyncio.new_event_loop()
+
+        # Like a notebook cell, which runs inside the notebook's loop
+        def fetch():
+            try:
+                fetched.append(fetcher.fetch_all([('ok', {'q': 'ok'})]))
+            finally:
+                loop.stop()
+
+        try:
+            with patch('requests.Session.get', MagicMock(return_value=response)):
+                loop.call_soon(fetch)
+                loop.run_forever()
+        finally:
+            loop.close()
+        results, report = fetched[0]
+        self.assertDictEqual(dict(results), {'ok': [['a'], ['1']]})
+        self.assertTrue(report.complete)
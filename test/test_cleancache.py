@@ -0,0 +1,121 @@
+# Copyright 2017 Sidewalk Labs | https://www.apache.org/licenses/LICENSE-2.0
+
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import patch
+import pandas
+
+from doppelganger import CleanedData, DirtyDataSource, inputs, Preprocessor, PumsData
+
+try:
+    import pyarrow  # noqa: F401
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
+
+if HAS_PYARROW:
+    from doppelganger.cleancache import CleanedDataCache
+
+PERSONS_CSV = '''serialno,puma,agep,sex,wagp
+a,00106,15,1,
+b,00106,50,2,0070000
+c,00107,70,1,0015000
+'''
+
+FIELDS = [inputs.SERIAL_NUMBER.name, inputs.AGE.name, inputs.INDIVIDUAL_INCOME.name]
+
+
+@unittest.skipUnless(HAS_PYARROW, 'requires pyarrow')
+class CleanedDataCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.source_path = os.path.join(self.directory, 'persons.csv')
+        with open(self.source_path, 'w') as outfile:
+            outfile.write(PERSONS_CSV)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _source(self):
+        return PumsData(pandas.read_csv(self.source_path, dtype=str))
+
+    def test_clean(self):
+        cache = CleanedDataCache(os.path.join(self.directory, 'cache'))
+        preprocessor = Preprocessor.from_config({'individual_income': {'bins': [20000]}})
+        expected = cache.clean(self._source(), FIELDS, preprocessor, puma='00106',
+                               categorical=True, source_path=self.source_path)
+        with patch.object(PumsData, 'clean') as clean:
+            cached = cache.clean(self._source(), FIELDS, preprocessor, puma='00106',
+                                 categorical=True, source_path=self.source_path)
+            self.assertFalse(clean.called)
+        pandas.testing.assert_frame_equal(cached.data, expected.data)
+        self.assertEqual(cached.data[inputs.AGE.name].dtype.name, 'category')
+        self.assertEqual(cache.stats()['hits'], 1)
+
+        # A different puma, config or source is cleaned again
+        cache.clean(self._source(), FIELDS, preprocessor, puma='00107',
+                    source_path=self.source_path)
+        cache.clean(self._source(), FIELDS,
+                    Preprocessor.from_config({'individual_income': {'bins': [10000]}}))
+        with open(self.source_path, 'a') as outfile:
+            outfile.write('d,00106,20,2,0000000\n')
+        os.utime(self.source_path, (0, 0))
+        cleaned = cache.clean(self._source(), FIELDS, preprocessor, puma='00106',
+                              source_path=self.source_path)
+        self.assertEqual(len(cleaned.data), 3)
+        self.assertEqual(cache.stats()['misses'], 4)
+        self.assertEqual(cache.stats()['entries'], 4)
+
+    def test_clean_not_categorical(self):
+        cache = CleanedDataCache(os.path.join(self.directory, 'cache'))
+        expected = cache.clean(self._source(), FIELDS, Preprocessor(),
+                               source_path=self.source_path)
+        cached = cache.clean(self._source(), FIELDS, Preprocessor(),
+                             source_path=self.source_path)
+        self.assertEqual(cache.stats()['hits'], 1)
+        pandas.testing.assert_frame_equal(cached.data, expected.data)
+        # Missing values are read back as None
+        cache.put('missing', CleanedData(pandas.DataFrame({
+            'sex': pandas.Series(['M', None], dtype=object)})))
+        self.assertSequenceEqual(cache.get('missing').data['sex'].tolist(), ['M', None])
+
+    def test_content_hash_and_eviction(self):
+        cache = CleanedDataCache(os.path.join(self.directory, 'cache'))
+        cache.clean(self._source(), FIELDS, Preprocessor(),
+                    source_path=self.source_path, content_hash=True)
+        # The same contents hit, whatever the modification time
+        os.utime(self.source_path, (0, 0))
+        cache.clean(self._source(), FIELDS, Preprocessor(),
+                    source_path=self.source_path, content_hash=True)
+        self.assertEqual(cache.stats()['hits'], 1)
+
+        size = cache.stats()['bytes']
+        cache.max_bytes = size
+        cache.clean(self._source(), FIELDS, Preprocessor(), puma='00107')
+        self.assertEqual(cache.stats()['entries'], 1)
+        self.assertEqual(cache.stats()['evictions'], 1)
+        cache.clear()
+        self.assertEqual(cache.stats()['entries'], 0)
+        self.assertSequenceEqual(os.listdir(cache.directory), ['index.sqlite'])
+
+    def test_name_map(self):
+        cache = CleanedDataCache(os.path.join(self.directory, 'cache'))
+        data = pandas.read_csv(self.source_path, dtype=str)
+        name_map = dict(PumsData(data).name_map, age='wagp')
+        by_age = cache.clean(PumsData(data), [inputs.AGE.name], Preprocessor())
+        by_income = cache.clean(
+            DirtyDataSource(data, name_map), [inputs.AGE.name], Preprocessor())
+        # Sources with the same data but different columns do not share entries
+        self.assertEqual(cache.stats()['hits'], 0)
+        self.assertSequenceEqual(by_age.data[inputs.AGE.name].tolist(),
+                                 ['0-17', '35-64', '65+'])
+        self.assertSequenceEqual(by_income.data[inputs.AGE.name].tolist(),
+                                 [None, '65+', '65+'])
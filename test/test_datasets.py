@@ -0,0 +1,124 @@
+# Copyright 2017 Sidewalk Labs | https://www.apache.org/licenses/LICENSE-2.0
+
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import pandas
+
+from doppelganger import datasets, sinks, HouseholdAllocator, Marginals, Population
+
+try:
+    import pyarrow  # noqa: F401
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
+
+
+@unittest.skipUnless(HAS_PYARROW, 'requires pyarrow')
+class DatasetsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _households(self):
+        return pandas.DataFrame({
+            'serial_number': ['a', 'b', 'b'],
+            'tract': ['000100', '000100', '000200'],
+            'count': [1, 2, 3],
+        })
+
+    def _persons(self):
+        return pandas.DataFrame({
+            'serial_number': ['b', 'a', 'b'],
+            'age': ['35-64', '0-17', '18-34'],
+        })
+
+    def _partitions(self, path):
+        return sorted(name for name in os.listdir(path) if '=' in name)
+
+    def test_round_trip(self):
+        for format in ('parquet', 'arrow'):
+            path = self._path(format)
+            datasets.write_dataset(self._households(), path, ['tract'], format=format)
+            self.assertSequenceEqual(self._partitions(path), ['tract=000100', 'tract=000200'])
+            data = datasets.read_dataset(path, format=format)
+            self.assertSequenceEqual(list(data.columns), ['serial_number', 'tract', 'count'])
+            self.assertSequenceEqual(sorted(data['tract']), ['000100', '000100', '000200'])
+            self.assertEqual(data['count'].dtype, 'int64')
+
+    def test_read_projected_and_filtered(self):
+        path = self._path('households')
+        datasets.write_dataset(self._households(), path, ['tract'])
+        data = datasets.read_dataset(path, columns=['serial_number', 'count'],
+                                     filters={'tract': '000200'})
+        self.assertSequenceEqual(list(data.columns), ['serial_number', 'count'])
+        self.assertSequenceEqual(data['count'].tolist(), [3])
+        self.assertRaises(ValueError, datasets.read_dataset, path, format='csv')
+
+    def test_dataset_sink(self):
+        path = self._path('households')
+        datasets.write_dataset(self._households(), path, ['tract'])
+        sink = sinks.DatasetSink(path, ['tract'])
+        households = self._households()
+        sink.write(households.iloc[:1])
+        sink.write(households.iloc[1:])
+        sink.close()
+        # The old partitions are replaced, and each chunk is kept
+        data = datasets.read_dataset(path)
+        self.assertSequenceEqual(sorted(data['count']), [1, 2, 3])
+
+    def test_allocation_for_tracts(self):
+        allocator = HouseholdAllocator(self._households(), self._persons())
+        allocator.write_dataset(self._path('households'), self._path('persons'))
+        loaded = HouseholdAllocator.from_dataset(
+            self._path('households'), self._path('persons'), tracts=['000200'])
+        self.assertSequenceEqual(loaded.allocated_households['count'].tolist(), [3])
+        self.assertSequenceEqual(loaded.allocated_persons['age'].tolist(), ['35-64', '18-34'])
+        self.assertSequenceEqual(loaded.get_counts('b'), [('000200', 3)])
+
+    def test_population(self):
+        persons = pandas.DataFrame({
+            'household_id': ['000100-b-0', '000200-b-0'],
+            'tract': ['000100', '000200'],
+            'serial_number': ['b', 'b'],
+            'repeat_index': [0, 0],
+            'age': ['35-64', '35-64'],
+        })
+        households = persons.drop('age', axis=1)
+        Population(persons, households).write_dataset(
+            self._path('persons'), self._path('households'), format='arrow')
+        self.assertSequenceEqual(self._partitions(self._path('persons')),
+                                 ['tract=000100', 'tract=000200'])
+        population = Population.from_dataset(
+            self._path('persons'), self._path('households'), tracts=['000100'],
+            person_columns=['household_id', 'age'], format='arrow')
+        self.assertSequenceEqual(population.generated_people['household_id'].tolist(),
+                                 ['000100-b-0'])
+        self.assertSequenceEqual(list(population.generated_people.columns),
+                                 ['household_id', 'age'])
+        self.assertEqual(len(population.generated_households), 1)
+
+    def test_marginals(self):
+        marginals = Marginals(pandas.DataFrame({
+            'STATEFP': ['06', '06'],
+            'COUNTYFP': ['001', '075'],
+            'PUMA5CE': ['00101', '07501'],
+            'TRACTCE': ['000100', '000200'],
+            '1': ['3', '4'],
+        }))
+        marginals.write_dataset(self._path('marginals'))
+        loaded = Marginals.from_dataset(self._path('marginals'), filters={'PUMA5CE': '07501'})
+        self.assertSequenceEqual(loaded.data['COUNTYFP'].tolist(), ['075'])
+        self.assertSequenceEqual(loaded.data['1'].tolist(), [4])
@@ -4,11 +4,23 @@ from __future__ import (
     absolute_import, division, print_function, unicode_literals
 )
 
+import os
+import shutil
+import sqlite3
+import tempfile
 import unittest
+import zipfile
+
+from mock import patch
 import pandas
 
 from doppelganger import datasource, inputs, Preprocessor
 
+try:
+    import sqlalchemy
+except ImportError:
+    sqlalchemy = None
+
 
 class DataSourceTest(unittest.TestCase):
 
@@ -65,3 +77,184 @@ class DataSourceTest(unittest.TestCase):
             inputs.NUM_PEOPLE.name: '2',
         }
         self.assertDictEqual(actual, expected)
+
+    def test_clean_data_puma(self):
+        households = pandas.DataFrame(self._mock_dirty_household_input())
+        households['puma'] = ['00106', '00107', '00106']
+        cleaned = datasource.PumsData(households).clean(
+            [inputs.SERIAL_NUMBER.name, inputs.NUM_PEOPLE.name], Preprocessor(), puma='00106')
+        self.assertSequenceEqual(cleaned.data[inputs.SERIAL_NUMBER.name].tolist(), ['a', 'c'])
+
+    def test_from_csv_filtered(self):
+        directory = tempfile.mkdtemp()
+        try:
+            parts = [
+                'SERIALNO,ST,PUMA,AGEP,SEX,WAGP\n'
+                '1,06,00106,15,1,\n'
+                '2,06,00107,50,2,0070000\n'
+                '3,36,00106,70,1,0015000\n',
+                'SERIALNO,ST,PUMA,AGEP,SEX,WAGP\n'
+                '4,06,00106,25,2,0000000\n'
+                '5,6,106,35,1,0000000\n',
+            ]
+            archive_path = os.path.join(directory, 'csv_pus.zip')
+            with zipfile.ZipFile(archive_path, 'w') as archive:
+                for name, part in zip(['ss15pusa.csv', 'ss15pusb.csv'], parts):
+                    archive.writestr(name, part)
+                archive.writestr('README.pdf', 'not a csv')
+            fields = [inputs.SERIAL_NUMBER, inputs.AGE, inputs.PUMA]
+            persons = datasource.PumsData.from_csv_filtered(
+                archive_path, fields, state='06', pumas=['00106'], chunksize=2)
+            self.assertSequenceEqual(list(persons.data.columns), ['serialno', 'agep', 'puma'])
+            self.assertSequenceEqual(persons.data.values.tolist(), [
+                ['1', '15', '00106'], ['4', '25', '00106'], ['5', '35', '106']])
+            cleaned = persons.clean([inputs.SERIAL_NUMBER.name, inputs.AGE.name], Preprocessor())
+            self.assertSequenceEqual(cleaned.data[inputs.AGE.name].tolist(),
+                                     ['0-17', '18-34', '35-64'])
+
+            csv_path = os.path.join(directory, 'persons.csv')
+            with open(csv_path, 'w') as outfile:
+                outfile.write(parts[0])
+            persons = datasource.PumsData.from_csv_filtered(csv_path, fields, pumas=['00106'])
+            self.assertSequenceEqual(persons.data['serialno'].tolist(), ['1', '3'])
+            self.assertEqual(len(datasource.PumsData.from_csv_filtered(
+                csv_path, fields, pumas=['99999']).data), 0)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_from_csv_filtered_closes_archive(self):
+        directory = tempfile.mkdtemp()
+        opened = []
+        zip_file = zipfile.ZipFile
+
+        def open_archive(*args, **kwargs):
+            opened.append(zip_file(*args, **kwargs))
+            return opened[-1]
+
+        try:
+            archive_path = os.path.join(directory, 'csv_pus.zip')
+            with zipfile.ZipFile(archive_path, 'w') as archive:
+                archive.writestr('ss15pusa.csv', 'SERIALNO,PUMA\n1,00106\n2,00106\n')
+            with patch('doppelganger.datasource.zipfile.ZipFile', side_effect=open_archive):
+                datasource.PumsData.from_csv_filtered(
+                    archive_path, [inputs.SERIAL_NUMBER], pumas=['00106'])
+                # Stopping early closes it too
+                chunks = datasource._iter_pums_csv(archive_path, ['serialno'], {}, 1)
+                next(chunks)
+                chunks.close()
+            self.assertEqual(len(opened), 2)
+            for archive in opened:
+                self.assertIsNone(archive.fp)
+        finally:
+            shutil.rmtree(directory)
+
+    def _write_database(self, conn, table):
+        conn.execute('CREATE TABLE {} (SERIALNO, ST, PUMA, AGEP, SEX)'.format(table))
+        conn.executemany('INSERT INTO {} VALUES (?, ?, ?, ?, ?)'.format(table), [
+            ('3', '06', '00107', '70', '1'),
+            ('1', '06', '00106', '15', '1'),
+            ('2', '06', '00107', '50', '2'),
+            ('4', '36', '00106', '25', '2'),
+            ('5', '06', '00108', '35', '1'),
+            ('0', '06', '00106', '45', '2'),
+        ])
+        conn.commit()
+
+    def test_from_database(self):
+        conn = sqlite3.connect(':memory:')
+        conn.execute("ATTACH DATABASE ':memory:' AS import")
+        self._write_database(conn, 'import.persons')
+        persons = datasource.PumsData.from_database(
+            conn, '06', '00106', 'persons', [inputs.SERIAL_NUMBER, inputs.AGE])
+        self.assertSequenceEqual(persons.data.values.tolist(), [['0', '45'], ['1', '15']])
+        self.assertRaises(ValueError, datasource.PumsData.from_database,
+                          conn, '06', '00106', 'persons; DROP TABLE persons', [inputs.AGE])
+
+    @unittest.skipIf(sqlalchemy is None, 'requires sqlalchemy')
+    def test_from_database_sqlalchemy(self):
+        engine = sqlalchemy.create_engine('sqlite://')
+        with engine.connect() as conn:
+            self._write_database(conn.connection, 'persons')
+            for connectable in (engine, conn):
+                persons = datasource.PumsData.from_database(
+                    connectable, '06', '00106', 'persons', [inputs.SERIAL_NUMBER, inputs.AGE],
+                    schema=None)
+                self.assertSequenceEqual(persons.data.values.tolist(),
+                                         [['0', '45'], ['1', '15']])
+
+    def test_query_params(self):
+        query = datasource._pums_query('persons', None, ['AGEP'], 2, 'named')
+        self.assertEqual(query, 'SELECT AGEP FROM persons WHERE ST=:p0 AND PUMA IN (:p1, :p2) '
+                                'ORDER BY PUMA, SERIALNO')
+        self.assertDictEqual(datasource._query_params('named', ['06', '00106', '00107']),
+                             {'p0': '06', 'p1': '00106', 'p2': '00107'})
+        self.assertSequenceEqual(datasource._query_params('qmark', ('06', '00106')),
+                                 ['06', '00106'])
+
+    def test_iter_from_database(self):
+        conn = sqlite3.connect(':memory:')
+        self._write_database(conn, 'persons')
+        partitions = list(datasource.PumsData.iter_from_database(
+            conn, '06', ['00107', '00106', '00109'], 'persons',
+            [inputs.SERIAL_NUMBER, inputs.AGE], schema=None, chunksize=1))
+        self.assertSequenceEqual([puma for puma, _ in partitions], ['00106', '00107'])
+        self.assertSequenceEqual(partitions[0][1].data.values.tolist(),
+                                 [['0', '45'], ['1', '15']])
+        self.assertSequenceEqual(partitions[1][1].data['SERIALNO'].tolist(), ['2', '3'])
+
+    def test_iter_from_database_pool(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'pums.sqlite')
+            self._write_database(sqlite3.connect(path), 'persons')
+            pool = datasource.ConnectionPool(
+                lambda: sqlite3.connect(path, check_same_thread=False), size=2)
+            partitions = dict(datasource.PumsData.iter_from_database_pool(
+                pool, '06', ['00106', '00107', '00108'], 'persons',
+                [inputs.SERIAL_NUMBER, inputs.PUMA], schema=None))
+            self.assertSequenceEqual(sorted(partitions), ['00106', '00107', '00108'])
+            self.assertSequenceEqual(partitions['00108'].data.values.tolist(), [['5', '00108']])
+            self.assertLessEqual(len(pool._opened), 2)
+            # Stopping early releases the readers and their connections
+            next(datasource.PumsData.iter_from_database_pool(
+                pool, '06', ['00106', '00107', '00108'], 'persons',
+                [inputs.SERIAL_NUMBER], readers=1, schema=None))
+            with pool.connection() as conn:
+                self.assertIsNotNone(conn)
+            self.assertRaises(sqlite3.OperationalError, list,
+                              datasource.PumsData.iter_from_database_pool(
+                                  pool, '06', ['00106'], 'missing', [inputs.AGE], schema=None))
+            pool.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_clean_not_categorical_by_default(self):
+        households = pandas.DataFrame(self._mock_dirty_household_input())
+        cleaned = datasource.PumsData(households).clean(
+            [inputs.NUM_VEHICLES.name], Preprocessor())
+        self.assertNotEqual(cleaned.data[inputs.NUM_VEHICLES.name].dtype.name, 'category')
+        self.assertSequenceEqual(cleaned.data[inputs.NUM_VEHICLES.name].tolist(),
+                                 ['1', '6+', ''])
+
+    def test_clean_categorical(self):
+        households = pandas.DataFrame(self._mock_dirty_household_input())
+        households.loc[0, 'veh'] = '7'
+        cleaned = datasource.PumsData(households).clean([
+            inputs.SERIAL_NUMBER.name, inputs.NUM_PEOPLE.name, inputs.NUM_VEHICLES.name
+        ], Preprocessor(), categorical=True)
+        self.assertSequenceEqual(cleaned.vocabulary(inputs.NUM_PEOPLE.name),
+                                 ['0', '1', '2', '3', '4+'])
+        self.assertSequenceEqual(cleaned.codes(inputs.NUM_PEOPLE.name).tolist(), [1, 2, 1])
+        # Values that are not possible are kept, and missing values stay missing
+        self.assertSequenceEqual(cleaned.vocabulary(inputs.NUM_VEHICLES.name),
+                                 ['0', '1', '2', '3', '4', '5', '6+', '7'])
+        self.assertSequenceEqual(cleaned.codes(inputs.NUM_VEHICLES.name).tolist(), [7, 6, -1])
+        self.assertNotEqual(cleaned.data[inputs.SERIAL_NUMBER.name].dtype.name, 'category')
+
+        # Numbers read back from csv share the same vocabulary
+        cleaned = datasource.CleanedData(pandas.DataFrame({'num_people': [3, 1]})).categorize()
+        self.assertSequenceEqual(cleaned.codes('num_people').tolist(), [3, 1])
+        binned = datasource.CleanedData(pandas.DataFrame({'individual_income': ['40000+']}))
+        preprocessor = Preprocessor.from_config({'individual_income': {'bins': [10000, 40000]}})
+        self.assertSequenceEqual(binned.categorize(preprocessor).vocabulary('individual_income'),
+                                 ['<=10000', '10000-40000', '40000+'])
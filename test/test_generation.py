@@ -4,12 +4,14 @@ from __future__ import (
     absolute_import, division, print_function, unicode_literals
 )
 
-from mock import MagicMock, patch
+from mock import ANY, MagicMock, patch
 
 import unittest
+import numpy
 import pandas
 
-from doppelganger import inputs, Population, HouseholdAllocator
+from doppelganger import bayesnets, inputs, LazyPopulation, Population, HouseholdAllocator
+from doppelganger.populationgen import HouseholdIdEncoder
 
 
 class TestPopulationGen(unittest.TestCase):
@@ -83,6 +85,91 @@ class TestPopulationGen(unittest.TestCase):
             'one_bucket', evidence, count=2)
         self._check_person_output(population.generated_people)
 
+    def test_generate_persons_vectorized_segmenter(self):
+        person_model = self._mock_model(
+            [inputs.AGE.name, inputs.SEX.name],
+            generated=[('35-64', 'F'), ('35-64', 'F')]
+        )
+        person_model.segmenter = bayesnets.vectorized_segmenter(
+            MagicMock(return_value=['one_bucket', 'other_bucket']))
+        allocations = self._mock_allocated()
+        population = Population.generate(
+            allocations, person_model, MagicMock())
+
+        person_model.segmenter.assert_called_once_with(allocations.allocated_persons)
+        evidence = ((inputs.AGE.name, '35-64'), (inputs.SEX.name, 'M'))
+        person_model.generate.assert_called_with(
+            'other_bucket', evidence, count=2)
+        self._check_person_output(population.generated_people)
+
+    def test_generate_seeded(self):
+        def generated_draws(seed):
+            person_model = self._mock_model(
+                [inputs.AGE.name, inputs.SEX.name],
+                generated=[('35-64', 'F'), ('35-64', 'F')]
+            )
+            Population.generate(self._mock_allocated(), person_model, MagicMock(), seed=seed)
+            # One stream per (tract, segment, evidence)
+            streams = [call[1]['random_state'] for call in person_model.generate.call_args_list]
+            self.assertEqual(len(streams), 4)
+            self.assertEqual(len(set(id(stream) for stream in streams)), 4)
+            return [stream.random() for stream in streams]
+
+        self.assertSequenceEqual(generated_draws(3), generated_draws(3))
+        self.assertNotEqual(generated_draws(3), generated_draws(4))
+
+    def test_generate_by_tract(self):
+        person_model = self._mock_model(
+            [inputs.AGE.name, inputs.SEX.name],
+            generated=[('35-64', 'F'), ('35-64', 'F')]
+        )
+        household_model = self._mock_model([inputs.NUM_PEOPLE.name], generated=[('6+',), ('6+',)])
+        tracts = Population.generate_by_tract(
+            self._mock_allocated(), person_model, household_model, seed=0, processes=1)
+        tract_to_population = dict(tracts)
+        self.assertSetEqual(set(tract_to_population), {'tract1', 'tract2'})
+        persons = tract_to_population['tract1'].generated_people
+        self.assertSequenceEqual(persons[inputs.TRACT.name].tolist(), ['tract1'] * 4)
+        self.assertSequenceEqual(persons[inputs.REPEAT_INDEX.name].tolist(), [0, 1, 0, 1])
+        households = tract_to_population['tract2'].generated_households
+        self.assertSequenceEqual(households[inputs.HOUSEHOLD_ID.name].tolist(),
+                                 ['tract2-b-0', 'tract2-b-1'])
+
+    def test_generate_parallel(self):
+        person_model = self._mock_model(
+            [inputs.AGE.name, inputs.SEX.name],
+            generated=[('35-64', 'F'), ('35-64', 'F')]
+        )
+        household_model = self._mock_model([inputs.NUM_PEOPLE.name], generated=[('6+',), ('6+',)])
+        serial = Population.generate(
+            self._mock_allocated(), person_model, household_model, seed=0, processes=1)
+        parallel = Population.generate(
+            self._mock_allocated(), person_model, household_model, seed=0, processes=2)
+        pandas.testing.assert_frame_equal(serial.generated_people, parallel.generated_people)
+        pandas.testing.assert_frame_equal(
+            serial.generated_households, parallel.generated_households)
+        self.assertSequenceEqual(
+            parallel.generated_people[inputs.TRACT.name].tolist(),
+            ['tract1'] * 4 + ['tract2'] * 4
+        )
+
+    def test_generate_persons_grouped_by_evidence(self):
+        person_model = self._mock_model([inputs.AGE.name, inputs.SEX.name], generated=None)
+        person_model.generate = MagicMock(
+            side_effect=lambda segment, evidence, count: [('35-64', 'M')] * count)
+        allocations = self._mock_allocated()
+        allocations.allocated_persons = pandas.DataFrame([
+            {'serial_number': 'b', 'age': '35-64', 'sex': 'M'},
+            {'serial_number': 'b', 'age': '35-64', 'sex': 'M'},
+        ])
+        population = Population.generate(allocations, person_model, MagicMock())
+
+        # One call per tract for both persons
+        evidence = ((inputs.AGE.name, '35-64'), (inputs.SEX.name, 'M'))
+        self.assertEqual(person_model.generate.call_count, 2)
+        person_model.generate.assert_called_with('one_bucket', evidence, count=4)
+        self._check_person_output(population.generated_people)
+
     def test_generate_households_simple(self):
         household_model = self._mock_model(
             [inputs.NUM_PEOPLE.name],
@@ -100,6 +187,150 @@ class TestPopulationGen(unittest.TestCase):
         self.assertIn(inputs.NUM_PEOPLE.name, population.generated_households)
         self._check_household_output(population.generated_households)
 
+    def test_generate_chunks(self):
+        person_model = self._mock_model(
+            [inputs.AGE.name, inputs.SEX.name],
+            generated=[('35-64', 'F'), ('35-64', 'F')]
+        )
+        household_model = self._mock_model([inputs.NUM_PEOPLE.name], generated=[('6+',), ('6+',)])
+        chunks = list(Population.generate_chunks(
+            self._mock_allocated(), person_model, household_model, chunk_size=3))
+        self.assertSequenceEqual(
+            [(name, len(chunk)) for name, chunk in chunks],
+            [('persons', 3), ('persons', 3), ('persons', 2), ('households', 3),
+             ('households', 1)]
+        )
+        persons = pandas.concat([chunk for name, chunk in chunks if name == 'persons'])
+        self.assertSequenceEqual(persons.index.tolist(), list(range(8)))
+        self._check_person_output(persons)
+        households = pandas.concat([chunk for name, chunk in chunks if name == 'households'])
+        self._check_household_output(households)
+
+    def test_generate_to(self):
+        person_model = self._mock_model(
+            [inputs.AGE.name, inputs.SEX.name],
+            generated=[('35-64', 'F'), ('35-64', 'F')]
+        )
+        household_model = self._mock_model([inputs.NUM_PEOPLE.name], generated=[('6+',), ('6+',)])
+        persons_sink = MagicMock()
+        households_sink = MagicMock()
+        Population.generate_to(self._mock_allocated(), person_model, household_model,
+                               persons_sink, households_sink, chunk_size=5)
+        self.assertEqual(persons_sink.write.call_count, 2)
+        self.assertEqual(households_sink.write.call_count, 1)
+        persons_sink.close.assert_called_once_with()
+        households_sink.close.assert_called_once_with()
+        self._check_household_output(households_sink.write.call_args[0][0])
+
+    def test_lazy_population(self):
+        person_model = self._mock_model(
+            [inputs.AGE.name, inputs.SEX.name],
+            generated=[('35-64', 'F'), ('35-64', 'F')]
+        )
+        household_model = self._mock_model([inputs.NUM_PEOPLE.name], generated=[('6+',), ('6+',)])
+        population = LazyPopulation(
+            self._mock_allocated(), person_model, household_model, seed=0, cache_size=1)
+        self.assertSequenceEqual(population.tracts, ['tract1', 'tract2'])
+        self.assertIn('tract2', population)
+        self.assertRaises(KeyError, population.__getitem__, 'tract3')
+
+        tract2 = population['tract2']
+        # Only the requested tract is generated
+        self.assertEqual(person_model.generate.call_count, 2)
+        self.assertSequenceEqual(tract2.generated_households[inputs.HOUSEHOLD_ID.name].tolist(),
+                                 ['tract2-b-0', 'tract2-b-1'])
+        self.assertIs(population['tract2'], tract2)
+        self.assertEqual(person_model.generate.call_count, 2)
+
+        population['tract1']
+        self.assertSequenceEqual(list(population.cache), ['tract1'])
+        regenerated = population['tract2']
+        self.assertIsNot(regenerated, tract2)
+        self.assertEqual(
+            [call[1]['random_state'].random() for call in person_model.generate.call_args_list[:2]],
+            [call[1]['random_state'].random() for call in person_model.generate.call_args_list[4:]]
+        )
+        combined = population.get(['tract1', 'tract2'])
+        self.assertSequenceEqual(combined.generated_people[inputs.TRACT.name].tolist(),
+                                 ['tract1'] * 4 + ['tract2'] * 4)
+
+    def _mock_batch_model(self, fields, vocabulary):
+        model = self._mock_model(fields, generated=None)
+        model.vocabulary = MagicMock(return_value=vocabulary)
+        model.generate_batch = MagicMock(
+            side_effect=lambda segments, evidence, counts, evidence_fields=None,
+            random_state=None: (numpy.zeros((sum(counts), len(fields)), dtype=numpy.int8),
+                                vocabulary))
+        return model
+
+    def test_generate_compact(self):
+        person_model = self._mock_batch_model(
+            [inputs.AGE.name, inputs.SEX.name], [['35-64'], ['F', 'M']])
+        household_model = self._mock_batch_model([inputs.NUM_PEOPLE.name], [['6+']])
+        population = Population.generate(
+            self._mock_allocated(), person_model, household_model, seed=0, compact=True)
+
+        persons = population.generated_people
+        households = population.generated_households
+        self.assertEqual(persons[inputs.HOUSEHOLD_ID.name].dtype, numpy.int64)
+        self.assertEqual(persons[inputs.AGE.name].dtype.name, 'category')
+        self.assertEqual(persons[inputs.TRACT.name].dtype.name, 'category')
+        self.assertSetEqual(set(persons[inputs.HOUSEHOLD_ID.name]),
+                            set(households[inputs.HOUSEHOLD_ID.name]))
+        self.assertEqual(len(set(households[inputs.HOUSEHOLD_ID.name])), 4)
+        person_model.generate_batch.assert_called_with(
+            ['one_bucket'], [('35-64', 'M')], [2],
+            evidence_fields=[inputs.AGE.name, inputs.SEX.name], random_state=ANY)
+
+        rendered = population.with_string_household_ids()
+        self._check_person_output(rendered.generated_people)
+        self._check_household_output(rendered.generated_households)
+
+    def test_generate_joint(self):
+        person_model = self._mock_batch_model(
+            [inputs.AGE.name, inputs.SEX.name], [['35-64'], ['F', 'M']])
+        # Keep the evidence's sex
+        person_model.generate_batch.side_effect = (
+            lambda segments, evidence, counts, evidence_fields=None, random_state=None: (
+                numpy.array([[0, ['F', 'M'].index(evidence[0][1])]] * counts[0]), None))
+        household_model = self._mock_batch_model([inputs.NUM_PEOPLE.name], [['6+']])
+        allocations = self._mock_allocated()
+        allocations.allocated_persons = pandas.concat([
+            allocations.allocated_persons,
+            pandas.DataFrame([{'serial_number': 'unallocated', 'age': '0-17', 'sex': 'F'}])
+        ], ignore_index=True)
+        population = Population.generate(
+            allocations, person_model, household_model, seed=0, joint=True)
+
+        persons = population.generated_people
+        households = population.generated_households
+        self.assertEqual(len(households), 4)
+        self.assertEqual(households[inputs.HOUSEHOLD_ID.name].nunique(), 4)
+        # Persons are grouped by household, in member order
+        self.assertSequenceEqual(persons[inputs.HOUSEHOLD_ID.name].tolist(), numpy.repeat(
+            households[inputs.HOUSEHOLD_ID.name].values, 2).tolist())
+        self.assertSequenceEqual(persons[inputs.SEX.name].tolist(), ['F', 'M'] * 4)
+        self.assertSequenceEqual(persons[inputs.REPEAT_INDEX.name].tolist(),
+                                 [0, 0, 1, 1, 0, 0, 1, 1])
+        self.assertSequenceEqual(
+            population.with_string_household_ids().generated_people[
+                inputs.HOUSEHOLD_ID.name].tolist()[:3],
+            ['tract1-b-0', 'tract1-b-0', 'tract1-b-1'])
+        self.assertEqual(person_model.generate_batch.call_count, 4)
+        self.assertEqual(household_model.generate_batch.call_count, 2)
+
+    def test_household_id_encoder(self):
+        encoder = HouseholdIdEncoder.from_allocator(self._mock_allocated())
+        self.assertSequenceEqual(encoder.tracts.tolist(), ['tract1', 'tract2'])
+        ids = encoder.encode(encoder.tract_indexes(['tract2', 'tract1']),
+                             encoder.household_indexes(['b', 'b']), [3, 0])
+        self.assertEqual(len(set(ids)), 2)
+        tract_indexes, household_indexes, repeat_indexes = encoder.decode(ids)
+        self.assertSequenceEqual(tract_indexes.tolist(), [1, 0])
+        self.assertSequenceEqual(household_indexes.tolist(), [0, 0])
+        self.assertSequenceEqual(repeat_indexes.tolist(), [3, 0])
+        self.assertRaises(ValueError, encoder.tract_indexes, ['tract3'])
+
     def test_read_from_file(self):
         read_csv = MagicMock(return_value=pandas.DataFrame())
         with patch('pandas.read_csv', read_csv):
@@ -0,0 +1,39 @@
+# Copyright 2017 Sidewalk Labs | https://www.apache.org/licenses/LICENSE-2.0
+
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import patch
+
+from doppelganger import hashing, Preprocessor
+
+
+class HashingTest(unittest.TestCase):
+
+    def test_file_digest(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'data.bin')
+            with open(path, 'wb') as outfile:
+                outfile.write(b'doppelganger' * 10)
+            # Hashed a few bytes at a time, like the whole file at once
+            with patch('doppelganger.hashing.HASH_BLOCK_SIZE', 7):
+                self.assertEqual(hashing.file_digest(path),
+                                 hashlib.sha256(b'doppelganger' * 10).hexdigest())
+        finally:
+            shutil.rmtree(directory)
+
+    def test_callable_name(self):
+        self.assertEqual(hashing.callable_name(hashing.file_digest),
+                         'doppelganger.hashing.file_digest')
+        self.assertEqual(hashing.callable_name(Preprocessor),
+                         'doppelganger.preprocessing.Preprocessor')
+        self.assertEqual(hashing.callable_name(Preprocessor()),
+                         'doppelganger.preprocessing.Preprocessor')
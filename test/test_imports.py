@@ -0,0 +1,69 @@
+# Copyright 2017 Sidewalk Labs | https://www.apache.org/licenses/LICENSE-2.0
+
+"""Checks and a benchmark of what importing doppelganger costs.
+
+Run as a script to print the import time of each entry point:
+
+    python test/test_imports.py
+"""
+
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+
+import os
+import subprocess
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Dependencies that only some code paths need
+HEAVY_MODULES = ('cvxpy', 'pomegranate', 'requests')
+
+# Statements to benchmark, from the package alone to its heaviest entry points
+BENCHMARKS = (
+    'import doppelganger',
+    'from doppelganger import Population',
+    'from doppelganger import Marginals',
+    'from doppelganger import HouseholdAllocator',
+)
+
+
+def _run(statement):
+    """Run python code in a fresh interpreter and return its output."""
+    return subprocess.check_output(
+        [sys.executable, '-c', statement], cwd=ROOT).decode('utf-8').strip()
+
+
+def _loaded_modules(statement):
+    """Heavy modules loaded by the statement, in a fresh interpreter."""
+    output = _run('import sys\n{}\nprint(",".join(m for m in {!r} if m in sys.modules))'.format(
+        statement, HEAVY_MODULES))
+    return [module for module in output.split(',') if module]
+
+
+def import_time(statement, repeat=5):
+    """Best time in seconds to run the statement in a fresh interpreter."""
+    code = 'import time\nstart = time.time()\n{}\nprint(time.time() - start)'.format(statement)
+    return min(float(_run(code)) for _ in range(repeat))
+
+
+@unittest.skipIf(sys.version_info < (3, 7), 'imports are lazy from python 3.7')
+class ImportTest(unittest.TestCase):
+
+    def test_import_is_lazy(self):
+        self.assertSequenceEqual(_loaded_modules('import doppelganger'), [])
+        self.assertSequenceEqual(
+            _loaded_modules('from doppelganger import Population, inputs'), [])
+
+    def test_public_names(self):
+        output = _run('import doppelganger\nfrom doppelganger import *\n'
+                      'print(all(name in dir(doppelganger) for name in doppelganger.__all__))\n'
+                      'print(PumsData.__name__)')
+        self.assertSequenceEqual(output.split(), ['True', 'PumsData'])
+
+
+if __name__ == '__main__':
+    for statement in BENCHMARKS:
+        print('{:50} {:.3f}s'.format(statement, import_time(statement)))
@@ -4,10 +4,55 @@ from __future__ import (
     absolute_import, division, print_function, unicode_literals
 )
 
+import gzip
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
 import unittest
 from mock import patch
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from six.moves.urllib.parse import parse_qs, urlparse
 
-from doppelganger import Marginals
+import pandas
+
+from doppelganger import Marginals, PumaTractMapping
+from doppelganger.censuscache import CensusCache
+
+
+class StubCensusHandler(BaseHTTPRequestHandler):
+    """Answers ACS queries for tracts 000100 and 000200, whose fields are all
+    1 and 2.  County 999 always fails, county 998 fails the first time
+    each query is made, and the fields of county 997 are null."""
+
+    queries = []
+
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)
+        StubCensusHandler.queries.append(query)
+        state, county = [part.split(':')[1] for part in query['in'][0].split(' ')]
+        tract_key = query['for'][0].split(':')[1]
+        if county == '999' or (county == '998' and StubCensusHandler.queries.count(query) == 1):
+            self.send_response(500)
+            self.end_headers()
+            return
+        fields = query['get'][0].split(',')
+        rows = [fields + ['state', 'county', 'tract']] + [
+            [None if county == '997' else value] * len(fields) + [state, county, tract]
+            for value, tract in (('1', '000100'), ('2', '000200'))
+            if tract_key in ('*', tract)
+        ]
+        body = json.dumps(rows).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
 
 
 class MarginalsTest(unittest.TestCase):
@@ -78,6 +123,135 @@ class MarginalsTest(unittest.TestCase):
         result = marg.data.loc[0].to_dict()
         self.assertDictEqual(result, expected)
 
+    def _start_stub_server(self):
+        server = HTTPServer(('127.0.0.1', 0), StubCensusHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        StubCensusHandler.queries = []
+        return server
+
+    def _stop_stub_server(self, server):
+        server.shutdown()
+        server.server_close()
+
+    def test_fetch_marginals_by_county(self):
+        server = self._start_stub_server()
+        mappings = [
+            {'STATEFP': '06', 'COUNTYFP': '075', 'PUMA5CE': '07507', 'TRACTCE': '000200'},
+            {'STATEFP': '06', 'COUNTYFP': '075', 'PUMA5CE': '07507', 'TRACTCE': '000100'},
+            {'STATEFP': '06', 'COUNTYFP': '075', 'PUMA5CE': '07508', 'TRACTCE': '000300'},
+            {'STATEFP': '06', 'COUNTYFP': '999', 'PUMA5CE': '07507', 'TRACTCE': '000100'},
+        ]
+        try:
+            marg = Marginals.from_census_data_by_county(
+                mappings, census_key='key', state='06', pumas={'07507'},
+                api_url='http://127.0.0.1:{}/data'.format(server.server_address[1]))
+        finally:
+            self._stop_stub_server(server)
+
+        # One request per county and control category
+        self.assertEqual(len(StubCensusHandler.queries), 3)
+        self.assertEqual(StubCensusHandler.queries[0]['for'], ['tract:*'])
+        self.assertSequenceEqual(marg.data['TRACTCE'].tolist(), ['000200', '000100'])
+        self.assertDictEqual(marg.data.loc[1].to_dict(), {
+            'STATEFP': '06',
+            'COUNTYFP': '075',
+            'PUMA5CE': '07507',
+            'TRACTCE': '000100',
+            '0-17': '8',
+            '18-34': '12',
+            '65+': '12',
+            '35-64': '14',
+            'count': '13',
+            '1': '1',
+            '3': '2',
+            '2': '2',
+            '4+': '8'
+        })
+        self.assertEqual(marg.data.loc[0, 'count'], '26')
+
+    def test_fetch_marginals_by_county_invalid(self):
+        mappings = [
+            {'STATEFP': '06', 'COUNTYFP': '075', 'PUMA5CE': '07507', 'TRACTCE': '000100'},
+            {'STATEFP': '06', 'COUNTYFP': '997', 'PUMA5CE': '07507', 'TRACTCE': '000200'},
+        ]
+        for state, pumas in ((None, {'07507'}), ('06', None), ('06', {'07507', '99999'})):
+            with self.assertRaises(ValueError):
+                Marginals.from_census_data_by_county(mappings, 'key', state, pumas)
+
+        server = self._start_stub_server()
+        try:
+            with patch('doppelganger.marginals.logging') as mock_logging:
+                marg = Marginals.from_census_data_by_county(
+                    mappings, 'key', '06', {'07507'},
+                    api_url='http://127.0.0.1:{}/data'.format(server.server_address[1]))
+        finally:
+            self._stop_stub_server(server)
+        # The county with null fields is skipped, naming its tracts
+        self.assertSequenceEqual(marg.data['COUNTYFP'].tolist(), ['075'])
+        warning = mock_logging.warning.call_args[0][0]
+        self.assertIn('997', warning)
+        self.assertIn('000200', warning)
+
+    def test_fetch_marginals_cached(self):
+        server = self._start_stub_server()
+        mappings = [
+            {'STATEFP': '06', 'COUNTYFP': '075', 'PUMA5CE': '07507', 'TRACTCE': '000100'},
+        ]
+        api_url = 'http://127.0.0.1:{}/data'.format(server.server_address[1])
+        cache = CensusCache(':memory:')
+        try:
+            first = Marginals.from_census_data_by_county(
+                mappings, 'key', '06', {'07507'}, api_url=api_url, cache=cache)
+            self.assertEqual(len(StubCensusHandler.queries), 2)
+            cache.offline = True
+            second = Marginals.from_census_data_by_county(
+                mappings, 'other key', '06', {'07507'}, api_url=api_url, cache=cache)
+            # Everything is read from the cache
+            self.assertEqual(len(StubCensusHandler.queries), 2)
+            pandas.testing.assert_frame_equal(first.data, second.data)
+            self.assertEqual(cache.stats()['hits'], 2)
+            if sys.version_info >= (3, 5):
+                concurrent = Marginals.from_census_data_concurrent(
+                    mappings, 'key', '06', {'07507'}, by_county=True, api_url=api_url,
+                    cache=cache)
+                pandas.testing.assert_frame_equal(first.data, concurrent.data)
+                self.assertEqual(concurrent.fetch_report.cached, 2)
+            # Offline, uncached counties are skipped
+            cache.clear()
+            self.assertEqual(len(Marginals.from_census_data_by_county(
+                mappings, 'key', '06', {'07507'}, api_url=api_url, cache=cache).data), 0)
+            self.assertEqual(len(StubCensusHandler.queries), 2)
+        finally:
+            self._stop_stub_server(server)
+
+    @unittest.skipIf(sys.version_info < (3, 5), 'requires asyncio')
+    def test_fetch_marginals_concurrent(self):
+        server = self._start_stub_server()
+        mappings = [
+            {'STATEFP': '06', 'COUNTYFP': '075', 'PUMA5CE': '07507', 'TRACTCE': '000200'},
+            {'STATEFP': '06', 'COUNTYFP': '998', 'PUMA5CE': '07507', 'TRACTCE': '000100'},
+            {'STATEFP': '06', 'COUNTYFP': '999', 'PUMA5CE': '07507', 'TRACTCE': '000100'},
+        ]
+        try:
+            for by_county in (False, True):
+                marg = Marginals.from_census_data_concurrent(
+                    mappings, census_key='key', state='06', pumas={'07507'},
+                    by_county=by_county, concurrency=4, rate=1000, retries=2, backoff=0.001,
+                    api_url='http://127.0.0.1:{}/data'.format(server.server_address[1]))
+                self.assertSequenceEqual(marg.data['COUNTYFP'].tolist(), ['075', '998'])
+                self.assertSequenceEqual(marg.data['count'].tolist(), ['26', '13'])
+                report = marg.fetch_report
+                # County 999 fails for each control category
+                self.assertSequenceEqual(
+                    [unit for unit, _ in report.failed], [('999', '000100'), ('999', '000100')]
+                    if not by_county else [('999', '*'), ('999', '*')])
+                self.assertEqual(len(report.succeeded), 4)
+                self.assertEqual(report.retries, 2 + 2 * 2)
+        finally:
+            self._stop_stub_server(server)
+
     def _mock_marginals_csv():
         return [{
             'STATEFP': '06',
@@ -95,3 +269,47 @@ class MarginalsTest(unittest.TestCase):
             '1': '80',
             '2+': '90',
         }]
+
+    def test_from_summary_files(self):
+        directory = tempfile.mkdtemp()
+        try:
+            hh_columns = ['B11016_E{:03d}'.format(i) for i in range(1, 17)]
+            with open(os.path.join(directory, 'b11016.dat'), 'w') as outfile:
+                outfile.write('|'.join(['GEO_ID', 'NAME'] + hh_columns) + '\n')
+                for geo_id, value in (('0500000US06075', '9'), ('1400000US06075000100', '1'),
+                                      ('1400000US06075000200', '2'),
+                                      ('1400000US06075000300', '3')):
+                    outfile.write('|'.join([geo_id, 'name'] + [value] * 16) + '\n')
+            # API style names, compressed, and a mapped tract with no estimates
+            age_columns = ['B01001_{:03d}E'.format(i) for i in range(1, 50)]
+            with gzip.open(os.path.join(directory, 'b01001.dat.gz'), 'wt') as outfile:
+                outfile.write('|'.join(['GEO_ID'] + age_columns) + '\n')
+                for geo_id in ('1400000US06075000200', '1400000US06075000100'):
+                    outfile.write('|'.join([geo_id] + ['1'] * 49) + '\n')
+            mapping = PumaTractMapping(pandas.DataFrame({
+                'STATEFP': ['06', '06', '06', '06'],
+                'COUNTYFP': ['075', '075', '075', '075'],
+                'PUMA5CE': ['07507', '07507', '07501', '07507'],
+                'TRACTCE': ['000100', '000200', '000300', '000400'],
+            }))
+            table_files = {
+                'B11016': os.path.join(directory, 'b11016.dat'),
+                'B01001': os.path.join(directory, 'b01001.dat.gz'),
+            }
+            marginals = Marginals.from_summary_files(
+                table_files, mapping, state='06', pumas=['07507'], chunksize=2)
+            data = marginals.data.set_index('TRACTCE')
+            self.assertSequenceEqual(data.index.tolist(), ['000100', '000200'])
+            self.assertDictEqual(data.loc['000100'].to_dict(), {
+                'STATEFP': '06', 'COUNTYFP': '075', 'PUMA5CE': '07507',
+                'count': '13', '1': '1', '2': '2', '3': '2', '4+': '8',
+                '0-17': '8', '18-34': '12', '35-64': '14', '65+': '12',
+            })
+            self.assertEqual(data.loc['000200', 'count'], '26')
+            self.assertEqual(data.loc['000200', '0-17'], '8')
+
+            self.assertEqual(len(Marginals.from_summary_files(table_files, mapping).data), 2)
+            del table_files['B01001']
+            self.assertRaises(ValueError, Marginals.from_summary_files, table_files, mapping)
+        finally:
+            shutil.rmtree(directory)
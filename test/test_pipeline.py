@@ -0,0 +1,269 @@
+# Copyright 2017 Sidewalk Labs | https://www.apache.org/licenses/LICENSE-2.0
+
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+
+import json
+from multiprocessing import Pool
+import os
+import shutil
+import tempfile
+import unittest
+
+import pandas
+
+from doppelganger.pipeline import build_pipeline, Pipeline, Stage
+
+SAMPLE_DATA = os.path.join(os.path.dirname(__file__), '..', 'examples', 'sample_data')
+
+
+def _count_run(options, name):
+    """Count runs of a stage in a file, which works across processes."""
+    with open(os.path.join(options['counts'], name), 'a') as outfile:
+        outfile.write('.')
+
+
+def read_stage(inputs, params, options, output_directory):
+    _count_run(options, 'read')
+    with open(inputs['source']) as infile:
+        text = infile.read()
+    with open(os.path.join(output_directory, 'read.txt'), 'w') as outfile:
+        outfile.write(text * params['repeat'])
+
+
+def upper_stage(inputs, params, options, output_directory):
+    _count_run(options, 'upper')
+    with open(os.path.join(inputs['read'], 'read.txt')) as infile:
+        text = infile.read()
+    with open(os.path.join(output_directory, 'upper.txt'), 'w') as outfile:
+        outfile.write(text.upper())
+
+
+def length_stage(inputs, params, options, output_directory):
+    _count_run(options, 'length')
+    if options.get('fail'):
+        raise RuntimeError('crash')
+    with open(os.path.join(inputs['read'], 'read.txt')) as infile:
+        text = infile.read()
+    with open(os.path.join(output_directory, 'length.txt'), 'w') as outfile:
+        outfile.write(str(len(text)))
+
+
+def join_stage(inputs, params, options, output_directory):
+    _count_run(options, 'join')
+    with open(os.path.join(inputs['upper'], 'upper.txt')) as infile:
+        upper = infile.read()
+    with open(os.path.join(inputs['length'], 'length.txt')) as infile:
+        length = infile.read()
+    with open(os.path.join(output_directory, 'join.txt'), 'w') as outfile:
+        outfile.write('{} {}'.format(upper, length))
+
+
+def _square(number):
+    return number * number
+
+
+def pool_stage(inputs, params, options, output_directory):
+    # Like generation, which starts a pool of its own
+    pool = Pool(options['processes'])
+    try:
+        squares = pool.map(_square, range(4))
+    finally:
+        pool.close()
+        pool.join()
+    with open(os.path.join(output_directory, 'squares.txt'), 'w') as outfile:
+        outfile.write(str(squares))
+
+
+class PipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.source = os.path.join(self.directory, 'source.txt')
+        self._write_source('ab')
+        os.makedirs(os.path.join(self.directory, 'counts'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _write_source(self, text):
+        with open(self.source, 'w') as outfile:
+            outfile.write(text)
+
+    def _pipeline(self, repeat=2, fail=False):
+        counts = os.path.join(self.directory, 'counts')
+        # Stages are listed out of order on purpose
+        return Pipeline(os.path.join(self.directory, 'artifacts'), [
+            Stage('join', join_stage, depends_on=['upper', 'length'],
+                  options={'counts': counts}),
+            Stage('upper', upper_stage, depends_on=['read'], options={'counts': counts}),
+            Stage('length', length_stage, depends_on=['read'],
+                  options={'counts': counts, 'fail': fail}),
+            Stage('read', read_stage, files={'source': self.source},
+                  params={'repeat': repeat}, options={'counts': counts}),
+        ])
+
+    def _counts(self):
+        counts = os.path.join(self.directory, 'counts')
+        return {name: len(open(os.path.join(counts, name)).read())
+                for name in os.listdir(counts)}
+
+    def _result(self, artifacts):
+        with open(os.path.join(artifacts['join'], 'join.txt')) as infile:
+            return infile.read()
+
+    def test_run(self):
+        pipeline = self._pipeline()
+        artifacts = pipeline.run()
+        self.assertEqual(self._result(artifacts), 'ABAB 4')
+        self.assertEqual(list(artifacts)[0], 'read')
+        self.assertEqual(list(artifacts)[-1], 'join')
+        self.assertEqual(set(pipeline.last_run.values()), {'ran'})
+
+    def test_skip_up_to_date(self):
+        self._pipeline().run()
+        pipeline = self._pipeline()
+        artifacts = pipeline.run()
+        self.assertEqual(self._result(artifacts), 'ABAB 4')
+        self.assertEqual(set(pipeline.last_run.values()), {'skipped'})
+        self.assertEqual(self._counts(), {'read': 1, 'upper': 1, 'length': 1, 'join': 1})
+
+    def test_rerun_changed_inputs(self):
+        self._pipeline().run()
+        pipeline = self._pipeline(repeat=3)
+        self.assertEqual(self._result(pipeline.run()), 'ABABAB 6')
+        self.assertEqual(set(pipeline.last_run.values()), {'ran'})
+
+        self._write_source('ba')
+        self.assertEqual(self._result(pipeline.run()), 'BABABA 6')
+
+    def test_skip_unchanged_artifacts(self):
+        # Changed inputs that give the same artifacts do not rerun what
+        # depends on them
+        self._pipeline().run()
+        self._write_source('abab')
+        pipeline = self._pipeline(repeat=1)
+        pipeline.run()
+        self.assertEqual(pipeline.last_run['read'], 'ran')
+        self.assertEqual(pipeline.last_run['upper'], 'skipped')
+        self.assertEqual(pipeline.last_run['join'], 'skipped')
+
+    def test_resume(self):
+        with self.assertRaises(RuntimeError):
+            self._pipeline(fail=True).run()
+        pipeline = self._pipeline()
+        self.assertEqual(self._result(pipeline.run()), 'ABAB 4')
+        self.assertEqual(pipeline.last_run['read'], 'skipped')
+        self.assertEqual(pipeline.last_run['length'], 'ran')
+        self.assertEqual(self._counts()['read'], 1)
+        self.assertEqual(self._counts()['length'], 2)
+        # The failed attempt left nothing behind
+        self.assertEqual(len(os.listdir(os.path.join(self.directory, 'artifacts', 'length'))), 1)
+
+    def test_targets_and_force(self):
+        pipeline = self._pipeline()
+        artifacts = pipeline.run(targets=['upper'])
+        self.assertEqual(list(artifacts), ['read', 'upper'])
+        pipeline.run(targets=['upper'], force=['upper'])
+        self.assertEqual(pipeline.last_run, {'read': 'skipped', 'upper': 'ran'})
+
+    def test_parallel(self):
+        pipeline = self._pipeline()
+        self.assertEqual(self._result(pipeline.run(processes=2)), 'ABAB 4')
+        self.assertEqual(set(pipeline.last_run.values()), {'ran'})
+        with self.assertRaises(RuntimeError):
+            self._pipeline(repeat=3, fail=True).run(processes=2)
+
+    def test_parallel_stage_with_pool(self):
+        pipeline = Pipeline(os.path.join(self.directory, 'artifacts'), [
+            Stage('squares', pool_stage, options={'processes': 2}),
+            Stage('read', read_stage, files={'source': self.source}, params={'repeat': 1},
+                  options={'counts': os.path.join(self.directory, 'counts')}),
+        ])
+        artifacts = pipeline.run(processes=2)
+        with open(os.path.join(artifacts['squares'], 'squares.txt')) as infile:
+            self.assertEqual(infile.read(), '[0, 1, 4, 9]')
+
+    def _temporary_directories(self):
+        return [name for _, directories, _ in os.walk(os.path.join(self.directory, 'artifacts'))
+                for name in directories if '.tmp-' in name]
+
+    def test_failures_leave_no_temporary_directories(self):
+        for processes in (1, 2):
+            with self.assertRaises(RuntimeError):
+                self._pipeline(fail=True).run(processes=processes)
+            self.assertEqual(self._temporary_directories(), [])
+
+        # What a killed run left behind is removed when the stage runs again
+        artifacts = self._pipeline().run(targets=['upper'])
+        os.makedirs(artifacts['upper'] + '.tmp-1')
+        self._pipeline().run(targets=['upper'], force=['upper'])
+        self.assertEqual(self._temporary_directories(), [])
+
+    def test_unknown_stage(self):
+        with self.assertRaises(ValueError):
+            Pipeline(self.directory, [Stage('upper', upper_stage, depends_on=['read'])])
+        with self.assertRaises(ValueError):
+            self._pipeline().run(targets=['missing'])
+
+    def test_cycle(self):
+        pipeline = Pipeline(self.directory, [
+            Stage('read', read_stage, depends_on=['upper']),
+            Stage('upper', upper_stage, depends_on=['read']),
+        ])
+        for processes in (1, 2):
+            with self.assertRaises(ValueError):
+                pipeline.run(processes=processes)
+
+
+class BuildPipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        with open(os.path.join(SAMPLE_DATA, 'config.json')) as infile:
+            config = json.load(infile)
+        config['network_config_files'] = {
+            name: os.path.join(SAMPLE_DATA, os.path.basename(path))
+            for name, path in config['network_config_files'].items()
+        }
+        self.config_file = os.path.join(self.directory, 'config.json')
+        with open(self.config_file, 'w') as outfile:
+            json.dump(config, outfile)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _pipeline(self, **kwargs):
+        return build_pipeline(
+            os.path.join(self.directory, 'artifacts'), self.config_file,
+            os.path.join(SAMPLE_DATA, 'households_00106_dirty.csv'),
+            os.path.join(SAMPLE_DATA, 'persons_00106_dirty.csv'),
+            marginals_csv=os.path.join(SAMPLE_DATA, 'marginals_00106.csv'), puma='00106',
+            **kwargs)
+
+    def test_stages(self):
+        pipeline = self._pipeline()
+        self.assertEqual(pipeline.stages['allocation'].depends_on,
+                         ('households', 'persons', 'marginals'))
+        self.assertEqual(pipeline.stages['person_model'].depends_on, ('persons',))
+        self.assertEqual(pipeline.stages['household_model'].depends_on, ('households',))
+        self.assertEqual(pipeline.stages['population'].depends_on,
+                         ('allocation', 'person_model', 'household_model'))
+
+    def test_missing_marginals(self):
+        with self.assertRaises(ValueError):
+            build_pipeline(self.directory, self.config_file, 'households.csv', 'persons.csv',
+                           puma='00106')
+
+    def test_run_inputs(self):
+        targets = ['households', 'persons', 'marginals']
+        pipeline = self._pipeline()
+        artifacts = pipeline.run(targets)
+        persons = pandas.read_pickle(os.path.join(artifacts['persons'], 'cleaned.pkl'))
+        self.assertIn('age', persons.columns)
+        self.assertTrue(len(persons) > 0)
+
+        pipeline = self._pipeline(seed=1)
+        pipeline.run(targets)
+        self.assertEqual(set(pipeline.last_run.values()), {'skipped'})
@@ -6,6 +6,9 @@ from __future__ import (
 
 import unittest
 
+import numpy as np
+import pandas
+
 from doppelganger import Preprocessor, inputs
 
 
@@ -34,3 +37,57 @@ class PreprocessingTest(unittest.TestCase):
         for sample_birthday in ['', float('nan')]:
             age = inputs.yyyy_to_age(sample_birthday)
             self.assertEqual(age, inputs.UNKNOWN)
+
+    def _assert_vectorized(self, preprocess, values):
+        for dtype in (object, str):
+            series = pandas.Series(values, dtype=dtype)
+            expected = [preprocess(value) for value in series]
+            actual = inputs.process_series(preprocess, series).tolist()
+            # Missing values must be the same UNKNOWN, not NaN
+            self.assertSequenceEqual(actual, expected)
+
+    def test_vectorized_preprocessors(self):
+        self._assert_vectorized(
+            inputs.age_discrete, ['15', '018', 34, '', None, np.nan, '64', '90'])
+        self._assert_vectorized(inputs.gender_named, ['1', 2, '3', '', np.nan, '02'])
+        self._assert_vectorized(inputs.gender_named, ['', None])
+        self._assert_vectorized(inputs.num_people_discrete, ['01', '3', 4, '12'])
+        labels, preprocess = inputs.generate_binning_preprocessor([0, 20000, 40000])
+        self._assert_vectorized(
+            preprocess, ['-5', 0, '0000001', 20000, '40000', '0040001', '', np.nan])
+        self.assertSequenceEqual(
+            inputs.PERSON_WEIGHT.process_series(pandas.Series(['00100', '7'])).tolist(),
+            [100, 7])
+        self.assertRaises(ValueError, inputs.num_people_discrete.vectorized,
+                          pandas.Series(['1', '']))
+
+    def test_vectorized_rejects_non_integers(self):
+        _, preprocess = inputs.generate_binning_preprocessor([0, 20000, 40000])
+        for value in ('2.0', '2.7', 'x'):
+            for elementwise, vectorized in (
+                    (inputs.age_discrete, inputs.age_discrete.vectorized),
+                    (inputs.gender_named, inputs.gender_named.vectorized),
+                    (inputs.num_people_discrete, inputs.num_people_discrete.vectorized),
+                    (preprocess, preprocess.vectorized),
+                    (int, inputs.PERSON_WEIGHT.process_series)):
+                self.assertRaises(ValueError, elementwise, value)
+                self.assertRaises(ValueError, vectorized, pandas.Series(['1', value]))
+
+    def test_process_dataframe(self):
+        dataframe = pandas.DataFrame({
+            'AGEP': ['15', '', '70'],
+            'wagp': ['0050000', '', '0010000'],
+            'serialno': ['a', 'b', 'c'],
+        })
+        preprocessor = Preprocessor({'sex': lambda value: 'unknown'})
+        name_map = {'age': 'agep', 'individual_income': 'wagp',
+                    'serial_number': 'serialno', 'sex': 'serialno'}
+        cleaned = preprocessor.process_dataframe(
+            dataframe, ['serial_number', 'age', 'individual_income', 'sex'], name_map)
+        self.assertSequenceEqual(
+            list(cleaned.columns), ['serial_number', 'age', 'individual_income', 'sex'])
+        self.assertSequenceEqual(cleaned['age'].fillna('').tolist(), ['0-17', '', '65+'])
+        self.assertSequenceEqual(cleaned['individual_income'].tolist(),
+                                 ['40000+', '<=40000', '<=40000'])
+        # Without a vectorized variant, processors are applied to each element
+        self.assertSequenceEqual(cleaned['sex'].tolist(), ['unknown'] * 3)
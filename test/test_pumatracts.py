@@ -0,0 +1,93 @@
+# Copyright 2017 Sidewalk Labs | https://www.apache.org/licenses/LICENSE-2.0
+
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+from mock import patch
+
+from doppelganger import Marginals, PumaTractMapping
+
+MAPPING_CSV = '''STATEFP,COUNTYFP,TRACTCE,PUMA5CE
+06,075,000100,07507
+06,001,000200,00101
+06,075,000200,07507
+06,001,000100,07507
+41,001,000100,07507
+'''
+
+
+class PumaTractMappingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _mapping_file(self, zipped):
+        path = os.path.join(self.directory, 'mapping.txt')
+        with open(path, 'w') as outfile:
+            outfile.write(MAPPING_CSV)
+        if not zipped:
+            return path
+        with zipfile.ZipFile(path + '.zip', 'w') as archive:
+            archive.write(path, 'mapping.txt')
+            archive.writestr('__MACOSX/._mapping.txt', 'resource fork')
+        return path + '.zip'
+
+    def test_from_file(self):
+        for zipped in (False, True):
+            mapping = PumaTractMapping.from_file(self._mapping_file(zipped))
+            self.assertEqual(len(mapping), 5)
+            self.assertDictEqual(next(iter(mapping)), {
+                'STATEFP': '06', 'COUNTYFP': '075', 'PUMA5CE': '07507', 'TRACTCE': '000100'})
+
+    def test_from_file_closes_archive(self):
+        opened = []
+        zip_file = zipfile.ZipFile
+
+        def open_archive(*args, **kwargs):
+            opened.append(zip_file(*args, **kwargs))
+            return opened[-1]
+
+        path = self._mapping_file(zipped=True)
+        with patch('doppelganger.pumatracts.zipfile.ZipFile', side_effect=open_archive):
+            PumaTractMapping.from_file(path)
+            with zipfile.ZipFile(path, 'a') as archive:
+                archive.writestr('other.txt', 'STATEFP\n')
+            self.assertRaises(ValueError, PumaTractMapping.from_file, path)
+        self.assertEqual(len(opened), 3)
+        for archive in opened:
+            self.assertIsNone(archive.fp)
+
+    def test_lookups(self):
+        mapping = PumaTractMapping.from_file(self._mapping_file(zipped=True))
+        # In file order, whatever the order of the pumas
+        self.assertSequenceEqual(mapping.tracts('06', ['07507', '00101']), [
+            ('075', '000100'), ('001', '000200'), ('075', '000200'), ('001', '000100')])
+        self.assertSequenceEqual(mapping.tracts('41', ['07507']), [('001', '000100')])
+        self.assertSequenceEqual(mapping.tracts('06', ['99999']), [])
+        self.assertSequenceEqual(list(mapping.select('06', ['00101']).columns),
+                                 ['STATEFP', 'COUNTYFP', 'PUMA5CE', 'TRACTCE'])
+        self.assertSequenceEqual(mapping.locate('06', '000100'),
+                                 [('075', '07507'), ('001', '07507')])
+        self.assertEqual(mapping.puma('06', '001', '000200'), '00101')
+        self.assertIsNone(mapping.puma('06', '075', '000300'))
+
+    def test_marginals(self):
+        mapping = PumaTractMapping.from_file(self._mapping_file(zipped=False))
+        response = {'B11016_010E': '1'}
+        with patch('doppelganger.marginals.Marginals._fetch_from_census',
+                   return_value=response), \
+                patch('doppelganger.marginals.CONTROLS', {'hh_size': {'1': ['B11016_010E']}}), \
+                patch('doppelganger.marginals.CONTROL_NAMES', ('1',)):
+            marginals = Marginals.from_census_data(mapping, None, state='06', pumas=['00101'])
+        self.assertSequenceEqual(marginals.data.values.tolist(),
+                                 [['06', '001', '00101', '000200', '1']])
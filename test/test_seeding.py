@@ -0,0 +1,69 @@
+# Copyright 2017 Sidewalk Labs | https://www.apache.org/licenses/LICENSE-2.0
+
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+
+import unittest
+
+from mock import patch
+import numpy
+
+from doppelganger import seeding
+
+
+class SeedingTest(unittest.TestCase):
+
+    def _draws(self, seed, *key):
+        return seeding.work_unit_rng(seed, *key).random(5)
+
+    def test_same_key_same_stream(self):
+        numpy.testing.assert_array_equal(
+            self._draws(0, 'persons', 'tract1', 'one_bucket'),
+            self._draws(0, 'persons', 'tract1', 'one_bucket')
+        )
+
+    def test_different_keys_different_streams(self):
+        draws = self._draws(0, 'persons', 'tract1', 'one_bucket')
+        self.assertFalse(numpy.array_equal(
+            draws, self._draws(0, 'persons', 'tract2', 'one_bucket')))
+        self.assertFalse(numpy.array_equal(
+            draws, self._draws(0, 'households', 'tract1', 'one_bucket')))
+        self.assertFalse(numpy.array_equal(
+            draws, self._draws(1, 'persons', 'tract1', 'one_bucket')))
+
+    def test_independent_of_order(self):
+        keys = [('persons', 'tract{}'.format(i), 'one_bucket') for i in range(3)]
+        forward = [self._draws(0, *key) for key in keys]
+        backward = [self._draws(0, *key) for key in reversed(keys)]
+        for first, second in zip(forward, reversed(backward)):
+            numpy.testing.assert_array_equal(first, second)
+
+    def test_seed_sequence_is_child_of_seed(self):
+        sequence = seeding.work_unit_seed_sequence(7, 'persons', 'tract1')
+        self.assertEqual(sequence.entropy, 7)
+        self.assertEqual(len(sequence.spawn_key), 2)
+
+    def test_random_state_without_generator(self):
+        with patch.object(seeding, 'HAS_GENERATOR', False):
+            rng = seeding.work_unit_rng(0, 'persons', 'tract1')
+            self.assertIsInstance(rng, numpy.random.RandomState)
+            numpy.testing.assert_array_equal(
+                seeding.uniform(rng, 5),
+                seeding.uniform(seeding.work_unit_rng(0, 'persons', 'tract1'), 5)
+            )
+            self.assertFalse(numpy.array_equal(
+                seeding.uniform(seeding.work_unit_rng(0, 'persons', 'tract1'), 5),
+                seeding.uniform(seeding.work_unit_rng(0, 'persons', 'tract2'), 5)
+            ))
+            self.assertIsInstance(seeding.random_seed(), int)
+            numpy.testing.assert_array_equal(
+                seeding.work_unit_seed_sequence(0, 'persons', 'tract1'),
+                seeding.work_unit_seed_sequence(0, 'persons', 'tract1'))
+
+    def test_uniform(self):
+        for random_state in (seeding.work_unit_rng(0, 'persons'), numpy.random.RandomState(0),
+                             numpy.random):
+            draws = seeding.uniform(random_state, (2, 3))
+            self.assertEqual(draws.shape, (2, 3))
+            self.assertTrue(((draws >= 0) & (draws < 1)).all())
@@ -0,0 +1,52 @@
+# Copyright 2017 Sidewalk Labs | https://www.apache.org/licenses/LICENSE-2.0
+
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import pandas
+
+from doppelganger import sinks
+
+
+class SinksTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _chunks(self):
+        return [
+            pandas.DataFrame({'a': [1, 2]}, index=pandas.RangeIndex(0, 2)),
+            pandas.DataFrame({'a': [3]}, index=pandas.RangeIndex(2, 3)),
+        ]
+
+    def test_csv_sink(self):
+        path = os.path.join(self.directory, 'out.csv')
+        sink = sinks.CsvSink(path)
+        for chunk in self._chunks():
+            sink.write(chunk)
+        sink.close()
+        written = pandas.read_csv(path, index_col=0)
+        pandas.testing.assert_frame_equal(written, pandas.concat(self._chunks()))
+
+    def test_callback_sink(self):
+        written = []
+        sink = sinks.as_sink(written.append)
+        for chunk in self._chunks():
+            sink.write(chunk)
+        sink.close()
+        self.assertSequenceEqual([len(chunk) for chunk in written], [2, 1])
+
+    def test_as_sink_keeps_sinks(self):
+        sink = sinks.CsvSink('file')
+        self.assertIs(sinks.as_sink(sink), sink)
+        with self.assertRaises(TypeError):
+            sinks.as_sink('file')
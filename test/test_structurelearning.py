@@ -0,0 +1,107 @@
+# Copyright 2017 Sidewalk Labs | https://www.apache.org/licenses/LICENSE-2.0
+
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+
+import unittest
+
+import numpy
+import pandas
+
+from doppelganger import bayesnets, datasource, structurelearning
+
+
+class StructureLearningTest(unittest.TestCase):
+
+    def _fields(self):
+        return ['age', 'income', 'sex']
+
+    def _mock_rows(self):
+        # income is determined by age, sex is independent of both
+        rows = []
+        for age, income in [('0-17', '<=0'), ('18-34', '0-40k'), ('65+', '40k+')]:
+            for sex in ['M', 'F']:
+                rows.extend([(age, income, sex)] * 20)
+        return rows
+
+    def _mock_counts(self):
+        return structurelearning.WeightedCounts.from_rows(self._mock_rows(), self._fields())
+
+    def test_counts_collapse_rows(self):
+        counts = self._mock_counts()
+        self.assertEqual(counts.codes.shape, (6, 3))
+        self.assertEqual(counts.total, 120)
+        self.assertSequenceEqual(counts.cardinalities, (3, 3, 2))
+
+    def test_counts_from_cleaned_data_weighted(self):
+        cleaned = datasource.CleanedData(pandas.DataFrame({
+            'age': ['0-17', '0-17', '65+'],
+            'sex': ['M', 'M', 'F'],
+            'weight': [2, 3, 4]
+        }))
+        counts = structurelearning.WeightedCounts.from_cleaned_data(
+            cleaned, ['age', 'sex'], weight_field='weight')
+        self.assertEqual(counts.total, 9)
+        numpy.testing.assert_array_equal(sorted(counts.weights), [4, 5])
+
+    def test_counts_from_segmented_data(self):
+        segmented = bayesnets.SegmentedData({
+            'one': self._mock_rows()[:60], 'two': self._mock_rows()[60:]
+        })
+        counts = structurelearning.WeightedCounts.from_segmented_data(segmented, self._fields())
+        self.assertEqual(counts.total, 120)
+        counts = structurelearning.WeightedCounts.from_segmented_data(
+            segmented, self._fields(), segments=['one'])
+        self.assertEqual(counts.total, 60)
+
+    def test_family_counts(self):
+        counts = self._mock_counts()
+        table = counts.family_counts(1, (0,))
+        self.assertEqual(table.shape, (3, 3))
+        # Each age determines exactly one income
+        numpy.testing.assert_array_equal(sorted(table.max(axis=1)), [40, 40, 40])
+        numpy.testing.assert_array_equal(table.sum(axis=1), [40, 40, 40])
+
+    def test_family_score_prefers_dependence(self):
+        counts = self._mock_counts()
+        self.assertGreater(counts.family_score(1, (0,)), counts.family_score(1, ()))
+        self.assertLess(counts.family_score(2, (0,)), counts.family_score(2, ()))
+
+    def test_chow_liu(self):
+        structure = structurelearning.learn_chow_liu_structure(self._mock_counts())
+        self.assertSequenceEqual(structure, ((), (0,), ()))
+
+    def test_chow_liu_forest(self):
+        # The root shares no information with the other fields, which still
+        # depend on each other
+        counts = structurelearning.WeightedCounts.from_rows(
+            [('c', 'x', 'p'), ('c', 'y', 'q')], self._fields())
+        self.assertSequenceEqual(
+            structurelearning.learn_chow_liu_structure(counts), ((), (), (1,)))
+        self.assertSequenceEqual(
+            structurelearning.learn_chow_liu_structure(counts, root=2), ((), (2,), ()))
+
+    def test_hill_climb(self):
+        counts = self._mock_counts()
+        structure = structurelearning.learn_hill_climb_structure(counts, max_parents=2)
+        # The edge between age and income may point either way
+        self.assertIn(structure, (((), (0,), ()), ((1,), (), ())))
+        self.assertGreater(counts.score(structure), counts.score(((), (), ())))
+
+    def test_hill_climb_max_parents(self):
+        counts = self._mock_counts()
+        structure = structurelearning.learn_hill_climb_structure(counts, max_parents=0)
+        self.assertSequenceEqual(structure, ((), (), ()))
+
+    def test_hill_climb_parallel(self):
+        counts = self._mock_counts()
+        self.assertSequenceEqual(
+            structurelearning.learn_hill_climb_structure(counts, processes=2),
+            structurelearning.learn_hill_climb_structure(self._mock_counts())
+        )
+
+    def test_structure_matches_defined_structure(self):
+        structure = structurelearning.learn_chow_liu_structure(self._mock_counts())
+        defined = bayesnets.define_bayes_net_structure(self._fields(), {'age': ['income']})
+        self.assertSequenceEqual(structure, defined)
@@ -0,0 +1,87 @@
+# Copyright 2017 Sidewalk Labs | https://www.apache.org/licenses/LICENSE-2.0
+
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pandas
+
+from doppelganger import validation, Marginals, Population
+
+try:
+    import pyarrow  # noqa: F401
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
+
+
+class ValidationTest(unittest.TestCase):
+
+    def _marginals(self):
+        return Marginals(pandas.DataFrame({
+            'STATEFP': ['06', '06'],
+            'COUNTYFP': ['001', '001'],
+            'PUMA5CE': ['00101', '00101'],
+            'TRACTCE': ['000100', '000200'],
+            'count': ['2', '1'],
+            '1': ['1', '1'],
+            '2': ['1', '0'],
+            '3': ['0', '0'],
+            '4+': ['0', '0'],
+            '0-17': ['1', '0'],
+            '18-34': ['2', '0'],
+            '35-64': ['0', '1'],
+            '65+': ['0', '0'],
+        }))
+
+    def _population(self):
+        households = pandas.DataFrame({
+            'tract': ['000100', '000100', '000200'],
+            'num_people': ['1', '1', '1'],
+        })
+        persons = pandas.DataFrame({
+            'tract': ['000100', '000100', '000100', '000200', 'other'],
+            'age': ['0-17', '18-34', '18-34', '35-64', '35-64'],
+        })
+        return Population(persons, households)
+
+    def test_validate(self):
+        report = validation.validate(self._population(), self._marginals())
+        self.assertSequenceEqual(report['observed'].tolist(), [3, 3, 0, 0, 0, 1, 2, 1, 0])
+        self.assertSequenceEqual(report['absolute_error'].tolist(), [0, 1, 1, 0, 0, 0, 0, 0, 0])
+        self.assertAlmostEqual(report.loc['1', 'rmse'], np.sqrt(0.5))
+        self.assertAlmostEqual(report.loc['1', 'srmse'], np.sqrt(0.5))
+        self.assertTrue(np.isnan(report.loc['3', 'srmse']))
+
+    def test_chunks_and_categoricals(self):
+        population = self._population()
+        validator = validation.PopulationValidator(self._marginals())
+        persons = population.generated_people
+        validator.add_chunk('persons', persons.iloc[:2])
+        validator.add_chunk('persons', persons.iloc[2:].astype('category'))
+        validator.add_households(population.generated_households)
+        self.assertEqual(validator.unmatched_rows['persons'], 1)
+        pandas.testing.assert_frame_equal(
+            validator.report(), validation.validate(population, self._marginals()))
+        counts = validator.counts()
+        self.assertEqual(counts.loc['000100', ('18-34', 'observed')], 2)
+        self.assertEqual(counts.loc['000200', ('count', 'expected')], 1)
+        self.assertAlmostEqual(validator.total_srmse(), np.sqrt(2 / 18) / (10 / 18))
+        self.assertRaises(ValueError, validator.add_chunk, 'vehicles', persons)
+
+    @unittest.skipUnless(HAS_PYARROW, 'requires pyarrow')
+    def test_dataset(self):
+        directory = tempfile.mkdtemp()
+        try:
+            persons_path, households_path = directory + '/persons', directory + '/households'
+            self._population().write_dataset(persons_path, households_path)
+            validator = validation.PopulationValidator(self._marginals())
+            validator.add_dataset(persons_path, households_path, tracts=['000200'])
+            self.assertSequenceEqual(validator.observed.sum(axis=1).tolist(), [0, 3])
+        finally:
+            shutil.rmtree(directory)